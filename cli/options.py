@@ -118,6 +118,8 @@ process = Map({
     'blur_samplesize': 60, # sample size to use for blur detection
     'similarity_score': 0.8, # maximum similarity score before image is discarded
     'similarity_size': 64, # base similarity detection on reduced images
+    'similarity_distance': 12, # max phash or dhash hamming distance for image to be compared using ssim
+    'similarity_index': '', # file to persist similarity index between runs, empty to disable
     'range_score': 0.15, # min score for face color dynamicrange detection
     # face processing settings
     'face_score': 0.7, # min face detection score
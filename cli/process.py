@@ -9,6 +9,7 @@ from PIL import Image, ImageOps
 from pi_heif import register_heif_opener
 from skimage.metrics import structural_similarity as ssim
 from scipy.stats import beta
+from scipy.fft import dctn
 
 import util
 import sdapi
@@ -17,8 +18,9 @@ import options
 face_model = None
 body_model = None
 segmentation_model = None
-all_images = []
+similarity_index = None
 all_images_by_type = {}
+popcount = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
 
 
 class Result():
@@ -69,16 +71,104 @@ def detect_dynamicrange(image: Image):
     return round(res, 2)
 
 
-def detect_simmilar(image: Image):
+def image_hashes(image: Image):
+    # 64-bit perceptual hash from low frequency dct coefficients and 64-bit difference hash from horizontal gradients
+    gray = ImageOps.grayscale(image)
+    data = np.asarray(gray.resize((32, 32), Image.LANCZOS), dtype=np.float32)
+    dct = dctn(data, norm='ortho')[:8, :8].flatten()
+    phash = dct > np.median(dct[1:]) # dc term is excluded from median as it only carries brightness
+    data = np.asarray(gray.resize((9, 8), Image.LANCZOS), dtype=np.float32)
+    dhash = (data[:, 1:] > data[:, :-1]).flatten()
+    return np.packbits(np.stack([phash, dhash])).view('>u8').astype(np.uint64)
+
+
+class SimilarityIndex():
+    # perceptual hashes and reduced images of accepted images
+    # candidates are found by vectorized hamming distance on hashes and only candidates are compared using ssim
+    def __init__(self, size: int, filename: str = None):
+        self.size = size
+        self.filename = filename
+        self.count = 0
+        self.hashes = np.zeros((0, 2), dtype=np.uint64)
+        self.thumbs = np.zeros((0, size, size), dtype=np.uint8)
+        self.keys = []
+        self.positions = {}
+        self.stats = { 'lookups': 0, 'candidates': 0 }
+        if filename is not None and os.path.isfile(filename):
+            self.load()
+
+    def load(self):
+        try:
+            with np.load(self.filename, allow_pickle=False) as data:
+                if data['thumbs'].shape[1:] != (self.size, self.size): # reduced image size changed so stored images cannot be compared
+                    util.log.warning(f'similarity index size mismatch, ignoring: {self.filename}')
+                    return
+                self.hashes, self.thumbs, self.keys = data['hashes'], data['thumbs'], data['keys'].tolist()
+                self.positions = { k: i for i, k in enumerate(self.keys) }
+                self.count = len(self.keys)
+        except Exception as e:
+            util.log.warning(f'similarity index load failed: {self.filename} {e}')
+            return
+        util.log.info(f'similarity index loaded: {self.filename} images={self.count}')
+
+    def save(self):
+        if self.filename is None:
+            return
+        os.makedirs(os.path.dirname(self.filename) or '.', exist_ok=True)
+        with open(self.filename, 'wb') as f:
+            np.savez_compressed(f, hashes=self.hashes[:self.count], thumbs=self.thumbs[:self.count], keys=np.array(self.keys, dtype=str))
+
+    def grow(self):
+        if self.count < len(self.hashes):
+            return
+        capacity = max(2 * len(self.hashes), 256)
+        self.hashes = np.concatenate([self.hashes, np.zeros((capacity - len(self.hashes), 2), dtype=np.uint64)])
+        self.thumbs = np.concatenate([self.thumbs, np.zeros((capacity - len(self.thumbs), self.size, self.size), dtype=np.uint8)])
+
+    def distances(self, hashes: np.ndarray):
+        # hamming distance of phash and dhash to every indexed image
+        xor = np.bitwise_xor(self.hashes[:self.count], hashes[None, :])
+        return popcount[xor.view(np.uint8)].reshape(self.count, 2, 8).sum(axis=2)
+
+    def lookup(self, hashes: np.ndarray, thumb: np.ndarray, key: str = None):
+        self.stats['lookups'] += 1
+        if self.count == 0:
+            return 0
+        distances = self.distances(hashes)
+        mask = (distances <= options.process.similarity_distance).any(axis=1)
+        if key in self.positions:
+            mask[self.positions[key]] = False # same source processed again in incremental run
+        candidates = np.flatnonzero(mask)
+        self.stats['candidates'] += len(candidates)
+        similarity = 0
+        for i in candidates:
+            val = ssim(thumb, self.thumbs[i], data_range=255, channel_axis=None, gradient=False, full=False)
+            similarity = max(similarity, val)
+        return similarity
+
+    def add(self, hashes: np.ndarray, thumb: np.ndarray, key: str = None):
+        key = key or f'image-{self.count}'
+        if key in self.positions:
+            i = self.positions[key]
+            self.hashes[i], self.thumbs[i] = hashes, thumb
+            return
+        self.grow()
+        self.hashes[self.count], self.thumbs[self.count] = hashes, thumb
+        self.positions[key] = self.count
+        self.keys.append(key)
+        self.count += 1
+
+
+def detect_simmilar(image: Image, key: str = None):
+    global similarity_index
+    if similarity_index is None:
+        similarity_index = SimilarityIndex(options.process.similarity_size, options.process.similarity_index or None)
     img = image.resize((options.process.similarity_size, options.process.similarity_size))
     img = ImageOps.grayscale(img)
     data = np.array(img)
-    similarity = 0
-    for i in all_images:
-        val = ssim(data, i, data_range=255, channel_axis=None, gradient=False, full=False)
-        if val > similarity:
-            similarity = val
-    all_images.append(data)
+    hashes = image_hashes(image)
+    similarity = similarity_index.lookup(hashes, data, key)
+    similarity_index.add(hashes, data, key)
     return similarity
 
 
@@ -108,6 +198,8 @@ def unload():
     global segmentation_model
     if segmentation_model is not None:
         segmentation_model = None
+    if similarity_index is not None:
+        similarity_index.save()
 
 
 def encode(img):
@@ -122,8 +214,8 @@ def reset():
     unload()
     global all_images_by_type
     all_images_by_type = {}
-    global all_images
-    all_images = []
+    global similarity_index
+    similarity_index = None
 
 
 def upscale_restore_image(res: Result, upscale: bool = False, restore: bool = False):
@@ -262,6 +354,14 @@ def save_image(res: Result, folder: str):
     return res
 
 
+def source_key(res: Result):
+    try:
+        stat = os.stat(res.input)
+        return f'{res.type}:{os.path.abspath(res.input)}:{stat.st_size}:{int(stat.st_mtime)}'
+    except OSError:
+        return None
+
+
 def file(filename: str, folder: str, tag = None, requested = []): # noqa: B006
     # initialize result dict
     res = Result(fn = filename, typ='unknown', tag=tag, requested = requested)
@@ -302,9 +402,9 @@ def file(filename: str, folder: str, tag = None, requested = []): # noqa: B006
             res.image = None
     if 'similarity' in requested:
         res.ops.append('similarity')
-        val = detect_simmilar(res.image)
+        val = detect_simmilar(res.image, key=source_key(res))
         if val > options.process.similarity_score:
-            res.message = f'dynamic range check failed: {val}'
+            res.message = f'similarity check failed: {val}'
             res.image = None
     if res.image is None:
         return res
@@ -314,6 +314,8 @@ def process_inputs():
         else:
             log.info(f'processed folder exists: {args.process_dir}')
     steps = [step for step in processing_options if step in ['face', 'body', 'original']]
+    if not options.process.similarity_index:
+        options.process.similarity_index = os.path.join(args.process_dir, 'similarity-index.npz') # reused by incremental runs into same folder
     process.reset()
     metadata = {}
     for step in steps:
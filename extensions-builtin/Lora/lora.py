@@ -2,8 +2,7 @@ import os
 import re
 from typing import Union
 import torch
-from modules import shared, devices, sd_models, errors, scripts, sd_hijack, hashes
-from modules.modelloader import directory_files, extension_filter
+from modules import shared, devices, sd_models, errors, scripts, sd_hijack, hashes, files_index
 
 metadata_tags_order = {"ss_sd_model_name": 1, "ss_resolution": 2, "ss_clip_skip": 3, "ss_num_train_images": 10, "ss_tag_frequency": 20}
 
@@ -445,7 +444,7 @@ def list_available_loras():
 
     os.makedirs(shared.cmd_opts.lora_dir, exist_ok=True)
 
-    for filename in sorted([*filter(extension_filter(['.PT', '.CKPT', '.SAFETENSORS']), directory_files(shared.cmd_opts.lora_dir))], key=str.lower):
+    for filename in sorted(files_index.query('loras'), key=str.lower):
 
         name = os.path.splitext(os.path.basename(filename))[0]
         entry = LoraOnDisk(name, filename)
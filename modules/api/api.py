@@ -13,16 +13,12 @@ from PIL import PngImagePlugin,Image
 import piexif
 import piexif.helper
 import gradio as gr
-from modules import errors, shared, sd_samplers, deepbooru, sd_hijack, images, scripts, ui, postprocessing
+from modules import errors, shared, sd_samplers, sd_hijack, images, scripts, postprocessing
 from modules.sd_vae import vae_dict
 from modules.api import models
 from modules.processing import StableDiffusionProcessingTxt2Img, StableDiffusionProcessingImg2Img, process_images
-from modules.textual_inversion.textual_inversion import create_embedding, train_embedding
-from modules.textual_inversion.preprocess import preprocess
-from modules.hypernetworks.hypernetwork import create_hypernetwork, train_hypernetwork
 from modules.sd_models import checkpoints_list, unload_model_weights, reload_model_weights
 from modules.sd_models_config import find_checkpoint_config_near_filename
-from modules.realesrgan_model import get_realesrgan_models
 from modules import devices
 
 errors.install()
@@ -119,6 +115,7 @@ class Api:
         self.add_api_route("/sdapi/v1/extra-batch-images", self.extras_batch_images_api, methods=["POST"], response_model=models.ExtrasBatchImagesResponse)
         self.add_api_route("/sdapi/v1/png-info", self.pnginfoapi, methods=["POST"], response_model=models.PNGInfoResponse)
         self.add_api_route("/sdapi/v1/progress", self.progressapi, methods=["GET"], response_model=models.ProgressResponse)
+        self.add_api_route("/sdapi/v1/png-info/bulk", self.pnginfobulkapi, methods=["POST"], response_model=List[models.PNGInfoBulkItem])
         self.add_api_route("/sdapi/v1/interrogate", self.interrogateapi, methods=["POST"])
         self.add_api_route("/sdapi/v1/interrupt", self.interruptapi, methods=["POST"])
         self.add_api_route("/sdapi/v1/skip", self.skip, methods=["POST"])
@@ -143,6 +140,13 @@ class Api:
         self.add_api_route("/sdapi/v1/train/hypernetwork", self.train_hypernetwork, methods=["POST"], response_model=models.TrainResponse)
         self.add_api_route("/sdapi/v1/shutdown", self.shutdown, methods=["POST"])
         self.add_api_route("/sdapi/v1/memory", self.get_memory, methods=["GET"], response_model=models.MemoryResponse)
+        self.add_api_route("/sdapi/v1/compile", self.get_compile, methods=["GET"])
+        self.add_api_route("/sdapi/v1/memory/estimate", self.memory_estimate, methods=["POST"])
+        self.add_api_route("/sdapi/v1/result-cache", self.get_result_cache, methods=["GET"])
+        self.add_api_route("/sdapi/v1/result-cache", self.clear_result_cache, methods=["DELETE"])
+        self.add_api_route("/sdapi/v1/catalogue", self.get_catalogue, methods=["GET"], response_model=List)
+        self.add_api_route("/sdapi/v1/catalogue/status", self.get_catalogue_status, methods=["GET"])
+        self.add_api_route("/sdapi/v1/catalogue/backfill", self.post_catalogue_backfill, methods=["POST"])
         self.add_api_route("/sdapi/v1/unload-checkpoint", self.unloadapi, methods=["POST"])
         self.add_api_route("/sdapi/v1/reload-checkpoint", self.reloadapi, methods=["POST"])
         self.add_api_route("/sdapi/v1/scripts", self.get_scripts_list, methods=["GET"], response_model=models.ScriptsList)
@@ -240,6 +244,7 @@ class Api:
         script_runner = scripts.scripts_txt2img
         if not script_runner.scripts:
             script_runner.initialize_scripts(False)
+            from modules import ui
             ui.create_ui(None)
         if not self.default_script_arg_txt2img:
             self.default_script_arg_txt2img = self.init_default_script_args(script_runner)
@@ -285,6 +290,7 @@ class Api:
         script_runner = scripts.scripts_img2img
         if not script_runner.scripts:
             script_runner.initialize_scripts(True)
+            from modules import ui
             ui.create_ui(None)
         if not self.default_script_arg_img2img:
             self.default_script_arg_img2img = self.init_default_script_args(script_runner)
@@ -360,6 +366,31 @@ class Api:
 
         return models.PNGInfoResponse(info=geninfo, items=items)
 
+    def pnginfobulkapi(self, req: models.PNGInfoBulkRequest):
+        import os
+        from concurrent.futures import ThreadPoolExecutor
+        from modules.generation_parameters_copypaste import parse_generation_parameters
+        from modules.catalogue import in_output_folders
+        if any(not in_output_folders(path) for path in req.paths):
+            raise HTTPException(status_code=403, detail="Paths must be inside output folders")
+        sources = [(str(i), base64.b64decode(image.split(";base64,")[-1])) for i, image in enumerate(req.images)]
+        for path in req.paths:
+            if os.path.isdir(path):
+                sources += [(fn, fn) for fn in shared.listfiles(path)]
+            else:
+                sources.append((path, path))
+
+        def parse(source):
+            name, data = source
+            try:
+                geninfo, items, size = images.read_info_from_file(data)
+                return models.PNGInfoBulkItem(name=name, info=geninfo or "", items=items, parameters=parse_generation_parameters(geninfo) if geninfo else {}, width=size[0] if size else None, height=size[1] if size else None)
+            except Exception as e:
+                return models.PNGInfoBulkItem(name=name, error=str(e))
+
+        with ThreadPoolExecutor(max_workers=req.workers or min(16, (os.cpu_count() or 4) + 4)) as executor:
+            return list(executor.map(parse, sources))
+
     def progressapi(self, req: models.ProgressRequest = Depends()):
         # copy from check_progress_call of ui.py
 
@@ -401,6 +432,7 @@ class Api:
             if interrogatereq.model == "clip":
                 processed = shared.interrogator.interrogate(img)
             elif interrogatereq.model == "deepdanbooru":
+                from modules import deepbooru
                 processed = deepbooru.model.tag(img)
             else:
                 raise HTTPException(status_code=404, detail="Model not found")
@@ -475,6 +507,7 @@ class Api:
         return [{"name":x.name(), "cmd_dir": getattr(x, "cmd_dir", None)} for x in shared.face_restorers]
 
     def get_realesrgan_models(self):
+        from modules.realesrgan_model import get_realesrgan_models
         return [{"name":x.name,"path":x.data_path, "scale":x.scale} for x in get_realesrgan_models(None)]
 
     def get_prompt_styles(self):
@@ -512,6 +545,7 @@ class Api:
         return shared.refresh_vaes()
 
     def create_embedding(self, args: dict):
+        from modules.textual_inversion.textual_inversion import create_embedding
         try:
             shared.state.begin()
             filename = create_embedding(**args) # create empty embedding
@@ -523,6 +557,7 @@ class Api:
             return models.TrainResponse(info = f"create embedding error: {e}")
 
     def create_hypernetwork(self, args: dict):
+        from modules.hypernetworks.hypernetwork import create_hypernetwork
         try:
             shared.state.begin()
             filename = create_hypernetwork(**args) # create empty embedding # pylint: disable=E1111
@@ -533,6 +568,7 @@ class Api:
             return models.TrainResponse(info = f"create hypernetwork error: {e}")
 
     def preprocess(self, args: dict):
+        from modules.textual_inversion.preprocess import preprocess
         try:
             shared.state.begin()
             preprocess(**args) # quick operation unless blip/booru interrogation is enabled
@@ -549,6 +585,7 @@ class Api:
             return models.PreprocessResponse(info = f'preprocess error: {e}')
 
     def train_embedding(self, args: dict):
+        from modules.textual_inversion.textual_inversion import train_embedding
         try:
             shared.state.begin()
             apply_optimizations = False
@@ -570,6 +607,7 @@ class Api:
             return models.TrainResponse(info = f"train embedding error: {msg}")
 
     def train_hypernetwork(self, args: dict):
+        from modules.hypernetworks.hypernetwork import train_hypernetwork
         try:
             shared.state.begin()
             shared.loaded_hypernetworks = []
@@ -598,6 +636,44 @@ class Api:
         import sys
         sys.exit(0)
 
+    def memory_estimate(self, txt2imgreq: models.StableDiffusionTxt2ImgProcessingAPI):
+        from modules import memory_planner
+        populate = txt2imgreq.copy(update={ "sampler_name": validate_sampler_name(txt2imgreq.sampler_name or txt2imgreq.sampler_index), "do_not_save_samples": True, "do_not_save_grid": True })
+        if populate.sampler_name:
+            populate.sampler_index = None
+        args = vars(populate)
+        for key in ['script_name', 'script_args', 'alwayson_scripts', 'send_images', 'save_images']:
+            args.pop(key, None)
+        p = StableDiffusionProcessingTxt2Img(sd_model=shared.sd_model, **args)
+        return memory_planner.estimate(p)
+
+    def get_compile(self):
+        from modules import sd_compile
+        return sd_compile.manager.summary() if sd_compile.manager is not None else {}
+
+    def get_result_cache(self):
+        from modules import result_cache
+        return result_cache.summary()
+
+    def clear_result_cache(self):
+        from modules import result_cache
+        return result_cache.clear()
+
+    def get_catalogue(self, req: models.CatalogueRequest = Depends()):
+        from modules import catalogue
+        return catalogue.query(model=req.model, prompt=req.prompt, seed=req.seed, since=req.since, until=req.until, folder=req.folder, limit=req.limit, offset=req.offset)
+
+    def get_catalogue_status(self):
+        from modules import catalogue
+        return catalogue.summary()
+
+    def post_catalogue_backfill(self, req: models.CatalogueBackfillRequest):
+        from modules import catalogue
+        if any(not catalogue.in_output_folders(folder) for folder in req.folders or []):
+            raise HTTPException(status_code=403, detail="Folders must be inside output folders")
+        catalogue.start_backfill(folders=req.folders, workers=req.workers or None)
+        return catalogue.summary()
+
     def get_memory(self):
         try:
             import os
@@ -172,10 +172,38 @@ class PNGInfoResponse(BaseModel):
     info: str = Field(title="Image info", description="A string with the parameters used to generate the image")
     items: dict = Field(title="Items", description="An object containing all the info the image had")
 
+class PNGInfoBulkRequest(BaseModel):
+    images: List[str] = Field(default=[], title="Images", description="Base64 encoded images")
+    paths: List[str] = Field(default=[], title="Paths", description="Image files or folders on server, must be inside output folders")
+    workers: int = Field(default=0, title="Workers", description="Number of parallel workers, 0 for automatic")
+
+class PNGInfoBulkItem(BaseModel):
+    name: str = Field(title="Name", description="File path or index of base64 image")
+    info: str = Field(default="", title="Image info", description="A string with the parameters used to generate the image")
+    items: dict = Field(default={}, title="Items", description="An object containing all the info the image had")
+    parameters: dict = Field(default={}, title="Parameters", description="Parsed generation parameters")
+    width: Optional[int] = Field(default=None, title="Width", description="Image width if known from file header")
+    height: Optional[int] = Field(default=None, title="Height", description="Image height if known from file header")
+    error: Optional[str] = Field(default=None, title="Error", description="Error message if image could not be read")
+
 class LogRequest(BaseModel):
     lines: int = Field(default=100, title="Lines", description="How many lines to return")
     clear: bool = Field(default=False, title="Clear", description="Should the log be cleared after returning the lines?")
 
+class CatalogueRequest(BaseModel):
+    model: str = Field(default=None, title="Model", description="Model name or model hash prefix")
+    prompt: str = Field(default=None, title="Prompt", description="Substring of positive or negative prompt")
+    seed: int = Field(default=None, title="Seed", description="Exact seed")
+    since: str = Field(default=None, title="Since", description="Images created at or after this date, iso format or epoch seconds")
+    until: str = Field(default=None, title="Until", description="Images created before this date, iso format or epoch seconds")
+    folder: str = Field(default=None, title="Folder", description="Images in this folder")
+    limit: int = Field(default=100, title="Limit", description="Maximum number of images to return")
+    offset: int = Field(default=0, title="Offset", description="Number of images to skip")
+
+class CatalogueBackfillRequest(BaseModel):
+    folders: List[str] = Field(default=None, title="Folders", description="Folders to index, must be inside output folders, defaults to all output folders")
+    workers: int = Field(default=0, title="Workers", description="Number of parallel workers, 0 for automatic")
+
 class ProgressRequest(BaseModel):
     skip_current_image: bool = Field(default=False, title="Skip current image", description="Skip current image serialization")
 
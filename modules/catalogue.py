@@ -0,0 +1,284 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import datetime as dt
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from modules import shared, paths
+
+
+db_filename = os.path.join(paths.data_path, 'catalogue.db')
+extensions = ['.png', '.jpg', '.jpeg', '.webp', '.tiff', '.jp2']
+batch_size = 500
+lock = threading.RLock()
+connection = None
+fts = False
+backfill_thread = None
+backfill_state = { 'running': False, 'folders': [], 'scanned': 0, 'indexed': 0, 'skipped': 0, 'errors': 0, 'time': 0 }
+columns = ['path', 'folder', 'filename', 'width', 'height', 'size', 'mtime', 'created', 'hash', 'model', 'model_hash', 'seed', 'sampler', 'steps', 'cfg_scale', 'prompt', 'negative_prompt', 'info', 'params']
+
+
+def enabled():
+    return shared.opts.image_catalogue
+
+
+def connect():
+    """single shared connection used from save thread, backfill workers and api, access is serialized by lock"""
+    global connection, fts # pylint: disable=global-statement
+    if connection is not None:
+        return connection
+    with lock:
+        if connection is not None:
+            return connection
+        db = sqlite3.connect(db_filename, check_same_thread=False, timeout=30)
+        db.row_factory = sqlite3.Row
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute(f'CREATE TABLE IF NOT EXISTS images ({columns[0]} TEXT PRIMARY KEY, folder TEXT, filename TEXT, width INTEGER, height INTEGER, size INTEGER, mtime REAL, created REAL, hash TEXT, model TEXT, model_hash TEXT, seed INTEGER, sampler TEXT, steps INTEGER, cfg_scale REAL, prompt TEXT, negative_prompt TEXT, info TEXT, params TEXT)')
+        for column in ['folder', 'created', 'model', 'model_hash', 'seed', 'hash']:
+            db.execute(f'CREATE INDEX IF NOT EXISTS images_{column} ON images ({column})')
+        try: # trigram tokenizer allows indexed substring search, requires sqlite 3.34
+            db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS prompts USING fts5(prompt, negative_prompt, tokenize='trigram')")
+            fts = True
+        except sqlite3.OperationalError as e:
+            shared.log.debug(f'Image catalogue: full text search not available: {e}')
+            fts = False
+        db.commit()
+        connection = db
+    return connection
+
+
+def file_hash(filename):
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def read_info(filename):
+    """generation parameters and size without decoding pixel data or running watermark detection"""
+    from modules import images
+    geninfo, _items, size = images.read_info_from_file(filename)
+    if size is None:
+        with Image.open(filename) as image:
+            size = image.size
+    return size[0], size[1], geninfo or ''
+
+
+def to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def entry(filename, info=None, size=None, created=None):
+    """catalogue row for image file, info and size are read from file when not known"""
+    from modules.generation_parameters_copypaste import parse_generation_parameters
+    filename = os.path.abspath(filename)
+    stat = os.stat(filename)
+    if info is None or size is None:
+        width, height, file_info = read_info(filename)
+        info = file_info if info is None else info
+    else:
+        width, height = size
+    params = parse_generation_parameters(info) if len(info) > 0 else {}
+    return {
+        'path': filename,
+        'folder': os.path.dirname(filename),
+        'filename': os.path.basename(filename),
+        'width': width,
+        'height': height,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'created': created or stat.st_mtime,
+        'hash': file_hash(filename),
+        'model': params.get('Model', None),
+        'model_hash': params.get('Model hash', None),
+        'seed': to_int(params.get('Seed', None)),
+        'sampler': params.get('Sampler', None),
+        'steps': to_int(params.get('Steps', None)),
+        'cfg_scale': to_float(params.get('CFG scale', None)),
+        'prompt': params.get('Prompt', ''),
+        'negative_prompt': params.get('Negative prompt', ''),
+        'info': info,
+        'params': json.dumps(params, default=str),
+    }
+
+
+def rowids(db, rows):
+    res = db.execute(f'SELECT rowid, path FROM images WHERE path IN ({", ".join(["?"] * len(rows))})', [row['path'] for row in rows]).fetchall()
+    return { r['path']: r['rowid'] for r in res }
+
+
+def insert(rows):
+    if len(rows) == 0:
+        return
+    db = connect()
+    with lock:
+        if fts: # replaced rows get new rowid so their search entries are removed first
+            db.executemany('DELETE FROM prompts WHERE rowid = ?', [(rowid,) for rowid in rowids(db, rows).values()])
+        db.executemany(f'INSERT OR REPLACE INTO images ({", ".join(columns)}) VALUES ({", ".join(["?"] * len(columns))})', [[row[c] for c in columns] for row in rows])
+        if fts:
+            ids = rowids(db, rows)
+            db.executemany('INSERT INTO prompts (rowid, prompt, negative_prompt) VALUES (?, ?, ?)', [(ids[row['path']], row['prompt'], row['negative_prompt']) for row in rows if row['path'] in ids])
+        db.commit()
+
+
+def add(filename, info=None, size=None):
+    """called by save pipeline for every saved image, parameters are already known so file is only hashed"""
+    if not enabled():
+        return
+    try:
+        insert([entry(filename, info=info, size=size, created=time.time())])
+    except Exception as e:
+        shared.log.warning(f'Image catalogue: add failed: {filename} {e}')
+
+
+def output_folders():
+    folders = [shared.opts.data.get(k, None) for k in shared.opts.data_labels.keys() if k.startswith('outdir_')]
+    return sorted({os.path.abspath(f) for f in folders if isinstance(f, str) and len(f) > 0 and os.path.isdir(f)})
+
+
+def in_output_folders(path):
+    """path is output folder or inside one, checked on normalized path so it can be used before path is accessed"""
+    path = os.path.abspath(path)
+    return any(path == folder or path.startswith(folder + os.sep) for folder in output_folders())
+
+
+def indexed(folder):
+    db = connect()
+    with lock:
+        rows = db.execute('SELECT filename, mtime, size FROM images WHERE folder = ?', (folder,)).fetchall()
+    return { r['filename']: (r['mtime'], r['size']) for r in rows }
+
+
+def backfill(folders=None, workers=None):
+    """index existing images in folders, files already indexed with unchanged size and mtime are skipped, runs per folder so memory does not grow with catalogue size"""
+    if folders:
+        rejected = [f for f in folders if not in_output_folders(f)]
+        if len(rejected) > 0:
+            shared.log.warning(f'Image catalogue: backfill skipping folders outside of output folders: {rejected}')
+        folders = [os.path.abspath(f) for f in folders if in_output_folders(f)]
+    else:
+        folders = output_folders()
+    workers = workers or min(16, (os.cpu_count() or 4) + 4)
+    t0 = time.time()
+    backfill_state.update({ 'running': True, 'folders': folders, 'scanned': 0, 'indexed': 0, 'skipped': 0, 'errors': 0, 'time': 0 })
+
+    def parse(filename):
+        try:
+            return entry(filename)
+        except Exception as e:
+            shared.log.debug(f'Image catalogue: parse failed: {filename} {e}')
+            backfill_state['errors'] += 1
+            return None
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for root in folders:
+                for folder, _dirs, files in os.walk(root):
+                    known = indexed(folder)
+                    todo = []
+                    for f in files:
+                        if os.path.splitext(f)[1].lower() not in extensions:
+                            continue
+                        backfill_state['scanned'] += 1
+                        try:
+                            stat = os.stat(os.path.join(folder, f))
+                        except OSError:
+                            continue
+                        if known.get(f, None) == (stat.st_mtime, stat.st_size):
+                            backfill_state['skipped'] += 1
+                            continue
+                        todo.append(os.path.join(folder, f))
+                    for i in range(0, len(todo), batch_size):
+                        rows = [row for row in executor.map(parse, todo[i:i+batch_size]) if row is not None]
+                        insert(rows)
+                        backfill_state['indexed'] += len(rows)
+    finally:
+        backfill_state.update({ 'running': False, 'time': round(time.time() - t0, 2) })
+    shared.log.info(f'Image catalogue: backfill {backfill_state}')
+    return backfill_state
+
+
+def start_backfill(folders=None, workers=None):
+    global backfill_thread # pylint: disable=global-statement
+    if backfill_thread is not None and backfill_thread.is_alive():
+        return backfill_state
+    backfill_thread = threading.Thread(target=backfill, args=(folders, workers), daemon=True)
+    backfill_thread.start()
+    return backfill_state
+
+
+def timestamp(value):
+    """epoch seconds from number or iso date string"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(value)
+    except ValueError:
+        return dt.datetime.fromisoformat(value).timestamp()
+
+
+def query(model=None, prompt=None, seed=None, since=None, until=None, folder=None, limit=100, offset=0):
+    """search catalogue, model matches name or hash prefix, prompt is substring of positive or negative prompt, newest images first"""
+    db = connect()
+    where, args = [], []
+    if model:
+        where.append('(model = ? OR model_hash LIKE ?)')
+        args += [model, f'{model}%']
+    if prompt:
+        if fts and len(prompt) >= 3:
+            where.append('rowid IN (SELECT rowid FROM prompts WHERE prompts MATCH ?)')
+            args.append('"' + prompt.replace('"', '""') + '"')
+        else:
+            where.append('(prompt LIKE ? OR negative_prompt LIKE ?)')
+            args += [f'%{prompt}%', f'%{prompt}%']
+    if seed is not None and seed != '':
+        where.append('seed = ?')
+        args.append(int(seed))
+    if timestamp(since) is not None:
+        where.append('created >= ?')
+        args.append(timestamp(since))
+    if timestamp(until) is not None:
+        where.append('created < ?')
+        args.append(timestamp(until))
+    if folder:
+        where.append('folder = ?')
+        args.append(os.path.abspath(folder))
+    sql = f'SELECT {", ".join(columns)} FROM images {"WHERE " + " AND ".join(where) if len(where) > 0 else ""} ORDER BY created DESC LIMIT ? OFFSET ?'
+    with lock:
+        rows = db.execute(sql, args + [int(limit), int(offset)]).fetchall()
+    res = []
+    for r in rows:
+        item = dict(r)
+        item['params'] = json.loads(item['params'] or '{}')
+        res.append(item)
+    return res
+
+
+def summary():
+    db = connect()
+    with lock:
+        count = db.execute('SELECT COUNT(*) FROM images').fetchone()[0]
+    return {
+        'images': count,
+        'database': db_filename,
+        'size': os.path.getsize(db_filename) if os.path.exists(db_filename) else 0,
+        'fts': fts,
+        'backfill': backfill_state,
+    }
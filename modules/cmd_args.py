@@ -27,6 +27,7 @@ group.add_argument("--auth-file", type=str, help='Set access authentication usin
 group.add_argument("--autolaunch", action='store_true', help="Open the UI URL in the system's default browser upon launch", default=False)
 group.add_argument('--docs', default = False, action='store_true', help = "Mount Gradio docs at /docs, default: %(default)s")
 group.add_argument('--api-only', default = False, action='store_true', help = "Run in API only mode without starting UI")
+group.add_argument("--lazy", default=False, action='store_true', help="Defer loading of UI, training, upscaler and face restoration modules until first use, default: %(default)s")
 group.add_argument("--api-log", default=False, action='store_true', help="Enable logging of all API requests, default: %(default)s")
 group.add_argument("--device-id", type=str, help="Select the default CUDA device to use, default: %(default)s", default=None)
 group.add_argument("--cors-origins", type=str, help="Allowed CORS origins as comma-separated list, default: %(default)s", default=None)
@@ -37,7 +38,7 @@ group.add_argument("--tls-selfsign", action="store_true", help="Enable TLS with
 group.add_argument("--server-name", type=str, help="Sets hostname of server, default: %(default)s", default=None)
 group.add_argument("--no-hashing", action='store_true', help="Disable hashing of checkpoints, default: %(default)s", default=False)
 group.add_argument("--no-download", action='store_true', help="Disable download of default model, default: %(default)s", default=False)
-group.add_argument("--profile", action='store_true', help="Run profiler, default: %(default)s")
+group.add_argument("--profile", action='store_true', help="Run profiler including import-time profiling, default: %(default)s")
 group.add_argument("--disable-queue", action='store_true', help="Disable queues, default: %(default)s")
 group.add_argument('--debug', default = False, action='store_true', help = "Run installer with debug logging, default: %(default)s")
 group.add_argument('--use-directml', default = False, action='store_true', help = "Use DirectML if no compatible GPU is detected, default: %(default)s")
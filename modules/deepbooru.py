@@ -47,19 +47,25 @@ class DeepDanbooru:
         return res
 
     def tag_multi(self, pil_image, force_disable_ranks=False):
+        return self.tag_batch([pil_image], force_disable_ranks=force_disable_ranks)[0]
+
+    def tag_batch(self, pil_images, force_disable_ranks=False):
+        pics = [images.resize_image(2, pil_image.convert("RGB"), 512, 512) for pil_image in pil_images]
+        a = np.stack([np.array(pic, dtype=np.float32) for pic in pics]) / 255
+
+        with torch.no_grad(), devices.autocast():
+            x = torch.from_numpy(a).to(devices.device)
+            y = self.model(x).detach().cpu().numpy()
+
+        return [self.format_tags(probabilities, force_disable_ranks=force_disable_ranks) for probabilities in y]
+
+    def format_tags(self, y, force_disable_ranks=False):
         threshold = shared.opts.interrogate_deepbooru_score_threshold
         use_spaces = shared.opts.deepbooru_use_spaces
         use_escape = shared.opts.deepbooru_escape
         alpha_sort = shared.opts.deepbooru_sort_alpha
         include_ranks = shared.opts.interrogate_return_ranks and not force_disable_ranks
 
-        pic = images.resize_image(2, pil_image.convert("RGB"), 512, 512)
-        a = np.expand_dims(np.array(pic, dtype=np.float32), 0) / 255
-
-        with torch.no_grad(), devices.autocast():
-            x = torch.from_numpy(a).to(devices.device)
-            y = self.model(x)[0].detach().cpu().numpy()
-
         probability_dict = {}
 
         for tag, probability in zip(self.model.tags, y):
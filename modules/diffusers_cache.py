@@ -0,0 +1,119 @@
+import os
+import time
+import shutil
+from modules import shared, paths
+
+
+cache_dir = os.path.join(paths.models_path, 'cache', 'diffusers')
+marker_filename = '.last_used'
+
+
+def enabled():
+    return shared.opts.diffusers_pipeline_cache > 0
+
+
+def cache_key(checkpoint_info, pipeline, load_config):
+    """converted pipeline depends on source file content, diffusers version, pipeline class and conversion options"""
+    import diffusers
+    if checkpoint_info.sha256 is None:
+        checkpoint_info.calculate_shorthash()
+    source = checkpoint_info.sha256
+    if source is None: # hashing disabled so use file signature instead
+        stat = os.stat(checkpoint_info.path)
+        source = f'{stat.st_size}-{int(stat.st_mtime)}'
+    dtype = str(load_config.get('torch_dtype', '')).replace('torch.', '')
+    ema = 'ema' if load_config.get('extract_ema', False) else 'noema'
+    return f'{checkpoint_info.model_name}-{source[:16]}-{pipeline.__name__}-{dtype}-{ema}-{diffusers.__version__}'
+
+
+def cached_path(key):
+    folder = os.path.join(cache_dir, key)
+    return folder if os.path.isfile(os.path.join(folder, 'model_index.json')) else None
+
+
+def touch(folder):
+    with open(os.path.join(folder, marker_filename), 'w', encoding='utf8') as f:
+        f.write(str(time.time()))
+
+
+def load(checkpoint_info, pipeline, load_config):
+    """load converted pipeline from cache using regular from_pretrained, returns None if not cached"""
+    if not enabled():
+        return None
+    key = cache_key(checkpoint_info, pipeline, load_config)
+    folder = cached_path(key)
+    if folder is None:
+        return None
+    config = { k: v for k, v in load_config.items() if k not in ['variant', 'extract_ema', 'use_safetensors', 'local_files_only', 'local_files_only ', 'load_connected_pipeline'] }
+    try:
+        t0 = time.time()
+        sd_model = pipeline.from_pretrained(folder, use_safetensors=True, local_files_only=True, **config)
+        touch(folder)
+        shared.log.info(f'Diffusers cache: load={checkpoint_info.filename} cached="{folder}" time={time.time() - t0:.2f}s')
+        return sd_model
+    except Exception as e:
+        shared.log.warning(f'Diffusers cache: load failed, removing entry: {folder} {e}')
+        shutil.rmtree(folder, ignore_errors=True)
+        return None
+
+
+def save(checkpoint_info, pipeline, load_config, sd_model):
+    """save converted pipeline in diffusers layout; pipelines loaded with custom vae are not cached since vae would be stored with them"""
+    if not enabled() or sd_model is None or load_config.get('vae', None) is not None:
+        return
+    key = cache_key(checkpoint_info, pipeline, load_config)
+    if cached_path(key) is not None:
+        return
+    folder = os.path.join(cache_dir, key)
+    tmp = f'{folder}.tmp'
+    try:
+        t0 = time.time()
+        shutil.rmtree(tmp, ignore_errors=True)
+        sd_model.save_pretrained(tmp, safe_serialization=True)
+        os.replace(tmp, folder)
+        touch(folder)
+        shared.log.info(f'Diffusers cache: save={checkpoint_info.filename} cached="{folder}" size={folder_size(folder) / 1024 / 1024 / 1024:.2f} GB time={time.time() - t0:.2f}s')
+    except Exception as e:
+        shared.log.warning(f'Diffusers cache: save failed: {checkpoint_info.filename} {e}')
+        shutil.rmtree(tmp, ignore_errors=True)
+        return
+    evict(keep=folder)
+
+
+def folder_size(folder):
+    total = 0
+    for root, _dirs, files in os.walk(folder):
+        for f in files:
+            try:
+                total += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return total
+
+
+def last_used(folder):
+    try:
+        return os.path.getmtime(os.path.join(folder, marker_filename))
+    except OSError:
+        return 0
+
+
+def evict(keep=None):
+    """remove least recently used entries until cache fits configured size"""
+    if not os.path.isdir(cache_dir):
+        return
+    limit = shared.opts.diffusers_pipeline_cache * 1024 * 1024 * 1024
+    entries = [os.path.join(cache_dir, f) for f in os.listdir(cache_dir) if os.path.isdir(os.path.join(cache_dir, f))]
+    for tmp in [e for e in entries if e.endswith('.tmp') and e != f'{keep}.tmp']: # leftovers from interrupted saves
+        shutil.rmtree(tmp, ignore_errors=True)
+    entries = sorted([e for e in entries if not e.endswith('.tmp')], key=last_used)
+    sizes = { e: folder_size(e) for e in entries }
+    total = sum(sizes.values())
+    for entry in entries:
+        if total <= limit:
+            break
+        if entry == keep:
+            continue
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= sizes[entry]
+        shared.log.info(f'Diffusers cache: evict="{entry}" size={sizes[entry] / 1024 / 1024 / 1024:.2f} GB')
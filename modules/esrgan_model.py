@@ -150,6 +150,13 @@ class UpscalerESRGAN(Upscaler):
         img = esrgan_upscale(model, img)
         return img
 
+    def do_upscale_batch(self, imgs, selected_model):
+        model = self.load_model(selected_model)
+        if model is None:
+            return imgs
+        model.to(devices.device_esrgan)
+        return esrgan_upscale_batch(model, imgs)
+
     def load_model(self, path: str):
         if "http" in path:
             filename = load_file_from_url(
@@ -194,39 +201,43 @@ class UpscalerESRGAN(Upscaler):
 
 
 def upscale_without_tiling(model, img):
-    img = np.array(img)
-    img = img[:, :, ::-1]
-    img = np.ascontiguousarray(np.transpose(img, (2, 0, 1))) / 255
-    img = torch.from_numpy(img).float()
-    img = img.unsqueeze(0).to(devices.device_esrgan)
+    return upscale_batch_without_tiling(model, [img])[0]
+
+
+def upscale_batch_without_tiling(model, imgs):
+    batch = np.stack([np.array(img)[:, :, ::-1] for img in imgs])
+    batch = np.ascontiguousarray(np.transpose(batch, (0, 3, 1, 2))) / 255
+    batch = torch.from_numpy(batch).float().to(devices.device_esrgan)
     with torch.no_grad():
-        output = model(img)
-    output = output.squeeze().float().cpu().clamp_(0, 1).numpy()
-    output = 255. * np.moveaxis(output, 0, 2)
+        output = model(batch)
+    output = output.float().cpu().clamp_(0, 1).numpy()
+    output = 255. * np.moveaxis(output, 1, 3)
     output = output.astype(np.uint8)
-    output = output[:, :, ::-1]
-    return Image.fromarray(output, 'RGB')
+    output = output[:, :, :, ::-1]
+    return [Image.fromarray(np.ascontiguousarray(o), 'RGB') for o in output]
 
 
 def esrgan_upscale(model, img):
-    if opts.ESRGAN_tile == 0:
-        return upscale_without_tiling(model, img)
-
-    grid = images.split_grid(img, opts.ESRGAN_tile, opts.ESRGAN_tile, opts.ESRGAN_tile_overlap)
-    newtiles = []
-    scale_factor = 1
+    return esrgan_upscale_batch(model, [img])[0]
 
-    for y, h, row in grid.tiles:
-        newrow = []
-        for tiledata in row:
-            x, w, tile = tiledata
 
-            output = upscale_without_tiling(model, tile)
-            scale_factor = output.width // tile.width
+def esrgan_upscale_batch(model, imgs):
+    """images of same size share tile layout so tiles at same position are upscaled together"""
+    if opts.ESRGAN_tile == 0:
+        return upscale_batch_without_tiling(model, imgs)
 
-            newrow.append([x * scale_factor, w * scale_factor, output])
-        newtiles.append([y * scale_factor, h * scale_factor, newrow])
+    grids = [images.split_grid(img, opts.ESRGAN_tile, opts.ESRGAN_tile, opts.ESRGAN_tile_overlap) for img in imgs]
+    newtiles = [[] for _ in grids]
+    scale_factor = 1
 
-    newgrid = images.Grid(newtiles, grid.tile_w * scale_factor, grid.tile_h * scale_factor, grid.image_w * scale_factor, grid.image_h * scale_factor, grid.overlap * scale_factor)
-    output = images.combine_grid(newgrid)
-    return output
+    for r, (y, h, row) in enumerate(grids[0].tiles):
+        newrows = [[] for _ in grids]
+        for c, (x, w, tile) in enumerate(row):
+            outputs = upscale_batch_without_tiling(model, [grid.tiles[r][2][c][2] for grid in grids])
+            scale_factor = outputs[0].width // tile.width
+            for newrow, output in zip(newrows, outputs):
+                newrow.append([x * scale_factor, w * scale_factor, output])
+        for newtile, newrow in zip(newtiles, newrows):
+            newtile.append([y * scale_factor, h * scale_factor, newrow])
+
+    return [images.combine_grid(images.Grid(newtile, grid.tile_w * scale_factor, grid.tile_h * scale_factor, grid.image_w * scale_factor, grid.image_h * scale_factor, grid.overlap * scale_factor)) for newtile, grid in zip(newtiles, grids)]
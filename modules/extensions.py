@@ -1,7 +1,8 @@
 import os
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import git
-from modules import shared, errors
+from modules import shared, errors, hashes
 from modules.paths_internal import extensions_dir, extensions_builtin_dir
 
 
@@ -19,6 +20,18 @@ def active():
         return [x for x in extensions if x.enabled]
 
 
+cache_fields = ['git_name', 'status', 'commit_hash', 'commit_date', 'version', 'description', 'branch', 'remote'] # extension info persisted in cache keyed by git metadata mtime
+cache_dirty = False
+
+
+def save_info_cache():
+    """persist extension info read since last save, called once after a batch of extensions is read"""
+    global cache_dirty # pylint: disable=global-statement
+    if cache_dirty:
+        cache_dirty = False
+        hashes.dump_cache()
+
+
 class Extension:
     def __init__(self, name, path, enabled=True, is_builtin=False):
         self.name = name
@@ -38,6 +51,27 @@ class Extension:
         self.mtime = 0
         self.ctime = 0
 
+    def git_mtime(self):
+        """latest modification time of git metadata files that change when repository head or remote changes"""
+        gitdir = os.path.join(self.path, ".git")
+        files = [os.path.join(gitdir, f) for f in ['HEAD', 'index', 'packed-refs', 'config']]
+        return max([os.path.getmtime(f) for f in files if os.path.isfile(f)], default=0)
+
+    def read_info_from_cache(self):
+        cached = hashes.cache("extensions").get(self.path, None)
+        if cached is None or cached.get('git_mtime', None) != self.git_mtime():
+            return False
+        for k in cache_fields:
+            setattr(self, k, cached.get(k, getattr(self, k)))
+        return True
+
+    def write_info_to_cache(self):
+        entry = {k: getattr(self, k) for k in cache_fields}
+        entry['git_mtime'] = self.git_mtime()
+        global cache_dirty # pylint: disable=global-statement
+        hashes.cache("extensions")[self.path] = entry
+        cache_dirty = True
+
     def read_info_from_repo(self):
         if self.have_info_from_repo:
             return
@@ -45,6 +79,8 @@ class Extension:
         repo = None
         self.mtime = datetime.fromtimestamp(os.path.getmtime(self.path)).isoformat() + 'Z'
         self.ctime = datetime.fromtimestamp(os.path.getctime(self.path)).isoformat() + 'Z'
+        if self.read_info_from_cache():
+            return
         try:
             if os.path.exists(os.path.join(self.path, ".git")):
                 repo = git.Repo(self.path)
@@ -70,6 +106,7 @@ class Extension:
             except Exception as ex:
                 shared.log.error(f"Failed reading extension data from Git repository: {self.name}: {ex}")
                 self.remote = None
+        self.write_info_to_cache()
 
     def list_files(self, subdir, extension):
         from modules import scripts
@@ -144,3 +181,14 @@ def list_extensions():
     for dirname, path, is_builtin in extension_paths:
         extension = Extension(name=dirname, path=path, enabled=dirname not in shared.opts.disabled_extensions, is_builtin=is_builtin)
         extensions.append(extension)
+
+
+def read_info_all():
+    """reads git info for all extensions in parallel, unchanged repositories are served from persisted cache"""
+    pending = [ext for ext in extensions if not ext.have_info_from_repo]
+    if len(pending) == 0:
+        return
+    hashes.cache("extensions") # create cache section before it is accessed from pool
+    with ThreadPoolExecutor(max_workers=min(len(pending), 16)) as executor:
+        list(executor.map(lambda ext: ext.read_info_from_repo(), pending))
+    save_info_cache()
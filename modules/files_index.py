@@ -0,0 +1,309 @@
+import os
+import sys
+import time
+import struct
+import threading
+from modules import shared
+from modules.paths_internal import models_path
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+watch_mask = IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+event_header = struct.Struct('iIII')
+
+poll_interval = 1 # seconds between mtime checks for directories that are not watched
+# inotify only reports changes made by local host, folders on these filesystems are always polled
+network_filesystems = ['nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'ncpfs', 'afs', '9p', 'ceph', 'glusterfs', 'lustre', 'gpfs', 'beegfs', 'davfs', 'fuse.sshfs', 'fuse.glusterfs', 'fuse.cephfs', 'fuse.rclone', 'fuse.s3fs', 'fuse.gcsfuse', 'fuse.juicefs']
+
+preview_extensions = ['.jpg', '.jpeg', '.png', '.webp', '.tiff', '.jp2']
+kinds = {
+    'checkpoints': { 'dirs': lambda: [os.path.join(models_path, 'Stable-diffusion'), shared.opts.ckpt_dir], 'ext': ['.ckpt', '.safetensors'], 'blacklist': ['.vae.ckpt', '.vae.safetensors'] },
+    'loras': { 'dirs': lambda: [shared.cmd_opts.lora_dir], 'ext': ['.pt', '.ckpt', '.safetensors'], 'blacklist': [] },
+    'lycos': { 'dirs': lambda: [shared.cmd_opts.lyco_dir], 'ext': ['.pt', '.ckpt', '.safetensors'], 'blacklist': [] },
+    'embeddings': { 'dirs': lambda: [shared.opts.embeddings_dir], 'ext': ['.png', '.webp', '.jxl', '.avif', '.bin', '.pt', '.safetensors'], 'blacklist': [f'.preview{ext}' for ext in preview_extensions] },
+    'vaes': { 'dirs': lambda: [os.path.join(models_path, 'VAE'), shared.opts.vae_dir, shared.opts.ckpt_dir], 'ext': ['.vae.ckpt', '.vae.pt', '.vae.safetensors', '.ckpt', '.pt', '.safetensors', '.json'], 'blacklist': [] },
+    'previews': { 'dirs': lambda: [models_path, shared.opts.ckpt_dir, shared.opts.vae_dir, shared.opts.embeddings_dir, shared.cmd_opts.lora_dir], 'ext': preview_extensions, 'blacklist': [] },
+}
+
+
+class Inotify:
+    """minimal linux inotify binding using ctypes, raises OSError if not available"""
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.ctypes = ctypes
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+    def add(self, path: str) -> int:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), watch_mask)
+        if wd < 0:
+            raise OSError(self.ctypes.get_errno(), f'inotify_add_watch failed: {path}')
+        return wd
+
+    def remove(self, wd: int):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self):
+        buffer = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset + event_header.size <= len(buffer):
+            wd, mask, _cookie, length = event_header.unpack_from(buffer, offset)
+            offset += event_header.size
+            name = buffer[offset:offset + length].rstrip(b'\0')
+            offset += length
+            yield wd, mask, os.fsdecode(name)
+
+
+def mounts() -> list[tuple[str, str]]:
+    """(mount point, filesystem type) from /proc, longest mount points first"""
+    res = []
+    try:
+        with open('/proc/self/mounts', 'r', encoding='utf8') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 3:
+                    res.append((fields[1].replace('\\040', ' '), fields[2]))
+    except OSError:
+        pass
+    return sorted(res, key=lambda m: len(m[0]), reverse=True)
+
+
+class FilesIndex:
+    """
+    shared in-memory index of model folders
+    - folders are scanned once and then kept current by inotify events where available
+    - folders that cannot be watched or are on network filesystems where inotify misses remote changes fall back to mtime polling rate-limited to poll_interval
+    - only folders that actually changed are rescanned
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.dirs: dict[str, tuple[float, list[str]]] = {} # folder -> (mtime, files)
+        self.dirty = set() # folders with pending events
+        self.watches: dict[int, str] = {} # watch descriptor -> folder
+        self.watched: dict[str, int] = {} # folder -> watch descriptor
+        self.last_poll = {}
+        self.generation = 0 # increments on every change applied to the index
+        self.changed: dict[str, int] = {} # folder -> generation of last change
+        self.notify = None
+        self.thread = None
+        self.scans = 0
+        self.mounts = []
+        self.network = set() # folders on network filesystems
+        if sys.platform.startswith('linux') and shared.opts.data.get('files_index_watch', True):
+            try:
+                self.mounts = mounts()
+                self.notify = Inotify()
+                self.thread = threading.Thread(target=self.watcher, name='files-index', daemon=True)
+                self.thread.start()
+            except Exception as e:
+                shared.log.debug(f'Files index: inotify not available, using polling: {e}')
+                self.notify = None
+
+    def watcher(self):
+        while self.notify is not None:
+            try:
+                events = list(self.notify.read())
+            except OSError as e:
+                shared.log.error(f'Files index: watcher error: {e}')
+                time.sleep(1)
+                continue
+            with self.lock:
+                for wd, mask, name in events:
+                    if mask & IN_Q_OVERFLOW: # lost events so everything is suspect
+                        self.dirty.update(self.dirs.keys())
+                        continue
+                    folder = self.watches.get(wd, None)
+                    if folder is None:
+                        continue
+                    if mask & IN_IGNORED:
+                        self.watches.pop(wd, None)
+                        self.watched.pop(folder, None)
+                    self.dirty.add(folder)
+                    if mask & IN_ISDIR and name:
+                        self.dirty.add(os.path.join(folder, name))
+
+    def is_network(self, folder: str) -> bool:
+        path = os.path.realpath(folder)
+        for mountpoint, fstype in self.mounts:
+            if path == mountpoint or path.startswith(os.path.join(mountpoint, '')):
+                return fstype in network_filesystems
+        return False
+
+    def watch(self, folder: str):
+        if self.notify is None or folder in self.watched or folder in self.network:
+            return
+        if self.is_network(folder):
+            self.network.add(folder)
+            shared.log.debug(f'Files index: network filesystem, using polling: {folder}')
+            return
+        try:
+            wd = self.notify.add(folder)
+            self.watches[wd] = folder
+            self.watched[folder] = wd
+        except OSError as e:
+            shared.log.debug(f'Files index: cannot watch folder, using polling: {folder} {e}')
+
+    def unwatch(self, folder: str):
+        wd = self.watched.pop(folder, None)
+        if wd is not None:
+            self.watches.pop(wd, None)
+            self.notify.remove(wd)
+
+    def scan(self, top: str):
+        """walk a folder tree and (re)index every folder found"""
+        from modules.modelloader import walk
+        for folder, files in walk(top, lambda e, path: shared.log.debug(f"FS walk error: {e} {path}")):
+            try:
+                self.watch(folder) # watch before stat so no event can be missed in between
+                self.dirs[folder] = (os.path.getmtime(folder), [os.path.join(folder, fn) for fn in files])
+                self.dirty.discard(folder)
+                self.scans += 1
+            except Exception as e:
+                shared.log.error(f"Filesystem Error: {e.__class__.__name__}({e})")
+                self.dirs.pop(folder, None)
+
+    def drop(self, top: str):
+        for folder in [d for d in self.dirs if d == top or d.startswith(os.path.join(top, ''))]:
+            self.dirs.pop(folder, None)
+            self.dirty.discard(folder)
+            self.network.discard(folder)
+            self.unwatch(folder)
+
+    def poll(self, top: str):
+        """mark unwatched folders, including all folders on network filesystems, as dirty if their mtime changed"""
+        now = time.time()
+        if self.last_poll.get(top, 0) > now - poll_interval:
+            return
+        self.last_poll[top] = now
+        for folder, (mtime, _files) in list(self.dirs.items()):
+            if folder in self.watched or not (folder == top or folder.startswith(os.path.join(top, ''))):
+                continue
+            try:
+                if not os.path.isdir(folder) or os.path.getmtime(folder) != mtime:
+                    self.dirty.add(folder)
+            except OSError:
+                self.dirty.add(folder)
+
+    def mark_changed(self, folder: str):
+        self.generation += 1
+        self.changed[folder] = self.generation
+
+    def refresh(self, top: str):
+        if top not in self.dirs and os.path.isdir(top):
+            self.scan(top)
+            self.mark_changed(top)
+            return
+        self.poll(top)
+        for folder in sorted([d for d in self.dirty if d == top or d.startswith(os.path.join(top, ''))]):
+            if folder not in self.dirty:
+                continue # already rescanned as part of parent
+            if not os.path.isdir(folder):
+                self.drop(folder)
+                self.dirty.discard(folder)
+            else:
+                self.rescan_folder(folder)
+            self.mark_changed(folder)
+
+    def rescan_folder(self, folder: str):
+        """rescan a single folder and walk only subfolders that are new"""
+        files = []
+        subdirs = []
+        try:
+            self.watch(folder)
+            mtime = os.path.getmtime(folder)
+            with os.scandir(folder) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        if not entry.name.startswith('models--'):
+                            subdirs.append(entry.path)
+                    else:
+                        files.append(entry.path)
+        except OSError as e:
+            shared.log.debug(f"FS walk error: {e} {folder}")
+            self.drop(folder)
+            return
+        self.dirs[folder] = (mtime, files)
+        self.dirty.discard(folder)
+        self.scans += 1
+        prefix = os.path.join(folder, '')
+        for known in [d for d in self.dirs if d.startswith(prefix) and os.sep not in d[len(prefix):]]:
+            if known not in subdirs:
+                self.drop(known)
+        for subdir in subdirs:
+            if subdir not in self.dirs:
+                self.scan(subdir)
+
+    def directories(self, top: str, recursive: bool = True) -> dict[str, tuple[float, list[str]]]:
+        top = os.path.abspath(top)
+        with self.lock:
+            self.refresh(top)
+            if not recursive:
+                return { top: self.dirs[top] } if top in self.dirs else {}
+            prefix = os.path.join(top, '')
+            return { d: v for d, v in self.dirs.items() if d == top or d.startswith(prefix) }
+
+    def generation_of(self, top: str) -> int:
+        """generation of the most recent change anywhere under folder, cheap to compare against later"""
+        top = os.path.abspath(top)
+        prefix = os.path.join(top, '')
+        with self.lock:
+            self.refresh(top)
+            return max([0, *[g for d, g in self.changed.items() if d == top or d.startswith(prefix)]])
+
+    def has_changed(self, top: str, generation: int) -> bool:
+        return self.generation_of(top) != generation
+
+    def files(self, *folders: str, recursive: bool = True, ext_filter=None, ext_blacklist=None) -> list[str]:
+        from modules.modelloader import unique_directories, extension_filter
+        res = {}
+        for folder in unique_directories(folders, recursive=recursive):
+            for _mtime, fns in self.directories(folder, recursive=recursive).values():
+                for fn in fns:
+                    res[fn] = True
+        if ext_filter or ext_blacklist:
+            return [*filter(extension_filter(ext_filter, ext_blacklist), res.keys())]
+        return list(res.keys())
+
+    def query(self, kind: str, folders: list[str] = None) -> list[str]:
+        """typed query for known model types, optionally limited to specific folders"""
+        if kind not in kinds:
+            raise ValueError(f'Files index: unknown kind: {kind} available={list(kinds)}')
+        spec = kinds[kind]
+        folders = folders or [d for d in spec['dirs']() if d]
+        return self.files(*folders, ext_filter=spec['ext'], ext_blacklist=spec['blacklist'])
+
+    def stats(self):
+        return { 'folders': len(self.dirs), 'files': sum([len(v[1]) for v in self.dirs.values()]), 'watched': len(self.watched), 'network': len(self.network), 'dirty': len(self.dirty), 'scans': self.scans, 'generation': self.generation, 'mode': 'inotify' if self.notify is not None else 'polling' }
+
+
+index = None
+index_lock = threading.Lock()
+
+
+def get_index() -> FilesIndex:
+    global index # pylint: disable=global-statement
+    with index_lock:
+        if index is None:
+            index = FilesIndex()
+    return index
+
+
+def query(kind: str, folders: list[str] = None) -> list[str]:
+    return get_index().query(kind, folders)
@@ -248,36 +248,36 @@ Steps: 20, Sampler: Euler a, CFG scale: 7, Seed: 965400086, Size: 512x512, Model
     if x is None:
         return {}
     res = {}
-    prompt = ""
-    negative_prompt = ""
+    lines = x.strip().split("\n")
+    params = re_param.findall(lines[-1]) # last line is tokenized once and reused
+    if len(params) < 3:
+        params = []
+    else:
+        lines = lines[:-1]
+    prompt = []
+    negative_prompt = []
     done_with_prompt = False
-    *lines, lastline = x.strip().split("\n")
-    if len(re_param.findall(lastline)) < 3:
-        lines.append(lastline)
-        lastline = ''
     for line in lines:
         line = line.strip()
         if line.startswith("Negative prompt:"):
             done_with_prompt = True
             line = line[16:].strip()
-        if done_with_prompt:
-            negative_prompt += ("" if negative_prompt == "" else "\n") + line
+        target = negative_prompt if done_with_prompt else prompt
+        if len(target) > 0 or line != "": # leading empty lines are skipped
+            target.append(line)
+    res["Prompt"] = "\n".join(prompt)
+    res["Negative prompt"] = "\n".join(negative_prompt)
+    for k, v in params:
+        if len(v) == 0:
+            continue
+        if v[0] == '"' and v[-1] == '"':
+            v = unquote(v)
+        width, sep, height = v.partition('x')
+        if sep and width.isdecimal() and height.isdecimal():
+            res[f"{k}-1"] = width
+            res[f"{k}-2"] = height
         else:
-            prompt += ("" if prompt == "" else "\n") + line
-    res["Prompt"] = prompt
-    res["Negative prompt"] = negative_prompt
-    for k, v in re_param.findall(lastline):
-        try:
-            if v[0] == '"' and v[-1] == '"':
-                v = unquote(v)
-            m = re_imagesize.match(v)
-            if m is not None:
-                res[f"{k}-1"] = m.group(1)
-                res[f"{k}-2"] = m.group(2)
-            else:
-                res[k] = v
-        except Exception:
-            pass
+            res[k] = v
 
     # Missing CLIP skip means it was set to 1 (the default)
     if "Clip skip" not in res:
@@ -314,6 +314,7 @@ infotext_to_setting_name_mapping = [
     ('UniPC lower order final', 'schedulers_use_loworder'),
     ('Token merging ratio', 'token_merging_ratio'),
     ('Token merging ratio hr', 'token_merging_ratio_hr'),
+    ('Token merging schedule', 'token_merging_late_start'),
 ]
 
 
@@ -1,11 +1,13 @@
 import hashlib
 import os.path
+import threading
 from rich import progress
 from modules import shared
 from modules.paths import data_path
 
 cache_filename = os.path.join(data_path, "cache.json")
 cache_data = None
+cache_lock = threading.Lock()
 
 
 def dump_cache():
@@ -14,13 +16,13 @@ def dump_cache():
 
 def cache(subsection):
     global cache_data # pylint: disable=global-statement
-    if cache_data is None:
-        if not os.path.isfile(cache_filename):
-            cache_data = {}
-        else:
-            cache_data = shared.readfile(cache_filename)
-    s = cache_data.get(subsection, {})
-    cache_data[subsection] = s
+    with cache_lock: # sections can be requested from worker threads
+        if cache_data is None:
+            if not os.path.isfile(cache_filename):
+                cache_data = {}
+            else:
+                cache_data = shared.readfile(cache_filename)
+        s = cache_data.setdefault(subsection, {})
     return s
 
 
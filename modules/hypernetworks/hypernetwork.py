@@ -498,6 +498,8 @@ def train_hypernetwork(id_task, hypernetwork_name, learn_rate, batch_size, gradi
 
     save_hypernetwork_every = save_hypernetwork_every or 0
     create_image_every = create_image_every or 0
+    if len(textual_inversion.textual_inversion_templates) == 0: # not yet listed when started with --lazy
+        textual_inversion.list_textual_inversion_templates()
     template_file = textual_inversion.textual_inversion_templates.get(template_filename, None)
     textual_inversion.validate_train_inputs(hypernetwork_name, learn_rate, batch_size, gradient_step, data_root, template_file, template_filename, steps, save_hypernetwork_every, create_image_every, log_directory, name="hypernetwork")
     template_file = template_file.path
@@ -8,7 +8,9 @@ import uuid
 import string
 import hashlib
 import queue
+import struct
 import threading
+import contextvars
 from collections import namedtuple
 import pytz
 import numpy as np
@@ -38,7 +40,7 @@ def check_grid_size(imgs):
     return ok
 
 
-def image_grid(imgs, batch_size=1, rows=None):
+def grid_rows(imgs, batch_size=1, rows=None):
     if rows is None:
         if shared.opts.n_rows > 0:
             rows = shared.opts.n_rows
@@ -53,6 +55,11 @@ def image_grid(imgs, batch_size=1, rows=None):
             rows = round(rows)
     if rows > len(imgs):
         rows = len(imgs)
+    return rows
+
+
+def image_grid(imgs, batch_size=1, rows=None):
+    rows = grid_rows(imgs, batch_size, rows)
     cols = math.ceil(len(imgs) / rows)
     params = script_callbacks.ImageGridLoopParams(imgs, cols, rows)
     script_callbacks.image_grid_callback(params)
@@ -123,77 +130,215 @@ class GridAnnotation:
         self.size = None
 
 
-def draw_grid_annotations(im, width, height, hor_texts, ver_texts, margin=0):
-    def wrap(drawing, text, font, line_length):
-        lines = ['']
-        for word in text.split():
-            line = f'{lines[-1]} {word}'.strip()
-            if drawing.textlength(line, font=font) <= line_length:
-                lines[-1] = line
-            else:
-                lines.append(word)
-        return lines
+def wrap_text(drawing, text, font, line_length):
+    lines = ['']
+    for word in text.split():
+        line = f'{lines[-1]} {word}'.strip()
+        if drawing.textlength(line, font=font) <= line_length:
+            lines[-1] = line
+        else:
+            lines.append(word)
+    return lines
 
-    def get_font(fontsize):
-        try:
-            return ImageFont.truetype(shared.opts.font or 'html/roboto.ttf', fontsize)
-        except Exception:
-            return ImageFont.truetype('html/roboto.ttf', fontsize)
 
-    def draw_texts(drawing: ImageDraw, draw_x, draw_y, lines, initial_fnt, initial_fontsize):
+def get_grid_font(fontsize):
+    try:
+        return ImageFont.truetype(shared.opts.font or 'html/roboto.ttf', fontsize)
+    except Exception:
+        return ImageFont.truetype('html/roboto.ttf', fontsize)
+
+
+class GridAnnotationLayout:
+    """fonts, wrapped texts and paddings of grid annotations computed once so annotations can be drawn on whole grid or on each row strip"""
+    color_active = (0, 0, 0)
+    color_inactive = (153, 153, 153)
+
+    def __init__(self, width, height, hor_texts, ver_texts):
+        self.width = width
+        self.height = height
+        self.hor_texts = hor_texts
+        self.ver_texts = ver_texts
+        self.fontsize = (width + height) // 25
+        self.line_spacing = self.fontsize // 2
+        self.fnt = get_grid_font(self.fontsize)
+        self.pad_left = 0 if sum([sum([len(line.text) for line in lines]) for lines in ver_texts]) == 0 else width * 3 // 4
+        calc_img = Image.new("RGB", (1, 1), "white")
+        calc_d = ImageDraw.Draw(calc_img)
+        for texts, allowed_width in zip(hor_texts + ver_texts, [width] * len(hor_texts) + [self.pad_left] * len(ver_texts)):
+            items = [] + texts
+            texts.clear()
+            for line in items:
+                wrapped = wrap_text(calc_d, line.text, self.fnt, allowed_width)
+                texts += [GridAnnotation(x, line.is_active) for x in wrapped]
+            for line in texts:
+                bbox = calc_d.multiline_textbbox((0, 0), line.text, font=self.fnt)
+                line.size = (bbox[2] - bbox[0], bbox[3] - bbox[1])
+                line.allowed_width = allowed_width
+        self.hor_text_heights = [sum([line.size[1] + self.line_spacing for line in lines]) - self.line_spacing for lines in hor_texts]
+        self.ver_text_heights = [sum([line.size[1] + self.line_spacing for line in lines]) - self.line_spacing * len(lines) for lines in ver_texts]
+        self.pad_top = 0 if sum(self.hor_text_heights) == 0 else max(self.hor_text_heights) + self.line_spacing * 2
+
+    def draw_texts(self, drawing: ImageDraw, draw_x, draw_y, lines):
         for line in lines:
-            fnt = initial_fnt
-            fontsize = initial_fontsize
+            fnt = self.fnt
+            fontsize = self.fontsize
             while drawing.multiline_textsize(line.text, font=fnt)[0] > line.allowed_width and fontsize > 0:
                 fontsize -= 1
-                fnt = get_font(fontsize)
-            drawing.multiline_text((draw_x, draw_y + line.size[1] / 2), line.text, font=fnt, fill=color_active if line.is_active else color_inactive, anchor="mm", align="center")
+                fnt = get_grid_font(fontsize)
+            drawing.multiline_text((draw_x, draw_y + line.size[1] / 2), line.text, font=fnt, fill=self.color_active if line.is_active else self.color_inactive, anchor="mm", align="center")
             if not line.is_active:
-                drawing.line((draw_x - line.size[0] // 2, draw_y + line.size[1] // 2, draw_x + line.size[0] // 2, draw_y + line.size[1] // 2), fill=color_inactive, width=4)
-            draw_y += line.size[1] + line_spacing
+                drawing.line((draw_x - line.size[0] // 2, draw_y + line.size[1] // 2, draw_x + line.size[0] // 2, draw_y + line.size[1] // 2), fill=self.color_inactive, width=4)
+            draw_y += line.size[1] + self.line_spacing
 
-    fontsize = (width + height) // 25
-    line_spacing = fontsize // 2
-    fnt = get_font(fontsize)
-    color_active = (0, 0, 0)
-    color_inactive = (153, 153, 153)
-    pad_left = 0 if sum([sum([len(line.text) for line in lines]) for lines in ver_texts]) == 0 else width * 3 // 4
+    def draw_header(self, drawing: ImageDraw, margin=0):
+        for col in range(len(self.hor_texts)):
+            x = self.pad_left + (self.width + margin) * col + self.width / 2
+            y = self.pad_top / 2 - self.hor_text_heights[col] / 2
+            self.draw_texts(drawing, x, y, self.hor_texts[col])
+
+    def draw_row(self, drawing: ImageDraw, row, top):
+        """top is position of row of cells in drawing"""
+        x = self.pad_left / 2
+        y = top + self.height / 2 - self.ver_text_heights[row] / 2
+        self.draw_texts(drawing, x, y, self.ver_texts[row])
+
+
+def draw_grid_annotations(im, width, height, hor_texts, ver_texts, margin=0):
     cols = im.width // width
     rows = im.height // height
     assert cols == len(hor_texts), f'bad number of horizontal texts: {len(hor_texts)}; must be {cols}'
     assert rows == len(ver_texts), f'bad number of vertical texts: {len(ver_texts)}; must be {rows}'
-    calc_img = Image.new("RGB", (1, 1), "white")
-    calc_d = ImageDraw.Draw(calc_img)
-    for texts, allowed_width in zip(hor_texts + ver_texts, [width] * len(hor_texts) + [pad_left] * len(ver_texts)):
-        items = [] + texts
-        texts.clear()
-        for line in items:
-            wrapped = wrap(calc_d, line.text, fnt, allowed_width)
-            texts += [GridAnnotation(x, line.is_active) for x in wrapped]
-        for line in texts:
-            bbox = calc_d.multiline_textbbox((0, 0), line.text, font=fnt)
-            line.size = (bbox[2] - bbox[0], bbox[3] - bbox[1])
-            line.allowed_width = allowed_width
-    hor_text_heights = [sum([line.size[1] + line_spacing for line in lines]) - line_spacing for lines in hor_texts]
-    ver_text_heights = [sum([line.size[1] + line_spacing for line in lines]) - line_spacing * len(lines) for lines in ver_texts]
-    pad_top = 0 if sum(hor_text_heights) == 0 else max(hor_text_heights) + line_spacing * 2
-    result = Image.new("RGB", (im.width + pad_left + margin * (cols-1), im.height + pad_top + margin * (rows-1)), "white")
+    layout = GridAnnotationLayout(width, height, hor_texts, ver_texts)
+    result = Image.new("RGB", (im.width + layout.pad_left + margin * (cols-1), im.height + layout.pad_top + margin * (rows-1)), "white")
     for row in range(rows):
         for col in range(cols):
             cell = im.crop((width * col, height * row, width * (col+1), height * (row+1)))
-            result.paste(cell, (pad_left + (width + margin) * col, pad_top + (height + margin) * row))
+            result.paste(cell, (layout.pad_left + (width + margin) * col, layout.pad_top + (height + margin) * row))
     d = ImageDraw.Draw(result)
-    for col in range(cols):
-        x = pad_left + (width + margin) * col + width / 2
-        y = pad_top / 2 - hor_text_heights[col] / 2
-        draw_texts(d, x, y, hor_texts[col], fnt, fontsize)
+    layout.draw_header(d, margin)
     for row in range(rows):
-        x = pad_left / 2
-        y = pad_top + (height + margin) * row + height / 2 - ver_text_heights[row] / 2
-        draw_texts(d, x, y, ver_texts[row], fnt, fontsize)
+        layout.draw_row(d, row, layout.pad_top + (height + margin) * row)
     return result
 
 
+class GridStream:
+    """
+    grid that is never composed as one image in memory, it is produced one row strip at a time
+    - each strip holds one row of cells together with its annotation so memory is bounded by single row of cells
+    - saved as png encoded strip by strip, other formats cannot be written incrementally
+    - preview is downscaled from strips so it can be displayed and passed to save_image which writes full grid
+    """
+
+    def __init__(self, imgs, rows=None, hor_texts=None, ver_texts=None, margin=0, batch_size=1):
+        rows = grid_rows(imgs, batch_size, rows)
+        params = script_callbacks.ImageGridLoopParams(list(imgs), math.ceil(len(imgs) / rows), rows) # copy since callers insert preview into their list
+        script_callbacks.image_grid_callback(params)
+        self.imgs, self.cols, self.rows = params.imgs, params.cols, params.rows
+        self.cell_w, self.cell_h = self.imgs[0].size
+        self.layout = GridAnnotationLayout(self.cell_w, self.cell_h, hor_texts, ver_texts) if hor_texts is not None else None
+        self.margin = margin if self.layout is not None else 0
+        self.pad_left = self.layout.pad_left if self.layout is not None else 0
+        self.pad_top = self.layout.pad_top if self.layout is not None else 0
+        self.background = 'white' if self.layout is not None else 'black'
+        self.width = self.pad_left + self.cols * self.cell_w + self.margin * (self.cols - 1)
+        self.height = self.pad_top + self.rows * self.cell_h + self.margin * (self.rows - 1)
+
+    @property
+    def size(self):
+        return (self.width, self.height)
+
+    def strips(self):
+        """yields top position and image of each horizontal strip"""
+        if self.pad_top > 0:
+            strip = Image.new('RGB', (self.width, self.pad_top), self.background)
+            self.layout.draw_header(ImageDraw.Draw(strip), self.margin)
+            yield 0, strip
+        for row in range(self.rows):
+            top = self.pad_top + (self.cell_h + self.margin) * row
+            strip = Image.new('RGB', (self.width, self.cell_h + (self.margin if row < self.rows - 1 else 0)), self.background)
+            for col in range(self.cols):
+                i = row * self.cols + col
+                cell = self.imgs[i] if i < len(self.imgs) else Image.new('RGB', (self.cell_w, self.cell_h), 'black')
+                strip.paste(cell, (self.pad_left + (self.cell_w + self.margin) * col, 0))
+            if self.layout is not None:
+                self.layout.draw_row(ImageDraw.Draw(strip), row, 0)
+            yield top, strip
+
+    def preview(self, max_pixels=None):
+        """downscaled grid used for display, full grid is written when preview is saved"""
+        max_pixels = max_pixels or min(shared.opts.img_max_size_mp, 16) * 1000000
+        scale = min(1, math.sqrt(max_pixels / (self.width * self.height)))
+        res = Image.new('RGB', (max(1, round(self.width * scale)), max(1, round(self.height * scale))), self.background)
+        for top, strip in self.strips():
+            y0, y1 = round(top * scale), round((top + strip.height) * scale)
+            if y1 > y0:
+                res.paste(strip.resize((res.width, y1 - y0), resample=Image.LANCZOS), (0, y0))
+        res.grid_stream = self
+        return res
+
+    def save(self, filename, pnginfo=None):
+        """png written strip by strip: rows use sub filter and are compressed incrementally"""
+        import zlib
+
+        def chunk(f, name, data):
+            f.write(struct.pack('>I', len(data)) + name + data + struct.pack('>I', zlib.crc32(name + data) & 0xFFFFFFFF))
+
+        with open(filename, 'wb') as f:
+            f.write(b'\x89PNG\r\n\x1a\n')
+            chunk(f, b'IHDR', struct.pack('>IIBBBBB', self.width, self.height, 8, 2, 0, 0, 0))
+            for k, v in (pnginfo or {}).items():
+                try:
+                    chunk(f, b'tEXt', k.encode('latin-1') + b'\x00' + str(v).encode('latin-1'))
+                except UnicodeEncodeError:
+                    chunk(f, b'iTXt', k.encode('latin-1') + b'\x00\x00\x00\x00\x00' + str(v).encode('utf-8'))
+            compressor = zlib.compressobj(6)
+            for _top, strip in self.strips():
+                data = np.asarray(strip, dtype=np.uint8)
+                filtered = data.copy()
+                filtered[:, 1:] -= data[:, :-1] # sub filter, wraps around as png expects
+                rows = np.concatenate([np.ones((data.shape[0], 1), dtype=np.uint8), filtered.reshape(data.shape[0], -1)], axis=1)
+                compressed = compressor.compress(rows.tobytes())
+                if len(compressed) > 0:
+                    chunk(f, b'IDAT', compressed)
+            chunk(f, b'IDAT', compressor.flush())
+            chunk(f, b'IEND', b'')
+        shared.log.debug(f'Saving grid: streamed png {filename} {self.size} strips={self.rows}')
+
+
+class GridStreamColumns(GridStream):
+    """
+    streamed grids of same layout placed side by side with optional column titles
+    - each strip is joined from matching strips of all grids so none of the grids is composed in memory
+    """
+
+    def __init__(self, streams, hor_texts=None): # pylint: disable=super-init-not-called
+        self.streams = streams
+        self.cols, self.rows = len(streams), streams[0].rows
+        self.cell_w, self.cell_h = streams[0].size
+        self.layout = GridAnnotationLayout(self.cell_w, self.cell_h, hor_texts, [[GridAnnotation()]]) if hor_texts is not None else None
+        self.margin = 0
+        self.pad_left = 0
+        self.pad_top = self.layout.pad_top if self.layout is not None else 0
+        self.background = 'white' if self.layout is not None else 'black'
+        self.width = self.cols * self.cell_w
+        self.height = self.pad_top + self.cell_h
+
+    @staticmethod
+    def compatible(streams):
+        return all(s.size == streams[0].size and (s.rows, s.pad_top, s.margin) == (streams[0].rows, streams[0].pad_top, streams[0].margin) for s in streams)
+
+    def strips(self):
+        if self.pad_top > 0:
+            strip = Image.new('RGB', (self.width, self.pad_top), self.background)
+            self.layout.draw_header(ImageDraw.Draw(strip), self.margin)
+            yield 0, strip
+        for parts in zip(*[s.strips() for s in self.streams]):
+            strip = Image.new('RGB', (self.width, parts[0][1].height), self.background)
+            for col, (_top, part) in enumerate(parts):
+                strip.paste(part, (self.cell_w * col, 0))
+            yield self.pad_top + parts[0][0], strip
+
+
 def draw_prompt_matrix(im, width, height, all_prompts, margin=0):
     prompts = all_prompts[1:]
     boundary = math.ceil(len(prompts) / 2)
@@ -436,63 +581,76 @@ def get_next_sequence_number(path, basename):
 def atomically_save_image():
     Image.MAX_IMAGE_PIXELS = None # disable check in Pillow and rely on check below to allow large custom image sizes
     while True:
-        image, filename, extension, params, exifinfo, txt_fullfn = save_queue.get()
-        fn = filename + extension
-        filename = filename.strip()
-        if extension[0] != '.': # add dot if missing
-            extension = '.' + extension
-        try:
-            image_format = Image.registered_extensions()[extension]
-        except Exception:
-            shared.log.warning(f'Unknown image format: {extension}')
-            image_format = 'JPEG'
-        if shared.opts.image_watermark_enabled:
-            image = set_watermark(image, shared.opts.image_watermark)
-        shared.log.debug(f'Saving image: {image_format} {fn} {image.size}')
-        # actual save
-        exifinfo = (exifinfo or "") if shared.opts.image_metadata else ""
-        if image_format == 'PNG':
-            pnginfo_data = PngImagePlugin.PngInfo()
-            for k, v in params.pnginfo.items():
-                pnginfo_data.add_text(k, str(v))
-            image.save(fn, format=image_format, quality=shared.opts.jpeg_quality, pnginfo=pnginfo_data if shared.opts.image_metadata else None)
-        elif image_format == 'JPEG':
-            if image.mode == 'RGBA':
-                shared.log.warning('Saving RGBA image as JPEG: Alpha channel will be lost')
-                image = image.convert("RGB")
-            elif image.mode == 'I;16':
-                image = image.point(lambda p: p * 0.0038910505836576).convert("L")
-            exif_bytes = piexif.dump({ "Exif": { piexif.ExifIFD.UserComment: piexif.helper.UserComment.dump(exifinfo, encoding="unicode") } })
-            image.save(fn, format=image_format, quality=shared.opts.jpeg_quality, exif=exif_bytes)
-        elif image_format == 'WEBP':
-            if image.mode == 'I;16':
-                image = image.point(lambda p: p * 0.0038910505836576).convert("RGB")
-            exif_bytes = piexif.dump({ "Exif": { piexif.ExifIFD.UserComment: piexif.helper.UserComment.dump(exifinfo, encoding="unicode") } })
-            try:
-                image.save(fn, format=image_format, quality=shared.opts.jpeg_quality, lossless=shared.opts.webp_lossless, exif=exif_bytes)
-            except Exception as e:
-                shared.log.warning(f'Image save failed: {fn} {e}')
-        else:
-            # shared.log.warning(f'Unrecognized image format: {extension} attempting save as {image_format}')
-            try:
-                image.save(fn, format=image_format, quality=shared.opts.jpeg_quality)
-            except Exception as e:
-                shared.log.warning(f'Image save failed: {fn} {e}')
-        # additional metadata saved in files
-        if shared.opts.save_txt and len(exifinfo) > 0:
-            try:
-                with open(txt_fullfn, "w", encoding="utf8") as file:
-                    file.write(f"{exifinfo}\n")
-            except Exception as e:
-                shared.log.warning(f'Image description save failed: {txt_fullfn} {e}')
-        with open(os.path.join(paths.data_path, "params.txt"), "w", encoding="utf8") as file:
-            file.write(exifinfo)
-        if shared.opts.save_log_fn != '' and len(exifinfo) > 0:
-            entry = { 'filename': filename, 'time': datetime.datetime.now().isoformat(), 'info': exifinfo }
-            shared.writefile(entry, os.path.join(paths.data_path, shared.opts.save_log_fn), mode='a+')
+        context, item = save_queue.get()
+        context.run(write_image, *item) # context of caller so per-job settings overlay applies to save options
         save_queue.task_done()
 
 
+def write_image(image, filename, extension, params, exifinfo, txt_fullfn):
+    fn = filename + extension
+    filename = filename.strip()
+    if extension[0] != '.': # add dot if missing
+        extension = '.' + extension
+    try:
+        image_format = Image.registered_extensions()[extension]
+    except Exception:
+        shared.log.warning(f'Unknown image format: {extension}')
+        image_format = 'JPEG'
+    grid_stream = getattr(image, 'grid_stream', None)
+    if shared.opts.image_watermark_enabled and grid_stream is None:
+        image = set_watermark(image, shared.opts.image_watermark)
+    shared.log.debug(f'Saving image: {image_format} {fn} {image.size}')
+    # actual save
+    exifinfo = (exifinfo or "") if shared.opts.image_metadata else ""
+    if grid_stream is not None:
+        try:
+            grid_stream.save(fn, params.pnginfo if shared.opts.image_metadata else None)
+        except Exception as e:
+            shared.log.warning(f'Image save failed: {fn} {e}')
+    elif image_format == 'PNG':
+        pnginfo_data = PngImagePlugin.PngInfo()
+        for k, v in params.pnginfo.items():
+            pnginfo_data.add_text(k, str(v))
+        image.save(fn, format=image_format, quality=shared.opts.jpeg_quality, pnginfo=pnginfo_data if shared.opts.image_metadata else None)
+    elif image_format == 'JPEG':
+        if image.mode == 'RGBA':
+            shared.log.warning('Saving RGBA image as JPEG: Alpha channel will be lost')
+            image = image.convert("RGB")
+        elif image.mode == 'I;16':
+            image = image.point(lambda p: p * 0.0038910505836576).convert("L")
+        exif_bytes = piexif.dump({ "Exif": { piexif.ExifIFD.UserComment: piexif.helper.UserComment.dump(exifinfo, encoding="unicode") } })
+        image.save(fn, format=image_format, quality=shared.opts.jpeg_quality, exif=exif_bytes)
+    elif image_format == 'WEBP':
+        if image.mode == 'I;16':
+            image = image.point(lambda p: p * 0.0038910505836576).convert("RGB")
+        exif_bytes = piexif.dump({ "Exif": { piexif.ExifIFD.UserComment: piexif.helper.UserComment.dump(exifinfo, encoding="unicode") } })
+        try:
+            image.save(fn, format=image_format, quality=shared.opts.jpeg_quality, lossless=shared.opts.webp_lossless, exif=exif_bytes)
+        except Exception as e:
+            shared.log.warning(f'Image save failed: {fn} {e}')
+    else:
+        # shared.log.warning(f'Unrecognized image format: {extension} attempting save as {image_format}')
+        try:
+            image.save(fn, format=image_format, quality=shared.opts.jpeg_quality)
+        except Exception as e:
+            shared.log.warning(f'Image save failed: {fn} {e}')
+    # additional metadata saved in files
+    if shared.opts.save_txt and len(exifinfo) > 0:
+        try:
+            with open(txt_fullfn, "w", encoding="utf8") as file:
+                file.write(f"{exifinfo}\n")
+        except Exception as e:
+            shared.log.warning(f'Image description save failed: {txt_fullfn} {e}')
+    with open(os.path.join(paths.data_path, "params.txt"), "w", encoding="utf8") as file:
+        file.write(exifinfo)
+    if shared.opts.image_catalogue and os.path.isfile(fn):
+        from modules import catalogue
+        catalogue.add(fn, exifinfo, grid_stream.size if grid_stream is not None else image.size)
+    if shared.opts.save_log_fn != '' and len(exifinfo) > 0:
+        entry = { 'filename': filename, 'time': datetime.datetime.now().isoformat(), 'info': exifinfo }
+        shared.writefile(entry, os.path.join(paths.data_path, shared.opts.save_log_fn), mode='a+')
+
+
 save_queue = queue.Queue()
 save_thread = threading.Thread(target=atomically_save_image, daemon=True)
 save_thread.start()
@@ -536,6 +694,8 @@ def save_image(image, path, basename, seed=None, prompt=None, extension='jpg', i
         return None, None
     if path is None or len(path) == 0: # set default path to avoid errors when functions are triggered manually or via api and param is not set
         path = shared.opts.outdir_save
+    if getattr(image, 'grid_stream', None) is not None:
+        extension = 'png' # only format that can be written strip by strip
     namegen = FilenameGenerator(p, seed, prompt, image)
     if save_to_dirs is None:
         save_to_dirs = (grid and shared.opts.grid_save_to_dirs) or (not grid and shared.opts.save_to_dirs and not no_prompt)
@@ -588,9 +748,9 @@ def save_image(image, path, basename, seed=None, prompt=None, extension='jpg', i
         params.filename = filename + extension
     txt_fullfn = f"{filename}.txt" if shared.opts.save_txt and len(exifinfo) > 0 else None
 
-    save_queue.put((params.image, filename, extension, params, exifinfo, txt_fullfn)) # actual save is executed in a thread that polls data from queue
+    save_queue.put((contextvars.copy_context(), (params.image, filename, extension, params, exifinfo, txt_fullfn))) # actual save is executed in a thread that polls data from queue
     save_queue.join()
-    # atomically_save_image(params.image, filename, extension, params, exifinfo, txt_fullfn)
+    # write_image(params.image, filename, extension, params, exifinfo, txt_fullfn)
 
     params.image.already_saved_as = params.filename
     script_callbacks.image_saved_callback(params)
@@ -614,8 +774,34 @@ def safe_decode_string(s: bytes):
     return None
 
 
-def read_info_from_image(image):
-    items = image.info or {}
+def parse_exif(exif_data, items):
+    """adds known exif tags to items, returns generation parameters stored in usercomment if any"""
+    geninfo = None
+    try:
+        exif = piexif.load(exif_data)
+    except Exception as e:
+        shared.log.error(f'Error loading EXIF data: {e}')
+        exif = {}
+    for _key, subkey in exif.items():
+        if isinstance(subkey, dict):
+            for key, val in subkey.items():
+                if isinstance(val, bytes): # decode bytestring
+                    val = safe_decode_string(val)
+                if isinstance(val, tuple) and isinstance(val[0], int) and isinstance(val[1], int): # convert camera ratios
+                    val = round(val[0] / val[1], 2)
+                if val is not None and key in ExifTags.TAGS: # add known tags
+                    if ExifTags.TAGS[key] == 'UserComment': # add geninfo from UserComment
+                        geninfo = val
+                        items['parameters'] = val
+                    else:
+                        items[ExifTags.TAGS[key]] = val
+                elif val is not None and key in ExifTags.GPSTAGS:
+                    items[ExifTags.GPSTAGS[key]] = val
+    return geninfo
+
+
+def parse_info(items, size, image=None):
+    """generation parameters and cleaned up metadata from raw image info, image is only needed for watermark detection"""
     geninfo = items.pop('parameters', None)
     if geninfo is None:
         geninfo = items.pop('UserComment', None)
@@ -625,30 +811,12 @@ def read_info_from_image(image):
         items['UserComment'] = geninfo
 
     if "exif" in items:
-        try:
-            exif = piexif.load(items["exif"])
-        except Exception as e:
-            shared.log.error(f'Error loading EXIF data: {e}')
-            exif = {}
-        for _key, subkey in exif.items():
-            if isinstance(subkey, dict):
-                for key, val in subkey.items():
-                    if isinstance(val, bytes): # decode bytestring
-                        val = safe_decode_string(val)
-                    if isinstance(val, tuple) and isinstance(val[0], int) and isinstance(val[1], int): # convert camera ratios
-                        val = round(val[0] / val[1], 2)
-                    if val is not None and key in ExifTags.TAGS: # add known tags
-                        if ExifTags.TAGS[key] == 'UserComment': # add geninfo from UserComment
-                            geninfo = val
-                            items['parameters'] = val
-                        else:
-                            items[ExifTags.TAGS[key]] = val
-                    elif val is not None and key in ExifTags.GPSTAGS:
-                        items[ExifTags.GPSTAGS[key]] = val
-    wm = get_watermark(image)
-    if wm != '':
-        # geninfo += f' Watermark: {wm}'
-        items['watermark'] = wm
+        geninfo = parse_exif(items["exif"], items) or geninfo
+    if image is not None:
+        wm = get_watermark(image)
+        if wm != '':
+            # geninfo += f' Watermark: {wm}'
+            items['watermark'] = wm
 
     for key, val in items.items():
         if isinstance(val, bytes): # decode bytestring
@@ -663,12 +831,134 @@ def read_info_from_image(image):
             sampler = sd_samplers.samplers_map.get(json_info["sampler"], "Euler a")
             geninfo = f"""{items["Description"]}
 Negative prompt: {json_info["uc"]}
-Steps: {json_info["steps"]}, Sampler: {sampler}, CFG scale: {json_info["scale"]}, Seed: {json_info["seed"]}, Size: {image.width}x{image.height}, Clip skip: 2, ENSD: 31337"""
+Steps: {json_info["steps"]}, Sampler: {sampler}, CFG scale: {json_info["scale"]}, Seed: {json_info["seed"]}, Size: {size[0]}x{size[1]}, Clip skip: 2, ENSD: 31337"""
         except Exception as e:
             errors.display(e, 'novelai image parser')
     return geninfo, items
 
 
+def read_info_from_image(image, watermark=True):
+    """watermark detection decodes full image so it can be skipped when only generation parameters are needed"""
+    return parse_info(image.info or {}, image.size, image if watermark else None)
+
+
+def read_png_chunks(f, items):
+    """text and exif chunks, image data chunks are skipped without reading"""
+    import zlib
+    size = None
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        length, chunk = struct.unpack('>I4s', header)
+        if chunk == b'IHDR':
+            data = f.read(length)
+            size = struct.unpack('>II', data[:8])
+        elif chunk in [b'tEXt', b'zTXt', b'iTXt', b'eXIf']:
+            data = f.read(length)
+            key, _sep, value = data.partition(b'\x00')
+            key = key.decode('latin-1')
+            if chunk == b'eXIf':
+                items['exif'] = b'Exif\x00\x00' + data
+            elif chunk == b'tEXt':
+                items[key] = value.decode('latin-1')
+            elif chunk == b'zTXt':
+                items[key] = zlib.decompress(value[1:]).decode('latin-1')
+            else:
+                compressed, value = value[0], value[2:]
+                _lang, _sep, value = value.partition(b'\x00')
+                _translated, _sep, value = value.partition(b'\x00')
+                items[key] = (zlib.decompress(value) if compressed else value).decode('utf-8')
+        elif chunk == b'IEND':
+            break
+        else:
+            f.seek(length, os.SEEK_CUR)
+        f.seek(4, os.SEEK_CUR) # crc
+    return size
+
+
+def read_jpeg_segments(f, items):
+    """exif and comment segments, stops at start of scan so compressed image data is never read"""
+    size = None
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            break
+        if marker[1] in [0xD8, 0x01] or 0xD0 <= marker[1] <= 0xD7:
+            continue
+        if marker[1] in [0xDA, 0xD9]:
+            break
+        length = struct.unpack('>H', f.read(2))[0]
+        if marker[1] == 0xE1 or marker[1] == 0xFE or (0xC0 <= marker[1] <= 0xCF and marker[1] not in [0xC4, 0xC8, 0xCC]):
+            data = f.read(length - 2)
+            if marker[1] == 0xE1 and data.startswith(b'Exif\x00\x00'):
+                items['exif'] = data
+            elif marker[1] == 0xFE:
+                items['comment'] = data
+            elif marker[1] not in [0xE1, 0xFE]: # start of frame
+                height, width = struct.unpack('>HH', data[1:5])
+                size = (width, height)
+        else:
+            f.seek(length - 2, os.SEEK_CUR)
+    return size
+
+
+def read_webp_chunks(f, items):
+    size = None
+    f.seek(12)
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        chunk, length = struct.unpack('<4sI', header)
+        if chunk in [b'EXIF', b'VP8X']:
+            data = f.read(length)
+            if chunk == b'EXIF':
+                items['exif'] = data if data.startswith(b'Exif') else b'Exif\x00\x00' + data
+            else:
+                size = (1 + int.from_bytes(data[4:7], 'little'), 1 + int.from_bytes(data[7:10], 'little'))
+        else:
+            f.seek(length, os.SEEK_CUR)
+        if length % 2 == 1:
+            f.seek(1, os.SEEK_CUR)
+    return size
+
+
+def read_info_from_file(source):
+    """
+    generation parameters and metadata read directly from png text chunks, jpeg exif segment or webp exif chunk without decoding image
+    source can be filename, bytes or file object, returns geninfo, items and image size if known from headers
+    other formats are opened lazily using pil
+    """
+    if isinstance(source, (bytes, bytearray)):
+        f = io.BytesIO(source)
+    elif isinstance(source, str):
+        f = open(source, 'rb') # pylint: disable=consider-using-with
+    else:
+        f = source
+    items = {}
+    try:
+        magic = f.read(12)
+        if magic.startswith(b'\x89PNG\r\n\x1a\n'):
+            f.seek(8)
+            size = read_png_chunks(f, items)
+        elif magic.startswith(b'\xff\xd8'):
+            f.seek(0)
+            size = read_jpeg_segments(f, items)
+        elif magic.startswith(b'RIFF') and magic[8:12] == b'WEBP':
+            size = read_webp_chunks(f, items)
+        else:
+            f.seek(0)
+            with Image.open(f) as image:
+                items = dict(image.info)
+                size = image.size
+    finally:
+        if isinstance(source, str):
+            f.close()
+    geninfo, items = parse_info(items, size or (0, 0))
+    return geninfo, items, size
+
+
 def image_data(data):
     import gradio as gr
     if data is None:
@@ -1,4 +1,9 @@
 import os
+import time
+import itertools
+import contextvars
+from collections import deque, Counter
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from PIL import Image, ImageOps, ImageFilter, ImageEnhance, ImageChops, UnidentifiedImageError
 import modules.scripts
@@ -8,6 +13,63 @@ from modules.ui import plaintext_to_html
 from modules.memstats import memory_stats
 
 
+def load_batch_image(image_file, mask_file, masks):
+    """decode image and its mask in loader thread, masks shared by several files are decoded once"""
+    try:
+        img = Image.open(image_file)
+        img = ImageOps.exif_transpose(img)
+        img.load()
+    except (UnidentifiedImageError, OSError) as e:
+        shared.log.error(f"Image error: {e}")
+        return None
+    if mask_file is None:
+        return img, None, None
+    if masks.get(mask_file, None) is not None:
+        return img, masks[mask_file], mask_file
+    mask = Image.open(mask_file)
+    mask.load()
+    if mask_file in masks:
+        masks[mask_file] = mask
+    return img, mask, mask_file
+
+
+def prefetch_batch_images(image_files, mask_files, count):
+    """yields (image_file, (image, mask, mask_file) or None) in input order while next files are decoded in background"""
+    masks = { f: None for f, n in Counter(mask_files).items() if f is not None and n > 1 }
+    with ThreadPoolExecutor(max_workers=max(1, min(count, os.cpu_count() or 4))) as executor:
+        files = iter(zip(image_files, mask_files))
+        pending = deque((f, executor.submit(load_batch_image, f, m, masks)) for f, m in itertools.islice(files, count))
+        while len(pending) > 0:
+            image_file, future = pending.popleft()
+            for f, m in itertools.islice(files, 1):
+                pending.append((f, executor.submit(load_batch_image, f, m, masks)))
+            yield image_file, future.result()
+
+
+def group_batch_images(loaded, pack, max_batch):
+    """consecutive files with same size, mode and mask are packed into one batch"""
+    group, group_key = [], None
+    for image_file, item in loaded:
+        if item is None:
+            continue
+        img, mask, mask_file = item
+        key = (img.size, img.mode, mask_file)
+        if len(group) > 0 and (not pack or key != group_key or len(group) >= max_batch):
+            yield group
+            group = []
+        group.append((image_file, img, mask))
+        group_key = key
+    if len(group) > 0:
+        yield group
+
+
+def save_batch_image(image, output_dir, basename, ext):
+    geninfo, items = images.read_info_from_image(image, watermark=False)
+    for k, v in items.items():
+        image.info[k] = v
+    images.save_image(image, path=output_dir, basename=basename, seed=None, prompt=None, extension=ext, info=geninfo, short_filename=True, no_prompt=True, grid=False, pnginfo_section_name="extras", existing_info=image.info, forced_filename=None)
+
+
 def process_batch(p, input_files, input_dir, output_dir, inpaint_mask_dir, args):
     shared.log.debug(f'batch: {input_dir}|{output_dir}|{inpaint_mask_dir}')
     processing.fix_seed(p)
@@ -24,54 +86,85 @@ def process_batch(p, input_files, input_dir, output_dir, inpaint_mask_dir, args)
         is_inpaint_batch = len(inpaint_masks) > 0
     if is_inpaint_batch:
         shared.log.info(f"\nInpaint batch is enabled. {len(inpaint_masks)} masks found.")
+        # try to find corresponding mask for an image using simple filename matching, if not found use first one ("same mask for all images" use-case)
+        mask_files = [os.path.join(inpaint_mask_dir, os.path.basename(f)) for f in image_files]
+        mask_files = [f if f in inpaint_masks else inpaint_masks[0] for f in mask_files]
+    else:
+        mask_files = [None] * len(image_files)
     shared.log.info(f"Will process {len(image_files)} images, creating {p.n_iter * p.batch_size} new images for each.")
     save_normally = output_dir == ''
     p.do_not_save_grid = True
     p.do_not_save_samples = not save_normally
+    if save_normally: # images are saved by processing and again under original name same as before
+        output_dir = shared.opts.outdir_img2img_samples
+    else:
+        os.makedirs(output_dir, exist_ok=True)
     shared.state.job_count = len(image_files) * p.n_iter
-    for i, image_file in enumerate(image_files):
-        shared.state.job = f"{i+1} out of {len(image_files)}"
-        if shared.state.skipped:
-            shared.state.skipped = False
-        if shared.state.interrupted:
-            break
-        try:
-            img = Image.open(image_file)
-        except UnidentifiedImageError as e:
-            shared.log.error(f"Image error: {e}")
-            continue
-        img = ImageOps.exif_transpose(img)
-        p.init_images = [img] * p.batch_size
-
-        if is_inpaint_batch:
-            # try to find corresponding mask for an image using simple filename matching
-            mask_image_path = os.path.join(inpaint_mask_dir, os.path.basename(image_file))
-            # if not found use first one ("same mask for all images" use-case)
-            if mask_image_path not in inpaint_masks:
-                mask_image_path = inpaint_masks[0]
-            mask_image = Image.open(mask_image_path)
-            p.image_mask = mask_image
-
-        proc = modules.scripts.scripts_img2img.run(p, *args)
-        if proc is None:
-            proc = processing.process_images(p)
-        for n, image in enumerate(proc.images):
-            basename, ext = os.path.splitext(os.path.basename(image_file))
-            ext = ext[1:]
-            if len(proc.images) > 1:
-                basename = f'{basename}-{n}'
-            if not shared.opts.use_original_name_batch:
-                basename = ''
-                ext = shared.opts.samples_format
-            if output_dir == '':
-                output_dir = shared.opts.outdir_img2img_samples
-            if not save_normally:
-                os.makedirs(output_dir, exist_ok=True)
-            geninfo, items = images.read_info_from_image(image)
-            for k, v in items.items():
-                image.info[k] = v
-            images.save_image(image, path=output_dir, basename=basename, seed=None, prompt=None, extension=ext, info=geninfo, short_filename=True, no_prompt=True, grid=False, pnginfo_section_name="extras", existing_info=image.info, forced_filename=None)
-        shared.log.debug(f'Processed: {len(image_files)} Memory: {memory_stats()} batch')
+    # files are packed into one batch only when each produces a single image and no script takes over processing
+    script_selected = len(args) > 0 and args[0] != 0
+    pack = not script_selected and p.batch_size == 1 and p.n_iter == 1 and not shared.opts.return_mask and not shared.opts.return_mask_composite
+    batch_size, seed, subseed = p.batch_size, p.seed, p.subseed
+    stats = { 'files': 0, 'batches': 0, 'images': 0, 'load': 0, 'process': 0, 'save': 0 }
+    t0 = time.time()
+    saves = deque()
+    # loader keeps next full batch decoding while current one is processed
+    loaded = prefetch_batch_images(image_files, mask_files, shared.opts.batch_prefetch + (shared.opts.batch_jobs_max if pack else 0))
+    try:
+        with ThreadPoolExecutor(max_workers=1) as saver:
+            batches = group_batch_images(loaded, pack, shared.opts.batch_jobs_max)
+            while True:
+                t1 = time.time()
+                group = next(batches, None)
+                stats['load'] += time.time() - t1
+                if group is None:
+                    break
+                shared.state.job = f"{stats['files'] + 1} out of {len(image_files)}" if len(group) == 1 else f"{stats['files'] + 1}-{stats['files'] + len(group)} out of {len(image_files)}"
+                if shared.state.skipped:
+                    shared.state.skipped = False
+                if shared.state.interrupted:
+                    break
+                t1 = time.time()
+                if len(group) == 1:
+                    p.init_images = [group[0][1]] * batch_size
+                    p.batch_size, p.seed, p.subseed = batch_size, seed, subseed
+                else: # same seed for every file same as when processed one by one
+                    p.init_images = [img for _f, img, _m in group]
+                    p.batch_size, p.seed, p.subseed = len(group), [seed] * len(group), [subseed] * len(group)
+                if is_inpaint_batch:
+                    p.image_mask = group[0][2]
+                proc = modules.scripts.scripts_img2img.run(p, *args)
+                if proc is None:
+                    proc = processing.process_images(p)
+                stats['process'] += time.time() - t1
+                stats['files'] += len(group)
+                stats['batches'] += 1
+                stats['images'] += len(proc.images)
+                per_file = max(1, len(proc.images) // len(group))
+                for n, image in enumerate(proc.images):
+                    image_file = group[min(n // per_file, len(group) - 1)][0]
+                    basename, ext = os.path.splitext(os.path.basename(image_file))
+                    ext = ext[1:]
+                    if per_file > 1:
+                        basename = f'{basename}-{n % per_file}'
+                    if not shared.opts.use_original_name_batch:
+                        basename = ''
+                        ext = shared.opts.samples_format
+                    saves.append(saver.submit(contextvars.copy_context().run, save_batch_image, image, output_dir, basename, ext))
+                t1 = time.time()
+                while len(saves) > shared.opts.batch_prefetch * max(1, len(group)): # limit images held in memory waiting to be saved
+                    saves.popleft().result()
+                stats['save'] += time.time() - t1
+            t1 = time.time()
+            while len(saves) > 0:
+                saves.popleft().result()
+            stats['save'] += time.time() - t1
+    finally:
+        loaded.close()
+        p.batch_size, p.seed, p.subseed = batch_size, seed, subseed
+    stats['time'] = time.time() - t0
+    stats = { k: round(v, 2) if isinstance(v, float) else v for k, v in stats.items() }
+    shared.log.info(f'Batch: {stats} rate={round(stats["files"] / stats["time"], 2) if stats["time"] > 0 else 0}/s pack={pack}')
+    shared.log.debug(f'Processed: {len(image_files)} Memory: {memory_stats()} batch')
 
 
 def img2img(id_task: str, mode: int, prompt: str, negative_prompt: str, prompt_styles, init_img, sketch, init_img_with_mask, inpaint_color_sketch, inpaint_color_sketch_orig, init_img_inpaint, init_mask_inpaint, steps: int, sampler_index: int, latent_index: int, mask_blur: int, mask_alpha: float, inpainting_fill: int, full_quality: bool, restore_faces: bool, tiling: bool, n_iter: int, batch_size: int, cfg_scale: float, image_cfg_scale: float, diffusers_guidance_rescale: float, refiner_start: float, clip_skip: int, denoising_strength: float, seed: int, subseed: int, subseed_strength: float, seed_resize_from_h: int, seed_resize_from_w: int, selected_scale_tab: int, height: int, width: int, scale_by: float, resize_mode: int, inpaint_full_res: bool, inpaint_full_res_padding: int, inpainting_mask_invert: int, img2img_batch_files: list, img2img_batch_input_dir: str, img2img_batch_output_dir: str, img2img_batch_inpaint_mask_dir: str, override_settings_texts, *args): # pylint: disable=unused-argument
@@ -179,6 +179,19 @@ class InterrogateModels:
 
         return caption[0]
 
+    def generate_captions(self, pil_images):
+        transform = transforms.Compose([
+            transforms.Resize((blip_image_eval_size, blip_image_eval_size), interpolation=InterpolationMode.BICUBIC),
+            transforms.ToTensor(),
+            transforms.Normalize((0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711))
+        ])
+        gpu_images = torch.stack([transform(pil_image.convert("RGB")) for pil_image in pil_images]).type(self.dtype).to(devices.device_interrogate)
+
+        with torch.no_grad():
+            captions = self.blip_model.generate(gpu_images, sample=False, num_beams=shared.opts.interrogate_clip_num_beams, min_length=shared.opts.interrogate_clip_min_length, max_length=shared.opts.interrogate_clip_max_length)
+
+        return captions
+
     def interrogate(self, pil_image):
         res = ""
         shared.state.begin()
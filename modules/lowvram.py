@@ -1,54 +1,233 @@
+import contextlib
+from collections import OrderedDict
 import torch
-from modules import devices
+from modules import devices, shared
 
-module_in_gpu = None
 cpu = torch.device("cpu")
+engine = None
 
 
-def send_everything_to_cpu():
-    global module_in_gpu # pylint: disable=global-statement
+def module_tensors(module):
+    return [*module.parameters(), *module.buffers()]
 
-    if module_in_gpu is not None:
-        module_in_gpu.to(cpu)
 
-    module_in_gpu = None
+def module_bytes(module):
+    return sum(t.numel() * t.element_size() for t in module_tensors(module))
 
 
-def setup_for_low_vram(sd_model, use_medvram):
-    parents = {}
+class ExecutionDeviceHook:
+    """marker read by diffusers pipelines to find execution device of an offloaded unet"""
+
+    def __init__(self, device):
+        self.execution_device = device
+
+    def detach_hook(self, module):
+        return module
+
+
+class OffloadEngine:
+    """
+    keeps model blocks in pinned host memory and moves them to gpu in execution order
+    - next blocks are prefetched on a side stream while current block computes, as long as resident blocks fit in vram budget
+    - default budget is size of two largest blocks, smallest budget that still lets next block load while largest one runs
+    - execution order is learned from observed calls, initial guess is registration order
+    - eviction is free unless weights were modified on device since load in which case they are written back
+    """
+
+    def __init__(self, device, budget=0, pin_memory=True):
+        self.device = device
+        self.budget = max(0, int(budget)) * 1024 * 1024 # bytes, 0 means size of two largest blocks
+        self.pin_memory = pin_memory and device is not None and device.type == 'cuda'
+        self.stream = torch.cuda.Stream(device) if device is not None and device.type == 'cuda' else None
+        self.blocks = [] # registration order
+        self.sizes = {} # block -> bytes
+        self.used = 0 # bytes of resident blocks
+        self.owners = {} # block -> root model
+        self.parents = {} # hooked module -> block it belongs to
+        self.handles = {} # block -> hook handles
+        self.successor = {} # block -> block observed to run next
+        self.resident = OrderedDict() # block -> pending copy event, ordered by last use
+        self.last = None
+        self.stats = { 'loads': 0, 'prefetch': 0, 'hits': 0, 'waits': 0, 'evictions': 0, 'writebacks': 0 }
+
+    def host_copy(self, tensor):
+        host = tensor.detach().to(cpu)
+        if self.pin_memory:
+            try:
+                host = host.pin_memory()
+            except Exception as e:
+                shared.log.warning(f'Offload: cannot pin memory, using pageable memory: {e}')
+                self.pin_memory = False
+        return host
 
-    def send_me_to_gpu(module, _):
-        """send this module to GPU; send whatever tracked module was previous in GPU to CPU;
-        we add this as forward_pre_hook to a lot of modules and this way all but one of them will
-        be in CPU
-        """
-        global module_in_gpu # pylint: disable=global-statement
+    def register(self, block, owner=None, hooked=None):
+        """register block and install hook on it or on the module that is actually called"""
+        hooked = hooked or block
+        if block not in self.owners:
+            self.blocks.append(block)
+            self.owners[block] = owner
+            self.sizes[block] = module_bytes(block)
+            self.handles[block] = []
+            for t in module_tensors(block):
+                t.data = self.host_copy(t.data)
+                t.offload_host = t.data
+        if hooked is not block:
+            self.parents[hooked] = block
+        self.handles[block].append(hooked.register_forward_pre_hook(self.hook))
 
-        module = parents.get(module, module)
+    def release(self, owner=None):
+        """remove blocks belonging to owner (or all blocks) and their hooks"""
+        for block in [b for b in self.blocks if owner is None or self.owners[b] is owner]:
+            self.evict(block)
+            for handle in self.handles.pop(block, []):
+                handle.remove()
+            self.blocks.remove(block)
+            self.owners.pop(block, None)
+            self.sizes.pop(block, None)
+            self.successor.pop(block, None)
+        self.parents = { k: v for k, v in self.parents.items() if v in self.owners }
+        self.successor = { k: v for k, v in self.successor.items() if v in self.owners }
+        if self.last not in self.owners:
+            self.last = None
 
-        if module_in_gpu == module:
+    def next_block(self, block):
+        if block in self.successor:
+            return self.successor[block]
+        i = self.blocks.index(block) + 1
+        return self.blocks[i] if i < len(self.blocks) else None
+
+    def limit(self):
+        return self.budget if self.budget > 0 else sum(sorted(self.sizes.values())[-2:])
+
+    def make_room(self, size, protected=()):
+        """evict least recently used blocks until size fits in budget, returns false if it does not fit without evicting protected blocks"""
+        for block in list(self.resident):
+            if self.used + size <= self.limit():
+                break
+            if block not in protected:
+                self.evict(block)
+        return self.used + size <= self.limit()
+
+    def load(self, block, prefetch=False, protected=()):
+        """returns false if block is not loaded because prefetch does not fit in budget, blocks that are about to run are always loaded"""
+        if block in self.resident:
+            return True
+        self.sizes[block] = module_bytes(block)
+        if not self.make_room(self.sizes[block], protected) and prefetch:
+            return False
+        compute_stream = torch.cuda.current_stream(self.device) if self.stream is not None else None
+        stream = self.stream if prefetch else None
+        with torch.cuda.stream(stream) if stream is not None else contextlib.nullcontext():
+            for t in module_tensors(block):
+                if t.data.device.type != 'cpu':
+                    continue
+                if getattr(t, 'offload_host', None) is not t.data: # tensor replaced while offloaded, e.g. resized embeddings
+                    t.offload_host = t.data
+                gpu = t.data.to(self.device, non_blocking=self.pin_memory)
+                if stream is not None:
+                    gpu.record_stream(compute_stream) # allocator must not reuse memory until compute stream is done with it
+                t.data = gpu
+                t.offload_version = t._version # pylint: disable=protected-access # counter of tensor itself, t.data returns new view with its own counter
+            event = None
+            if stream is not None:
+                event = torch.cuda.Event()
+                event.record(stream)
+        self.resident[block] = event
+        self.used += self.sizes[block]
+        self.stats['prefetch' if prefetch else 'loads'] += 1
+        return True
+
+    def evict(self, block):
+        if block not in self.resident:
             return
+        for t in module_tensors(block):
+            if t.data.device.type == 'cpu':
+                continue
+            host = getattr(t, 'offload_host', None)
+            if host is None or getattr(t, 'offload_version', None) != t._version or host.shape != t.data.shape or host.dtype != t.data.dtype: # pylint: disable=protected-access
+                host = self.host_copy(t.data) # modified on device so host copy is stale
+                t.offload_host = host
+                self.stats['writebacks'] += 1
+            t.data = host
+        del self.resident[block]
+        self.used -= self.sizes.get(block, 0)
+        self.stats['evictions'] += 1
+
+    def evict_all(self):
+        for block in list(self.resident):
+            self.evict(block)
+        self.last = None
+
+    def activate(self, block):
+        """make block resident before it runs and start prefetching blocks expected to run after it"""
+        if block is self.last and block in self.resident and self.resident[block] is None:
+            return
+        if self.last is not None and self.last is not block:
+            self.successor[self.last] = block
+        if block in self.resident:
+            event = self.resident[block]
+            if event is not None:
+                torch.cuda.current_stream(self.device).wait_event(event)
+                self.resident[block] = None
+                self.stats['waits'] += 1
+            self.resident.move_to_end(block)
+            self.stats['hits'] += 1
+        else:
+            self.load(block)
+        self.last = block
+        protected = { block }
+        upcoming = block
+        for _i in range(len(self.blocks)):
+            upcoming = self.next_block(upcoming)
+            if upcoming is None or upcoming is block:
+                break
+            if not self.load(upcoming, prefetch=True, protected=protected):
+                break
+            protected.add(upcoming)
+
+    def hook(self, module, _inputs):
+        self.activate(self.parents.get(module, module))
 
-        if module_in_gpu is not None:
-            module_in_gpu.to(cpu)
+    def summary(self):
+        return f'budget={round(self.limit() / 1024 / 1024)}MB pinned={self.pin_memory} async={self.stream is not None} blocks={len(self.blocks)} ' + ' '.join([f'{k}={v}' for k, v in self.stats.items()])
 
-        module.to(devices.device)
-        module_in_gpu = module
+
+def get_engine():
+    global engine # pylint: disable=global-statement
+    if engine is None:
+        engine = OffloadEngine(devices.device, budget=shared.opts.lowvram_budget, pin_memory=shared.opts.lowvram_pin_memory)
+    return engine
+
+
+def send_everything_to_cpu():
+    if engine is not None:
+        engine.evict_all()
+
+
+def release(owner=None):
+    if engine is not None:
+        shared.log.debug(f'Offload release: {engine.summary()}')
+        engine.release(owner)
+
+
+def setup_for_low_vram(sd_model, use_medvram):
+    offload = get_engine()
 
     # see below for register_forward_pre_hook;
     # first_stage_model does not use forward(), it uses encode/decode, so register_forward_pre_hook is
     # useless here, and we just replace those methods
 
     first_stage_model = sd_model.first_stage_model
-    first_stage_model_encode = sd_model.first_stage_model.encode
-    first_stage_model_decode = sd_model.first_stage_model.decode
+    if not hasattr(first_stage_model, 'offload_original'): # model can be set up again after weights are reloaded into it
+        first_stage_model.offload_original = (first_stage_model.encode, first_stage_model.decode)
+    first_stage_model_encode, first_stage_model_decode = first_stage_model.offload_original
 
     def first_stage_model_encode_wrap(x):
-        send_me_to_gpu(first_stage_model, None)
+        offload.activate(first_stage_model)
         return first_stage_model_encode(x)
 
     def first_stage_model_decode_wrap(z):
-        send_me_to_gpu(first_stage_model, None)
+        offload.activate(first_stage_model)
         return first_stage_model_decode(z)
 
     # for SD1, cond_stage_model is CLIP and its NN is in the tranformer frield, but for SD2, it's open clip, and it's in model field
@@ -62,37 +241,64 @@ def setup_for_low_vram(sd_model, use_medvram):
     sd_model.to(devices.device)
     sd_model.cond_stage_model.transformer, sd_model.first_stage_model, sd_model.depth_model, sd_model.embedder, sd_model.model = stored
 
-    # register hooks for those the first three models
-    sd_model.cond_stage_model.transformer.register_forward_pre_hook(send_me_to_gpu)
-    sd_model.first_stage_model.register_forward_pre_hook(send_me_to_gpu)
-    sd_model.first_stage_model.encode = first_stage_model_encode_wrap
-    sd_model.first_stage_model.decode = first_stage_model_decode_wrap
+    # register blocks in expected execution order: cond, unet, first stage
+    offload.register(sd_model.cond_stage_model, owner=sd_model, hooked=sd_model.cond_stage_model.transformer)
     if sd_model.depth_model:
-        sd_model.depth_model.register_forward_pre_hook(send_me_to_gpu)
+        offload.register(sd_model.depth_model, owner=sd_model)
     if sd_model.embedder:
-        sd_model.embedder.register_forward_pre_hook(send_me_to_gpu)
-    parents[sd_model.cond_stage_model.transformer] = sd_model.cond_stage_model
+        offload.register(sd_model.embedder, owner=sd_model)
 
     if hasattr(sd_model.cond_stage_model, 'model'):
         sd_model.cond_stage_model.model = sd_model.cond_stage_model.transformer
         del sd_model.cond_stage_model.transformer
 
     if use_medvram:
-        sd_model.model.register_forward_pre_hook(send_me_to_gpu)
+        offload.register(sd_model.model, owner=sd_model)
     else:
         diff_model = sd_model.model.diffusion_model
 
         # the third remaining model is still too big for 4 GB, so we also do the same for its submodules
-        # so that only one of them is in GPU at a time
+        # so that only a window of them is in GPU at a time
         stored = diff_model.input_blocks, diff_model.middle_block, diff_model.output_blocks, diff_model.time_embed
         diff_model.input_blocks, diff_model.middle_block, diff_model.output_blocks, diff_model.time_embed = None, None, None, None
         sd_model.model.to(devices.device)
         diff_model.input_blocks, diff_model.middle_block, diff_model.output_blocks, diff_model.time_embed = stored
 
-        # install hooks for bits of third model
-        diff_model.time_embed.register_forward_pre_hook(send_me_to_gpu)
+        # register bits of third model
+        offload.register(diff_model.time_embed, owner=sd_model)
         for block in diff_model.input_blocks:
-            block.register_forward_pre_hook(send_me_to_gpu)
-        diff_model.middle_block.register_forward_pre_hook(send_me_to_gpu)
+            offload.register(block, owner=sd_model)
+        offload.register(diff_model.middle_block, owner=sd_model)
         for block in diff_model.output_blocks:
-            block.register_forward_pre_hook(send_me_to_gpu)
+            offload.register(block, owner=sd_model)
+
+    offload.register(sd_model.first_stage_model, owner=sd_model)
+    sd_model.first_stage_model.encode = first_stage_model_encode_wrap
+    sd_model.first_stage_model.decode = first_stage_model_decode_wrap
+    shared.log.info(f'Offload: {"medvram" if use_medvram else "lowvram"} {offload.summary()}')
+
+
+def setup_for_diffusers(sd_model):
+    """use offload engine for diffusers pipeline components as alternative to accelerate model or sequential offload"""
+    offload = get_engine()
+    blocks = []
+    components = { name: module for name, module in sd_model.components.items() if isinstance(module, torch.nn.Module) }
+    for name, module in components.items():
+        if name == 'unet' and hasattr(module, 'down_blocks'):
+            blocks += [*module.down_blocks, module.mid_block, *module.up_blocks]
+        elif name in ['vae', 'movq'] and hasattr(module, 'encoder') and hasattr(module, 'decoder'):
+            blocks += [module.decoder, module.encoder]
+        else:
+            blocks.append(module)
+    blocks = [b for b in blocks if b is not None]
+    in_blocks = {id(t) for block in blocks for t in module_tensors(block)}
+    for module in components.values(): # everything not in a block is small and stays in vram
+        for t in module_tensors(module):
+            if id(t) not in in_blocks:
+                t.data = t.data.to(devices.device)
+    for block in blocks:
+        offload.register(block, owner=sd_model)
+    unet = components.get('unet', None)
+    if unet is not None and not hasattr(unet, '_hf_hook'):
+        unet._hf_hook = ExecutionDeviceHook(devices.device) # pylint: disable=protected-access
+    shared.log.info(f'Offload: diffusers {offload.summary()}')
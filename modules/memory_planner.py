@@ -0,0 +1,230 @@
+import torch
+from modules import shared, devices, hashes
+
+
+# prior activation costs in bytes at 16-bit precision, corrected per model and attention type by calibration from observed peaks
+unet_token_bytes = { 'sd': 75_000, 'sdxl': 110_000, 'kandinsky': 90_000 } # per latent token per sample
+unet_attention_bytes = { 'sd': 16, 'sdxl': 1.25, 'kandinsky': 16 } # per latent token squared per sample when attention is not memory efficient
+vae_pixel_bytes = 4_600 # per output pixel per decoded image
+vae_tile_pixels = 512 * 512 # approximate pixels decoded at once when vae tiling is enabled
+calibration_rate = 0.3
+
+
+class Plan:
+    """memory plan for a single job, entered as context so per-job changes are applied and reverted around processing"""
+
+    def __init__(self, p):
+        self.p = p
+        self.model_type = model_type()
+        self.attention = attention_method()
+        self.lean_attention = False
+        self.vae_tiled = vae_tiled()
+        self.batch_size = p.batch_size
+        self.n_iter = p.n_iter
+        self.actions = []
+        self.overrides = {}
+        self.baseline = 0
+        self.budget = 0
+        self.estimate = {}
+        self.overlay = None
+        self.original = None
+
+    @property
+    def key(self):
+        return f'{self.model_type}:{"lean" if self.lean_attention else self.attention}:{"tiled" if self.vae_tiled else "full"}'
+
+    def quadratic(self):
+        return not self.lean_attention and self.attention in ['none', 'v1', 'math']
+
+    def passes(self):
+        res = [(self.p.width, self.p.height)]
+        if getattr(self.p, 'enable_hr', False):
+            if getattr(self.p, 'hr_resize_x', 0) > 0 or getattr(self.p, 'hr_resize_y', 0) > 0:
+                res.append((self.p.hr_resize_x or self.p.hr_resize_y * self.p.width // self.p.height, self.p.hr_resize_y or self.p.hr_resize_x * self.p.height // self.p.width))
+            else:
+                res.append((int(self.p.width * self.p.hr_scale), int(self.p.height * self.p.hr_scale)))
+        return res
+
+    def predict(self):
+        """activation memory in bytes on top of memory already allocated when job starts"""
+        scale = 2 if devices.dtype == torch.float32 else 1
+        scale_vae = 2 if devices.dtype_vae == torch.float32 else 1
+        factor = calibration().get(self.key, {}).get('factor', 1.0)
+        unet = 0
+        vae = 0
+        for width, height in self.passes():
+            tokens = (width // 8) * (height // 8)
+            per_sample = unet_token_bytes.get(self.model_type, unet_token_bytes['sd']) * tokens
+            if self.quadratic():
+                per_sample += unet_attention_bytes.get(self.model_type, unet_attention_bytes['sd']) * tokens * tokens
+            unet = max(unet, 2 * self.batch_size * per_sample * scale) # cond and uncond run in same batch
+            pixels = min(width * height, vae_tile_pixels) if self.vae_tiled else width * height
+            images = 1 if shared.backend == shared.Backend.ORIGINAL or shared.opts.diffusers_vae_slicing else self.batch_size # original backend decodes one image at a time
+            vae = max(vae, vae_pixel_bytes * pixels * images * scale_vae)
+        self.estimate = { 'unet': unet * factor, 'vae': vae * factor, 'peak': max(unet, vae) * factor, 'factor': factor }
+        return self.estimate['peak']
+
+    def fits(self):
+        return self.budget <= 0 or self.predict() <= self.budget
+
+    def solve(self):
+        """choose cheapest changes that make predicted peak fit in budget: lean attention, then vae tiling, then smaller batches"""
+        if self.fits():
+            return
+        if self.quadratic():
+            self.lean_attention = True
+            self.actions.append('attention=lean')
+            if self.fits():
+                return
+        if not self.vae_tiled and self.estimate['vae'] > self.budget:
+            self.vae_tiled = True
+            self.actions.append('vae=tiled')
+            if self.fits():
+                return
+        total = self.batch_size * self.n_iter
+        for batch_size in [b for b in range(self.batch_size - 1, 0, -1) if self.batch_size % b == 0]: # keep total number of images identical
+            self.batch_size = batch_size
+            self.n_iter = total // batch_size
+            if self.fits():
+                break
+        if self.batch_size != self.p.batch_size:
+            self.actions.append(f'batch={self.p.batch_size}x{self.p.n_iter}->{self.batch_size}x{self.n_iter}')
+        if not self.fits():
+            shared.log.warning(f'Memory planner: job may not fit estimate={gb(self.estimate["peak"])} budget={gb(self.budget)}')
+
+    def summary(self):
+        return {
+            'model': self.model_type,
+            'attention': 'lean' if self.lean_attention else self.attention,
+            'vae': 'tiled' if self.vae_tiled else 'full',
+            'batch_size': self.batch_size,
+            'n_iter': self.n_iter,
+            'estimate': { k: gb(v) if k != 'factor' else round(v, 3) for k, v in self.estimate.items() },
+            'baseline': gb(self.baseline),
+            'budget': gb(self.budget),
+            'actions': self.actions,
+        }
+
+    def __enter__(self):
+        if len(self.actions) == 0:
+            return self
+        self.original = (self.p.batch_size, self.p.n_iter)
+        self.p.batch_size, self.p.n_iter = self.batch_size, self.n_iter
+        self.p.extra_generation_params['Memory plan'] = ' '.join(self.actions)
+        if shared.backend == shared.Backend.ORIGINAL:
+            if self.lean_attention:
+                self.overrides['cross_attention_optimization'] = 'Sub-quadratic'
+            if self.vae_tiled:
+                self.overrides['sd_vae_tiled_decode'] = True
+        self.overlay = shared.opts.overlay(self.overrides)
+        self.overlay.__enter__() # pylint: disable=unnecessary-dunder-call
+        set_model_options(self.lean_attention, self.vae_tiled)
+        shared.log.info(f'Memory planner: {self.summary()}')
+        return self
+
+    def __exit__(self, *args):
+        if self.overlay is not None:
+            self.overlay.__exit__(*args)
+            self.overlay = None
+            set_model_options(False, False) # back to configured options
+        if self.original is not None: # scripts reuse p for following jobs
+            self.p.batch_size, self.p.n_iter = self.original
+            self.original = None
+        self.calibrate()
+
+    def calibrate(self):
+        """correct future predictions using peak memory observed while this job was running"""
+        if not torch.cuda.is_available() or self.estimate.get('peak', 0) <= 0 or getattr(shared.sd_model, 'has_accelerate', False) or shared.cmd_opts.lowvram or shared.cmd_opts.medvram:
+            return
+        try:
+            observed = torch.cuda.max_memory_allocated(devices.device) - self.baseline
+        except Exception:
+            return
+        if observed <= 0:
+            return
+        entry = calibration().setdefault(self.key, { 'factor': 1.0, 'samples': 0 })
+        ratio = observed / (self.estimate['peak'] / self.estimate['factor'])
+        entry['factor'] = min(4.0, max(0.25, (1 - calibration_rate) * entry['factor'] + calibration_rate * ratio if entry['samples'] > 0 else ratio))
+        entry['samples'] += 1
+        if entry['samples'] <= 3 or entry['samples'] % 10 == 0:
+            hashes.dump_cache()
+        shared.log.debug(f'Memory planner calibrate: key={self.key} predicted={gb(self.estimate["peak"])} observed={gb(observed)} factor={entry["factor"]:.3f} samples={entry["samples"]}')
+
+
+def gb(val):
+    return round(val / 1024 / 1024 / 1024, 2)
+
+
+def calibration():
+    return hashes.cache('memory-planner')
+
+
+def model_type():
+    if shared.backend == shared.Backend.ORIGINAL:
+        return 'sd'
+    return shared.sd_model_type if shared.sd_model_type in unet_token_bytes else 'sd'
+
+
+def attention_method():
+    if shared.backend == shared.Backend.ORIGINAL:
+        from modules import sd_hijack
+        return sd_hijack.model_hijack.optimization_method or 'none'
+    if shared.opts.diffusers_attention_slicing:
+        return 'sliced'
+    return 'sdp' if hasattr(torch.nn.functional, 'scaled_dot_product_attention') else 'math'
+
+
+def vae_tiled():
+    if shared.backend == shared.Backend.ORIGINAL:
+        return shared.opts.sd_vae_tiled_decode
+    return shared.opts.diffusers_vae_tiling
+
+
+def set_model_options(lean_attention: bool, tiled: bool):
+    if shared.backend == shared.Backend.ORIGINAL:
+        from modules import sd_hijack
+        sd_hijack.model_hijack.optimization_method = sd_hijack.apply_optimizations()
+        return
+    sd_model = shared.sd_model
+    if hasattr(sd_model, 'enable_attention_slicing'):
+        if lean_attention or shared.opts.diffusers_attention_slicing:
+            sd_model.enable_attention_slicing()
+        else:
+            sd_model.disable_attention_slicing()
+    if hasattr(sd_model, 'enable_vae_tiling'):
+        if tiled or shared.opts.diffusers_vae_tiling:
+            sd_model.enable_vae_tiling()
+        else:
+            sd_model.disable_vae_tiling()
+
+
+def memory_budget():
+    """bytes available for activations: free device memory plus memory cached by torch but not in use"""
+    if not torch.cuda.is_available() or devices.device.type != 'cuda':
+        return 0, 0
+    try:
+        free, _total = torch.cuda.mem_get_info(devices.device)
+        allocated = torch.cuda.memory_allocated(devices.device)
+        cached = torch.cuda.memory_reserved(devices.device) - allocated
+        return allocated, int((free + cached) * shared.opts.memory_planner_limit)
+    except Exception:
+        return 0, 0
+
+
+def plan(p, apply=True) -> Plan:
+    res = Plan(p)
+    res.baseline, res.budget = memory_budget()
+    res.predict()
+    if shared.opts.memory_planner and res.budget > 0:
+        res.solve()
+    if apply and torch.cuda.is_available():
+        try:
+            torch.cuda.reset_peak_memory_stats(devices.device)
+        except Exception:
+            pass
+    return res
+
+
+def estimate(p) -> dict:
+    return plan(p, apply=False).summary()
+
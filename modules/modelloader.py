@@ -1,10 +1,9 @@
 import os
-import time
 import shutil
 import importlib
 from typing import Dict
 from urllib.parse import urlparse
-from modules import shared
+from modules import shared, files_index
 from modules.upscaler import Upscaler, UpscalerLanczos, UpscalerNearest, UpscalerNone
 from modules.paths import script_path, models_path
 
@@ -180,59 +179,24 @@ def find_diffuser(name: str):
     return None
 
 
-modelloader_directories = {}
-cache_last = 0
-cache_time = 1
-
-
-def directory_has_changed(dir:str, *, recursive:bool=True) -> bool: # pylint: disable=redefined-builtin
+def directory_has_changed(dir:str, *, recursive:bool=True, generation:int=None) -> bool: # pylint: disable=redefined-builtin,unused-argument
+    """if generation is provided it is compared against index generation, otherwise returns true if folder is not yet indexed"""
     try:
-        dir = os.path.abspath(dir)
-        if dir not in modelloader_directories:
-            return True
-        if cache_last > (time.time() - cache_time):
-            return False
-        if not (os.path.exists(dir) and os.path.isdir(dir) and os.path.getmtime(dir) == modelloader_directories[dir][0]):
-            return True
-        if recursive:
-            for _dir in modelloader_directories:
-                if _dir.startswith(dir) and _dir != dir and not (os.path.exists(_dir) and os.path.isdir(_dir) and os.path.getmtime(_dir) == modelloader_directories[_dir][0]):
-                    return True
+        index = files_index.get_index()
+        if generation is None:
+            return os.path.abspath(dir) not in index.dirs
+        return index.has_changed(dir, generation)
     except Exception as e:
         shared.log.error(f"Filesystem Error: {e.__class__.__name__}({e})")
         return True
-    return False
 
 
 def directory_directories(dir:str, *, recursive:bool=True) -> dict[str,tuple[float,list[str]]]: # pylint: disable=redefined-builtin
-    dir = os.path.abspath(dir)
-    if directory_has_changed(dir, recursive=recursive):
-        for _dir in modelloader_directories:
-            try:
-                if (os.path.exists(_dir) and os.path.isdir(_dir)):
-                    continue
-            except Exception:
-                pass
-            del modelloader_directories[_dir]
-        for _dir, _files in walk(dir, lambda e, path: shared.log.debug(f"FS walk error: {e} {path}")):
-            try:
-                mtime = os.path.getmtime(_dir)
-                if _dir not in modelloader_directories or mtime != modelloader_directories[_dir][0]:
-                    modelloader_directories[_dir] = (mtime, [os.path.join(_dir, fn) for fn in _files])
-            except Exception as e:
-                shared.log.error(f"Filesystem Error: {e.__class__.__name__}({e})")
-                del modelloader_directories[_dir]
-    res = {}
-    for _dir in modelloader_directories:
-        if _dir == dir or (recursive and _dir.startswith(dir)):
-            res[_dir] = modelloader_directories[_dir]
-            if not recursive:
-                break
-    return res
+    return files_index.get_index().directories(dir, recursive=recursive)
 
 
 def directory_mtime(dir:str, *, recursive:bool=True) -> float: # pylint: disable=redefined-builtin
-    return float(max(0, *[mtime for mtime, _ in directory_directories(dir, recursive=recursive).values()]))
+    return float(max([0, *[mtime for mtime, _ in directory_directories(dir, recursive=recursive).values()]]))
 
 
 def directories_file_paths(directories:dict) -> list[str]:
@@ -253,7 +217,7 @@ def unique_paths(paths:list[str]) -> list[str]:
 
 
 def directory_files(*directories:list[str], recursive:bool=True) -> list[str]:
-    return unique_paths(sum([[*directories_file_paths(directory_directories(dir, recursive=recursive))] for dir in unique_directories(directories, recursive=recursive)],[]))
+    return files_index.get_index().files(*directories, recursive=recursive)
 
 
 def extension_filter(ext_filter=None, ext_blacklist=None):
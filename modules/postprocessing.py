@@ -1,6 +1,11 @@
 import os
+import time
+import itertools
+import contextvars
 import tempfile
 from typing import List
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from PIL import Image
 
@@ -8,6 +13,116 @@ from modules import shared, images, devices, scripts, scripts_postprocessing, ge
 from modules.shared import opts
 
 
+def postprocess_info(pp, geninfo, items):
+    """copy source metadata to processed image and return its infotext"""
+    infotext = ''
+    for k, v in items.items():
+        pp.image.info[k] = v
+    if 'parameters' in items:
+        infotext = items['parameters'] + ', '
+    infotext = infotext + ", ".join([k if k == v else f'{k}: {generation_parameters_copypaste.quote(v)}' for k, v in pp.info.items() if v is not None])
+    pp.image.info["postprocessing"] = infotext
+    return infotext
+
+
+def load_image(filename):
+    """decode image and read its metadata in loader thread, only rgb copy is kept"""
+    try:
+        image = Image.open(filename)
+        rgb = image.convert("RGB")
+    except Exception as e:
+        shared.log.error(f'Failed to open image: {filename} {e}')
+        return None
+    geninfo, items = images.read_info_from_image(image, watermark=False)
+    image.close()
+    return rgb, geninfo, items
+
+
+def prefetch_images(filenames, count):
+    """yields (filename, (image, geninfo, items) or None) in input order while next files are decoded in background"""
+    with ThreadPoolExecutor(max_workers=max(1, min(count, os.cpu_count() or 4))) as executor:
+        files = iter(filenames)
+        pending = deque((f, executor.submit(load_image, f)) for f in itertools.islice(files, count))
+        while len(pending) > 0:
+            filename, future = pending.popleft()
+            for f in itertools.islice(files, 1):
+                pending.append((f, executor.submit(load_image, f)))
+            yield filename, future.result()
+
+
+def group_images(loaded, max_batch):
+    """consecutive images of same size are grouped so upscalers can process them together"""
+    group = []
+    for filename, item in loaded:
+        if item is None:
+            continue
+        if len(group) > 0 and (item[0].size != group[0][1][0].size or len(group) >= max_batch):
+            yield group
+            group = []
+        group.append((filename, item))
+    if len(group) > 0:
+        yield group
+
+
+def run_postprocessing_batch(input_dir, outpath, show_extras_results, args, save_output):
+    """
+    streaming directory mode, memory use does not depend on number of files
+    - loader threads decode next images while current ones are processed
+    - images of same size run through postprocessing scripts as one batch
+    - processed images are saved in background
+    """
+    image_list = shared.listfiles(input_dir)
+    max_batch = opts.postprocessing_batch_size
+    outputs = []
+    infotext = ''
+    params = {}
+    stats = { 'files': 0, 'batches': 0, 'load': 0, 'process': 0, 'save': 0 }
+    t0 = time.time()
+    saves = deque()
+    loaded = prefetch_images(image_list, opts.batch_prefetch + max_batch)
+    try:
+        with ThreadPoolExecutor(max_workers=1) as saver:
+            groups = group_images(loaded, max_batch)
+            while True:
+                t1 = time.time()
+                group = next(groups, None)
+                stats['load'] += time.time() - t1
+                if group is None:
+                    break
+                if shared.state.interrupted:
+                    shared.log.debug('Postprocess interrupted')
+                    break
+                t1 = time.time()
+                shared.state.textinfo = group[0][0]
+                pps = [scripts_postprocessing.PostprocessedImage(image) for _filename, (image, _geninfo, _items) in group]
+                scripts.scripts_postproc.run_batch(pps, args)
+                stats['process'] += time.time() - t1
+                for (filename, (_image, geninfo, items)), pp in zip(group, pps):
+                    basename = os.path.splitext(os.path.basename(filename))[0] if opts.use_original_name_batch else ''
+                    params = generation_parameters_copypaste.parse_generation_parameters(geninfo)
+                    infotext = postprocess_info(pp, geninfo, items)
+                    if save_output:
+                        saves.append(saver.submit(contextvars.copy_context().run, images.save_image, pp.image, path=outpath, basename=basename, seed=None, prompt=None, extension=opts.samples_format, info=infotext, short_filename=True, no_prompt=True, grid=False, pnginfo_section_name="extras", existing_info=pp.image.info, forced_filename=None))
+                    if show_extras_results:
+                        outputs.append(pp.image)
+                stats['files'] += len(group)
+                stats['batches'] += 1
+                t1 = time.time()
+                while len(saves) > opts.batch_prefetch + max_batch: # limit processed images held in memory waiting to be saved
+                    saves.popleft().result()
+                stats['save'] += time.time() - t1
+            t1 = time.time()
+            while len(saves) > 0:
+                saves.popleft().result()
+            stats['save'] += time.time() - t1
+    finally:
+        loaded.close()
+    stats['time'] = time.time() - t0
+    stats = { k: round(v, 2) if isinstance(v, float) else v for k, v in stats.items() }
+    shared.log.info(f'Postprocess batch: {stats} rate={round(stats["files"] / stats["time"], 2) if stats["time"] > 0 else 0}/s')
+    return outputs, infotext, params
+
+
 def run_postprocessing(extras_mode, image, image_folder: List[tempfile.NamedTemporaryFile], input_dir, output_dir, show_extras_results, *args, save_output: bool = True):
     devices.torch_gc()
     shared.state.begin()
@@ -32,24 +147,14 @@ def run_postprocessing(extras_mode, image, image_folder: List[tempfile.NamedTemp
     elif extras_mode == 2:
         assert not shared.cmd_opts.hide_ui_dir_config, '--hide-ui-dir-config option must be disabled'
         assert input_dir, 'input directory not selected'
-        image_list = shared.listfiles(input_dir)
-        for filename in image_list:
-            try:
-                image = Image.open(filename)
-            except Exception as e:
-                shared.log.error(f'Failed to open image: {filename} {e}')
-                continue
-            image_data.append(image)
-            image_names.append(filename)
-            image_ext.append(None)
+        outputs, infotext, params = run_postprocessing_batch(input_dir, output_dir or opts.outdir_samples or opts.outdir_extras_samples, show_extras_results, args, save_output)
+        devices.torch_gc()
+        return outputs, infotext, params
     else:
         image_data.append(image)
         image_names.append(None)
         image_ext.append(None)
-    if extras_mode == 2 and output_dir != '':
-        outpath = output_dir
-    else:
-        outpath = opts.outdir_samples or opts.outdir_extras_samples
+    outpath = opts.outdir_samples or opts.outdir_extras_samples
     for image, name, ext in zip(image_data, image_names, image_ext):
         infotext = ''
         if shared.state.interrupted:
@@ -64,18 +169,12 @@ def run_postprocessing(extras_mode, image, image_folder: List[tempfile.NamedTemp
             basename = os.path.splitext(os.path.basename(name))[0]
         else:
             basename = ''
-        geninfo, items = images.read_info_from_image(image)
+        geninfo, items = images.read_info_from_image(image, watermark=False)
         params = generation_parameters_copypaste.parse_generation_parameters(geninfo)
-        for k, v in items.items():
-            pp.image.info[k] = v
-        if 'parameters' in items:
-            infotext = items['parameters'] + ', '
-        infotext = infotext + ", ".join([k if k == v else f'{k}: {generation_parameters_copypaste.quote(v)}' for k, v in pp.info.items() if v is not None])
-        pp.image.info["postprocessing"] = infotext
+        infotext = postprocess_info(pp, geninfo, items)
         if save_output:
             images.save_image(pp.image, path=outpath, basename=basename, seed=None, prompt=None, extension=ext or opts.samples_format, info=infotext, short_filename=True, no_prompt=True, grid=False, pnginfo_section_name="extras", existing_info=pp.image.info, forced_filename=None)
-        if extras_mode != 2 or show_extras_results:
-            outputs.append(pp.image)
+        outputs.append(pp.image)
         image.close()
 
     devices.torch_gc()
@@ -8,15 +8,12 @@ from typing import Any, Dict, List
 import torch
 import numpy as np
 from PIL import Image, ImageFilter, ImageOps
-import cv2
-from skimage import exposure
 from ldm.data.util import AddMiDaS
 from ldm.models.diffusion.ddpm import LatentDepth2ImageDiffusion
 from einops import repeat, rearrange
-from blendmodes.blend import blendLayers, BlendType
 from installer import git_commit
 import modules.sd_hijack
-from modules import devices, prompt_parser, masking, sd_samplers, lowvram, generation_parameters_copypaste, script_callbacks, extra_networks, sd_vae_approx, scripts, sd_samplers_common # pylint: disable=unused-import
+from modules import devices, prompt_parser, masking, sd_samplers, lowvram, generation_parameters_copypaste, script_callbacks, extra_networks, sd_vae_approx, scripts, sd_samplers_common, memory_planner, processing_recovery, processing_correction, processing_tiled, result_cache # pylint: disable=unused-import
 from modules.sd_hijack import model_hijack
 import modules.shared as shared
 import modules.paths as paths
@@ -33,35 +30,35 @@ opt_f = 8
 
 def setup_color_correction(image):
     shared.log.debug("Calibrating color correction.")
-    correction_target = cv2.cvtColor(np.asarray(image.copy()), cv2.COLOR_RGB2LAB)
+    correction_target = processing_correction.lab(image)
     return correction_target
 
 
 def apply_color_correction(correction, original_image):
-    shared.log.debug("Applying color correction.")
-    image = Image.fromarray(cv2.cvtColor(exposure.match_histograms(
-        cv2.cvtColor(np.asarray(original_image), cv2.COLOR_RGB2LAB),
-        correction,
-        channel_axis=2
-    ), cv2.COLOR_LAB2RGB).astype("uint8"))
-    image = blendLayers(image, original_image, BlendType.LUMINOSITY)
-    return image
+    return apply_color_corrections([correction], [original_image])[0]
+
+
+def apply_color_corrections(corrections, original_images):
+    """batch of images is corrected on device in one pass"""
+    shared.log.debug(f"Applying color correction: images={len(original_images)}")
+    return processing_correction.color_correct(original_images, corrections)
 
 
 def apply_overlay(image, paste_loc, index, overlays):
-    if overlays is None or index >= len(overlays):
-        return image
-    overlay = overlays[index]
+    return apply_overlays([image], paste_loc, index, overlays)[0]
+
+
+def apply_overlays(batch_images, paste_loc, index, overlays):
+    """overlays starting at index are composited over batch of images on device, images without overlay are returned as is"""
+    count = min(len(batch_images), max(0, len(overlays or []) - index))
+    if count == 0:
+        return batch_images
     if paste_loc is not None:
-        x, y, w, h = paste_loc
-        base_image = Image.new('RGBA', (overlay.width, overlay.height))
-        image = images.resize_image(2, image, w, h)
-        base_image.paste(image, (x, y))
-        image = base_image
-    image = image.convert('RGBA')
-    image.alpha_composite(overlay)
-    image = image.convert('RGB')
-    return image
+        _x, _y, w, h = paste_loc
+        resized = [images.resize_image(2, image, w, h) for image in batch_images[:count]]
+    else:
+        resized = batch_images[:count]
+    return processing_correction.composite_overlays(resized, overlays[index:index+count], paste_loc) + batch_images[count:]
 
 
 def txt2img_image_conditioning(sd_model, x, width, height):
@@ -153,7 +150,6 @@ class StableDiffusionProcessing:
         self.enable_hr = None
         self.refiner_start = 0
         self.ops = []
-        shared.opts.data['clip_skip'] = clip_skip
 
     @property
     def sd_model(self):
@@ -216,7 +212,7 @@ class StableDiffusionProcessing:
             getattr(self, "inpainting_mask_weight", shared.opts.inpainting_mask_weight)
         )
         # Encode the new masked image using first stage of network.
-        conditioning_image = self.sd_model.get_first_stage_encoding(self.sd_model.encode_first_stage(conditioning_image))
+        conditioning_image = encode_first_stage(self.sd_model, conditioning_image)
         # Create the concatenated conditioning tensor to be fed to `c_concat`
         conditioning_mask = torch.nn.functional.interpolate(conditioning_mask, size=latent_image.shape[-2:])
         conditioning_mask = conditioning_mask.expand(conditioning_image.shape[0], -1, -1, -1)
@@ -425,7 +421,9 @@ def create_random_tensors(shape, seeds, subseeds=None, subseed_strength=0.0, see
 
 def decode_first_stage(model, x):
     with devices.autocast(disable = x.dtype==devices.dtype_vae):
-        if hasattr(model, 'decode_first_stage'):
+        if hasattr(model, 'decode_first_stage') and shared.opts.sd_vae_tiled_decode:
+            x = decode_first_stage_tiled(model, x)
+        elif hasattr(model, 'decode_first_stage'):
             x = model.decode_first_stage(x)
         elif hasattr(model, 'vae'):
             x = model.vae(x)
@@ -434,6 +432,73 @@ def decode_first_stage(model, x):
     return x
 
 
+def decode_first_stage_tiled(model, x, tile=64, overlap=16):
+    """decode latent in overlapping tiles blended with linear ramps so peak memory depends on tile size instead of image size"""
+    _b, _c, h, w = x.shape
+    if h <= tile and w <= tile:
+        return model.decode_first_stage(x)
+
+    def starts(size):
+        stride = tile - overlap
+        res = list(range(0, max(size - tile, 0) + 1, stride))
+        if res[-1] + tile < size:
+            res.append(size - tile)
+        return res
+
+    def ramp(size, length, start, end):
+        weight = torch.ones(size, device=x.device)
+        if start:
+            weight[:length] = torch.linspace(1 / length, 1, length, device=x.device)
+        if end:
+            weight[-length:] = torch.linspace(1, 1 / length, length, device=x.device)
+        return weight
+
+    out = None
+    weights = None
+    for y in starts(h):
+        for x0 in starts(w):
+            decoded = model.decode_first_stage(x[:, :, y:y+tile, x0:x0+tile]).float()
+            scale = decoded.shape[2] // min(tile, h)
+            if out is None:
+                out = torch.zeros((x.shape[0], decoded.shape[1], h * scale, w * scale), device=x.device)
+                weights = torch.zeros((1, 1, h * scale, w * scale), device=x.device)
+            th, tw = decoded.shape[2], decoded.shape[3]
+            mask = ramp(th, overlap * scale, y > 0, y + tile < h)[:, None] * ramp(tw, overlap * scale, x0 > 0, x0 + tile < w)[None, :]
+            out[:, :, y*scale:y*scale+th, x0*scale:x0*scale+tw] += decoded * mask
+            weights[:, :, y*scale:y*scale+th, x0*scale:x0*scale+tw] += mask
+            del decoded
+    return (out / weights).to(devices.dtype_vae)
+
+
+def encode_first_stage(model, x):
+    if shared.opts.sd_vae_tiled_decode:
+        return encode_first_stage_tiled(model, x)
+    return model.get_first_stage_encoding(model.encode_first_stage(x))
+
+
+def encode_first_stage_tiled(model, x, tile=512, overlap=128):
+    """encode image in overlapping pixel tiles blended in latent space so peak memory depends on tile size instead of image size"""
+    _b, _c, h, w = x.shape
+    if h <= tile and w <= tile:
+        return model.get_first_stage_encoding(model.encode_first_stage(x))
+    out = None
+    weights = None
+    for y in processing_tiled.tile_starts(h, tile, overlap):
+        for x0 in processing_tiled.tile_starts(w, tile, overlap):
+            encoded = model.get_first_stage_encoding(model.encode_first_stage(x[:, :, y:y+tile, x0:x0+tile]))
+            scale = min(tile, h) // encoded.shape[2]
+            if out is None:
+                out = torch.zeros((x.shape[0], encoded.shape[1], h // scale, w // scale), device=encoded.device)
+                weights = torch.zeros((1, 1, h // scale, w // scale), device=encoded.device)
+            ly, lx, th, tw = y // scale, x0 // scale, encoded.shape[2], encoded.shape[3]
+            mask = processing_tiled.ramp(th, overlap // scale, y > 0, y + tile < h, out.device)[:, None] * processing_tiled.ramp(tw, overlap // scale, x0 > 0, x0 + tile < w, out.device)[None, :]
+            out[:, :, ly:ly+th, lx:lx+tw] += encoded.float() * mask
+            weights[:, :, ly:ly+th, lx:lx+tw] += mask
+            dtype = encoded.dtype
+            del encoded
+    return (out / weights).to(dtype)
+
+
 def get_fixed_seed(seed):
     if seed is None or seed == '' or seed == -1:
         return int(random.randrange(4294967294))
@@ -531,49 +596,69 @@ def print_profile(profile, msg: str):
     print(f'Profile {msg}:', '\n'.join(lines))
 
 
+overlay_models = set() # model options whose loaded model currently comes from a job overlay instead of global settings
+
+
+def apply_model_settings(overrides: dict):
+    """load models required by effective settings; model loaded for a previous override is kept until a job requires a different one"""
+    keys = [k for k in shared.model_opts if k in overrides or k in overlay_models]
+    if 'sd_model_checkpoint' in keys or 'sd_model_dict' in keys:
+        sd_models.reload_model_weights() # returns early if loaded model already matches
+    if 'sd_model_refiner' in keys:
+        sd_models.reload_model_weights(op='refiner')
+    if len(keys) > 0 and shared.sd_model is not None:
+        sd_vae.reload_vae_weights() # returns early if loaded vae already matches
+    overlay_models.clear()
+    overlay_models.update([k for k in shared.model_opts if k in overrides])
+
+
 def process_images(p: StableDiffusionProcessing) -> Processed:
-    stored_opts = {k: shared.opts.data[k] for k in p.override_settings.keys()}
-    try:
-        # if no checkpoint override or the override checkpoint can't be found, remove override entry and load opts checkpoint
-        if p.override_settings.get('sd_model_checkpoint', None) is not None and sd_models.checkpoint_aliases.get(p.override_settings.get('sd_model_checkpoint')) is None:
-            p.override_settings.pop('sd_model_checkpoint', None)
-            sd_models.reload_model_weights()
+    # if no checkpoint override or the override checkpoint can't be found, remove override entry and load opts checkpoint
+    if p.override_settings.get('sd_model_checkpoint', None) is not None and sd_models.checkpoint_aliases.get(p.override_settings.get('sd_model_checkpoint')) is None:
+        shared.log.warning(f"Override checkpoint not found: {p.override_settings.get('sd_model_checkpoint')}")
+        p.override_settings.pop('sd_model_checkpoint', None)
+    for k in [k for k in p.override_settings.keys() if k in shared.overlay_restricted_opts]:
+        shared.log.warning(f'Override setting cannot be applied per-job: {k}')
+        p.override_settings.pop(k, None)
+    if p.override_settings_restore_afterwards:
+        overrides = p.override_settings
+    else: # caller asked for overrides to persist so apply them to global settings
         for k, v in p.override_settings.items():
             setattr(shared.opts, k, v)
-            if k == 'sd_model_checkpoint':
-                sd_models.reload_model_weights()
-            if k == 'sd_vae':
-                sd_vae.reload_vae_weights()
-
-        if not shared.opts.cuda_compile:
-            sd_models.apply_token_merging(p.sd_model, p.get_token_merging_ratio())
-
-        if shared.cmd_opts.profile:
-            """
-            import torch.profiler # pylint: disable=redefined-outer-name
-            with torch.profiler.profile(profile_memory=True, with_modules=True) as prof:
-                with torch.profiler.record_function("process_images"):
+        overlay_models.update([k for k in shared.model_opts if k in p.override_settings]) # treated as stale so they are reloaded from global settings
+        overrides = {}
+    try:
+        with shared.opts.overlay({ **overrides, 'clip_skip': p.clip_skip }):
+            apply_model_settings(overrides)
+
+            cached = result_cache.lookup(p)
+            if cached is not None:
+                return cached
+
+            if not shared.opts.cuda_compile:
+                sd_models.apply_token_merging(p.sd_model, p.get_token_merging_ratio())
+
+            p.recovery = processing_recovery.Recovery(p)
+            with memory_planner.plan(p), p.recovery:
+                if shared.cmd_opts.profile:
+                    """
+                    import torch.profiler # pylint: disable=redefined-outer-name
+                    with torch.profiler.profile(profile_memory=True, with_modules=True) as prof:
+                        with torch.profiler.record_function("process_images"):
+                            res = process_images_inner(p)
+                    print_profile(prof, 'process_images')
+                    """
+                    import cProfile
+                    pr = cProfile.Profile()
+                    pr.enable()
                     res = process_images_inner(p)
-            print_profile(prof, 'process_images')
-            """
-            import cProfile
-            pr = cProfile.Profile()
-            pr.enable()
-            res = process_images_inner(p)
-            print_profile(pr, 'Torch')
-        else:
-            res = process_images_inner(p)
+                    print_profile(pr, 'Torch')
+                else:
+                    res = process_images_inner(p)
+            result_cache.store(p, res)
     finally:
         if not shared.opts.cuda_compile:
             sd_models.apply_token_merging(p.sd_model, 0)
-        if p.override_settings_restore_afterwards: # restore opts to original state
-            for k, v in stored_opts.items():
-                setattr(shared.opts, k, v)
-                if k == 'sd_model_checkpoint':
-                    sd_models.reload_model_weights()
-
-                if k == 'sd_vae':
-                    sd_vae.reload_vae_weights()
     return res
 
 
@@ -613,6 +698,8 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
         model_hijack.embedding_db.load_textual_inversion_embeddings()
     if p.scripts is not None:
         p.scripts.process(p)
+    if getattr(p, 'recovery', None) is None:
+        p.recovery = processing_recovery.Recovery(p)
     infotexts = []
     output_images = []
     cached_uc = [None, None]
@@ -631,7 +718,7 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
         if cache[0] is not None and (required_prompts, steps) == cache[0]:
             return cache[1]
         with devices.autocast():
-            cache[1] = function(shared.sd_model, required_prompts, steps)
+            cache[1] = p.recovery.encode(function, shared.sd_model, required_prompts, steps)
         cache[0] = (required_prompts, steps)
         return cache[1]
 
@@ -684,8 +771,10 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
                     for comment in model_hijack.comments:
                         comments[comment] = 1
                 with devices.without_autocast() if devices.unet_needs_upcast else devices.autocast():
-                    samples_ddim = p.sample(conditioning=c, unconditional_conditioning=uc, seeds=p.seeds, subseeds=p.subseeds, subseed_strength=p.subseed_strength, prompts=p.prompts)
-                x_samples_ddim = [decode_first_stage(p.sd_model, samples_ddim[i:i+1].to(dtype=devices.dtype_vae))[0].cpu() for i in range(samples_ddim.size(0))]
+                    samples_ddim = p.recovery.sample(c, uc)
+                if samples_ddim is None: # out of memory even after degrading, keep images from previous batches
+                    break
+                x_samples_ddim = p.recovery.decode(samples_ddim)
                 try:
                     for x in x_samples_ddim:
                         devices.test_for_nans(x, "vae")
@@ -705,8 +794,9 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
                 del samples_ddim
 
             elif shared.backend == shared.Backend.DIFFUSERS:
-                from modules.processing_diffusers import process_diffusers
-                x_samples_ddim = process_diffusers(p, p.seeds, p.prompts, p.negative_prompts)
+                x_samples_ddim = p.recovery.diffusers()
+                if x_samples_ddim is None:
+                    break
 
             else:
                 raise ValueError(f"Unknown backend {shared.backend}")
@@ -726,6 +816,7 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
             def infotext(index=0):
                 return create_infotext(p, p.prompts, p.seeds, p.subseeds, index=index, all_negative_prompts=p.negative_prompts)
 
+            batch_images = []
             for i, x_sample in enumerate(x_samples_ddim):
                 p.batch_index = i
                 if shared.backend == shared.Backend.ORIGINAL:
@@ -747,26 +838,34 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
                     pp = scripts.PostprocessImageArgs(image)
                     p.scripts.postprocess_image(p, pp)
                     image = pp.image
-                if p.color_corrections is not None and i < len(p.color_corrections):
-                    if shared.opts.save and not p.do_not_save_samples and shared.opts.save_images_before_color_correction:
-                        orig = p.color_corrections
-                        p.color_corrections = None
-                        info = infotext(i)
-                        p.color_corrections = orig
-                        image_without_cc = apply_overlay(image, p.paste_to, i, p.overlay_images)
-                        images.save_image(image_without_cc, path=p.outpath_samples, basename="", seed=p.seeds[i], prompt=p.prompts[i], extension=shared.opts.samples_format, info=info, p=p, suffix="-before-color-correction")
-                    p.ops.append('color')
-                    image = apply_color_correction(p.color_corrections[i], image)
-                image = apply_overlay(image, p.paste_to, i, p.overlay_images)
+                batch_images.append(image)
+
+            # color correction and overlay paste-back run on device for whole batch
+            corrected = min(len(batch_images), len(p.color_corrections)) if p.color_corrections is not None else 0
+            if corrected > 0:
+                if shared.opts.save and not p.do_not_save_samples and shared.opts.save_images_before_color_correction:
+                    orig = p.color_corrections
+                    p.color_corrections = None
+                    for i, image_without_cc in enumerate(apply_overlays(batch_images[:corrected], p.paste_to, 0, p.overlay_images)):
+                        images.save_image(image_without_cc, path=p.outpath_samples, basename="", seed=p.seeds[i], prompt=p.prompts[i], extension=shared.opts.samples_format, info=infotext(i), p=p, suffix="-before-color-correction")
+                    p.color_corrections = orig
+                p.ops.append('color')
+                batch_images[:corrected] = apply_color_corrections(p.color_corrections[:corrected], batch_images[:corrected])
+            batch_images = apply_overlays(batch_images, p.paste_to, 0, p.overlay_images)
+            mask_composites = []
+            if hasattr(p, 'mask_for_overlay') and p.mask_for_overlay and any([shared.opts.save_mask, shared.opts.save_mask_composite, shared.opts.return_mask, shared.opts.return_mask_composite]) and len(batch_images) > 0:
+                image_mask = p.mask_for_overlay.convert('RGB')
+                mask_composites = processing_correction.mask_composite(batch_images, images.resize_image(3, p.mask_for_overlay, batch_images[0].width, batch_images[0].height).convert('L'))
+
+            for i, image in enumerate(batch_images):
                 if shared.opts.samples_save and not p.do_not_save_samples:
                     images.save_image(image, p.outpath_samples, "", p.seeds[i], p.prompts[i], shared.opts.samples_format, info=infotext(i), p=p)
                 text = infotext(i)
                 infotexts.append(text)
                 image.info["parameters"] = text
                 output_images.append(image)
-                if hasattr(p, 'mask_for_overlay') and p.mask_for_overlay and any([shared.opts.save_mask, shared.opts.save_mask_composite, shared.opts.return_mask, shared.opts.return_mask_composite]):
-                    image_mask = p.mask_for_overlay.convert('RGB')
-                    image_mask_composite = Image.composite(image.convert('RGBA').convert('RGBa'), Image.new('RGBa', image.size), images.resize_image(3, p.mask_for_overlay, image.width, image.height).convert('L')).convert('RGBA')
+                if len(mask_composites) > 0:
+                    image_mask_composite = mask_composites[i]
                     if shared.opts.save_mask:
                         images.save_image(image_mask, p.outpath_samples, "", p.seeds[i], p.prompts[i], shared.opts.samples_format, info=infotext(i), p=p, suffix="-mask")
                     if shared.opts.save_mask_composite:
@@ -785,14 +884,16 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
         if (shared.opts.return_grid or shared.opts.grid_save) and not p.do_not_save_grid and not unwanted_grid_because_of_img_count:
             if images.check_grid_size(output_images):
                 grid = images.image_grid(output_images, p.batch_size)
-                if shared.opts.return_grid:
-                    text = infotext()
-                    infotexts.insert(0, text)
-                    grid.info["parameters"] = text
-                    output_images.insert(0, grid)
-                    index_of_first_image = 1
-                if shared.opts.grid_save:
-                    images.save_image(grid, p.outpath_grids, "grid", p.all_seeds[0], p.all_prompts[0], shared.opts.grid_format, info=infotext(), short_filename=not shared.opts.grid_extended_filename, p=p, grid=True)
+            else: # too large to compose in memory, preview is returned and full grid is written on save
+                grid = images.GridStream(output_images, batch_size=p.batch_size).preview()
+            if shared.opts.return_grid:
+                text = infotext()
+                infotexts.insert(0, text)
+                grid.info["parameters"] = text
+                output_images.insert(0, grid)
+                index_of_first_image = 1
+            if shared.opts.grid_save:
+                images.save_image(grid, p.outpath_grids, "grid", p.all_seeds[0], p.all_prompts[0], shared.opts.grid_format, info=infotext(), short_filename=not shared.opts.grid_extended_filename, p=p, grid=True)
 
     if not p.disable_extra_networks and extra_network_data:
         extra_networks.deactivate(p, extra_network_data)
@@ -1070,10 +1171,9 @@ class StableDiffusionProcessingImg2Img(StableDiffusionProcessing):
                 self.width = image.width
                 self.height = image.height
             if image_mask is not None:
-                image_masked = Image.new('RGBa', (image.width, image.height))
-                image_masked.paste(image.convert("RGBA").convert("RGBa"), mask=ImageOps.invert(self.mask_for_overlay.convert('L')) if self.mask_for_overlay is not None else None)
+                image_masked = processing_correction.mask_composite([image], ImageOps.invert(self.mask_for_overlay.convert('L')))[0] if self.mask_for_overlay is not None else image.convert('RGBA')
                 self.mask = image_mask # assign early for diffusers
-                self.overlay_images.append(image_masked.convert('RGBA'))
+                self.overlay_images.append(image_masked)
             # crop_region is not None if we are doing inpaint full res
             if crop_region is not None:
                 image = image.crop(crop_region)
@@ -1108,7 +1208,7 @@ class StableDiffusionProcessingImg2Img(StableDiffusionProcessing):
         image = torch.from_numpy(batch_images)
         image = 2. * image - 1.
         image = image.to(device=shared.device, dtype=devices.dtype_vae)
-        self.init_latent = self.sd_model.get_first_stage_encoding(self.sd_model.encode_first_stage(image))
+        self.init_latent = encode_first_stage(self.sd_model, image)
         if self.resize_mode == 4:
             self.init_latent = torch.nn.functional.interpolate(self.init_latent, size=(self.height // opt_f, self.width // opt_f), mode="bilinear")
         if image_mask is not None:
@@ -0,0 +1,175 @@
+import time
+from copy import copy
+from itertools import pairwise
+from modules import shared, processing, sd_vae
+from modules.result_cache import canonical, NotCacheable
+
+
+# fields that can differ between images of the same batch
+item_params = ['prompt', 'negative_prompt', 'styles', 'seed', 'subseed', 'init_images', 'color_corrections']
+# runtime state that does not decide whether jobs can share a batch
+ignored_params = ['sd_model', 'scripts', 'sampler', 'recovery', 'result_cache_key', 'extra_generation_params', 'job_timestamp', 'comments', 'ops', 'iteration', 'is_hr_pass', 'per_script_args']
+
+
+def batchable(p):
+    if p.batch_size != 1 or p.n_iter != 1 or not isinstance(p.prompt, str) or isinstance(p.seed, list):
+        return False
+    if len(getattr(p, 'init_images', None) or []) > 1 or len(getattr(p, 'color_corrections', None) or []) > 1:
+        return False
+    return not shared.opts.return_mask and not shared.opts.return_mask_composite
+
+
+def batch_key(p):
+    """jobs with identical key differ only in per-image fields and can run as one batch"""
+    res = []
+    for k, v in sorted(vars(p).items()):
+        if k in item_params or k in ignored_params:
+            continue
+        try:
+            res.append((k, repr(canonical(v))))
+        except NotCacheable:
+            res.append((k, id(v)))
+    return tuple(res)
+
+
+def merge(jobs):
+    """single job with per-image prompts, negative prompts and seeds; styles are applied upfront since they can differ per job"""
+    first = jobs[0]
+    p = copy(first)
+    p.override_settings = copy(first.override_settings)
+    p.extra_generation_params = copy(first.extra_generation_params)
+    p.prompt = [shared.prompt_styles.apply_styles_to_prompt(j.prompt, j.styles) for j in jobs]
+    p.negative_prompt = [shared.prompt_styles.apply_negative_styles_to_prompt(j.negative_prompt, j.styles) for j in jobs]
+    p.styles = []
+    p.seed = [int(processing.get_fixed_seed(j.seed)) for j in jobs]
+    p.subseed = [int(processing.get_fixed_seed(j.subseed)) for j in jobs]
+    if len(getattr(first, 'init_images', None) or []) > 0:
+        p.init_images = [j.init_images[0] for j in jobs]
+    if all(len(getattr(j, 'color_corrections', None) or []) == 1 for j in jobs):
+        p.color_corrections = [j.color_corrections[0] for j in jobs]
+    p.batch_size = len(jobs)
+    p.n_iter = 1
+    p.do_not_save_grid = True
+    return p
+
+
+def split(processed, count):
+    """per-job results from a merged job, in same form as if each job was processed on its own"""
+    res = []
+    for i in range(count):
+        r = copy(processed)
+        idx = processed.index_of_first_image + i
+        r.images = processed.images[idx:idx+1]
+        r.infotexts = processed.infotexts[idx:idx+1]
+        r.info = r.infotexts[0] if len(r.infotexts) > 0 else ''
+        r.index_of_first_image = 0
+        r.batch_size = 1
+        for field in ['prompt', 'negative_prompt', 'seed', 'subseed']:
+            values = getattr(processed, f'all_{field}s')
+            value = values[i] if i < len(values) else getattr(processed, field)
+            setattr(r, field, value)
+            setattr(r, f'all_{field}s', [value])
+        res.append(r)
+    return res
+
+
+def join(p, results):
+    """single result with images of all jobs in job order"""
+    results = [r for r in results if r is not None]
+    images, infotexts, all_prompts, all_negative_prompts, all_seeds, all_subseeds = [], [], [], [], [], []
+    for r in results:
+        images += r.images
+        infotexts += r.infotexts
+        all_prompts += r.all_prompts
+        all_negative_prompts += r.all_negative_prompts
+        all_seeds += r.all_seeds
+        all_subseeds += r.all_subseeds
+    if len(results) == 0:
+        return processing.Processed(p, [], p.seed, '')
+    return processing.Processed(p, images, seed=results[0].seed, info=results[0].info, subseed=results[0].subseed, all_prompts=all_prompts, all_negative_prompts=all_negative_prompts, all_seeds=all_seeds, all_subseeds=all_subseeds, infotexts=infotexts)
+
+
+def create_jobs(p, params):
+    """copy of job for each parameter set"""
+    jobs = []
+    for args in params:
+        pc = copy(p)
+        pc.styles = p.styles[:]
+        pc.override_settings = copy(p.override_settings)
+        for k, v in args.items():
+            setattr(pc, k, v)
+        jobs.append(pc)
+    return jobs
+
+
+def switches(keys):
+    return sum(1 for a, b in pairwise(keys) if a != b)
+
+
+def loaded_models():
+    checkpoint_info = getattr(shared.sd_model, 'sd_checkpoint_info', None)
+    return (checkpoint_info.title if checkpoint_info is not None else None, sd_vae.loaded_vae_file)
+
+
+class JobList:
+    """
+    runs list of jobs grouping compatible ones into batches
+    - groups are per-job keys of settings that are expensive to change such as model or vae, batches are ordered so each group runs once
+    - jobs with identical settings apart from prompts, seeds and styles run as single batch of up to max_batch images
+    - results are returned in original job order
+    """
+
+    def __init__(self, jobs, groups=None, max_batch=0):
+        self.jobs = jobs
+        self.groups = groups if groups is not None else [()] * len(jobs)
+        self.max_batch = max_batch
+        self.batches = self.plan()
+        self.actual = {}
+
+    def plan(self):
+        buckets = {}
+        for i, p in enumerate(self.jobs):
+            key = (self.groups[i], batch_key(p) if batchable(p) else i)
+            buckets.setdefault(key, []).append(i)
+        keys = sorted(buckets.keys(), key=lambda k: k[0]) # stable so jobs within same group keep original order
+        batches = []
+        for key in keys:
+            indexes = buckets[key]
+            size = self.max_batch if self.max_batch > 0 else shared.opts.batch_jobs_max
+            batches += [indexes[i:i+size] for i in range(0, len(indexes), size)]
+        return batches
+
+    def planned(self):
+        return {
+            'jobs': len(self.jobs),
+            'batches': len(self.batches),
+            'switches': switches([self.groups[b[0]] for b in self.batches]),
+            'unplanned switches': switches(self.groups),
+            'steps': sum(p.steps for p in self.jobs),
+        }
+
+    def execute(self, prepare=None):
+        """prepare(p, indexes) is called for each batch before processing to apply settings with side effects"""
+        results = [None] * len(self.jobs)
+        t0 = time.time()
+        models = loaded_models()
+        self.actual = { 'batches': 0, 'switches': 0, 'images': 0, 'time': 0 }
+        shared.log.info(f'Job list: planned={self.planned()}')
+        for n, indexes in enumerate(self.batches):
+            if shared.state.interrupted:
+                break
+            shared.state.job = f'Batch {n + 1} out of {len(self.batches)}'
+            p = self.jobs[indexes[0]] if len(indexes) == 1 else merge([self.jobs[i] for i in indexes])
+            if prepare is not None:
+                prepare(p, indexes)
+            processed = processing.process_images(p)
+            if loaded_models() != models:
+                models = loaded_models()
+                self.actual['switches'] += 1
+            for i, res in zip(indexes, [processed] if len(indexes) == 1 else split(processed, len(indexes))):
+                results[i] = res
+                self.actual['images'] += len(res.images)
+            self.actual['batches'] += 1
+        self.actual['time'] = round(time.time() - t0, 2)
+        shared.log.info(f'Job list: actual={self.actual}')
+        return results
@@ -0,0 +1,138 @@
+import numpy as np
+import torch
+from PIL import Image
+from modules import devices
+
+
+# srgb d65 conversion matrices and white point as used by opencv
+rgb_to_xyz = torch.tensor([[0.412453, 0.357580, 0.180423], [0.212671, 0.715160, 0.072169], [0.019334, 0.119193, 0.950227]])
+xyz_to_rgb = torch.linalg.inv(rgb_to_xyz)
+white = torch.tensor([0.950456, 1.0, 1.088754])
+luminosity_weights = torch.tensor([0.3, 0.59, 0.11])
+epsilon = 1e-6
+
+
+def to_tensor(images, mode='RGB'):
+    """pil images of same size as float tensor in range 0-1 on active device"""
+    x = np.stack([np.asarray(image.convert(mode) if image.mode != mode else image) for image in images])
+    x = torch.from_numpy(x.reshape(x.shape[:3] + (-1,))).to(devices.device)
+    return x.permute(0, 3, 1, 2).float() / 255.0
+
+
+def to_images(x, mode='RGB'):
+    x = (x.clamp(0, 1) * 255.0).round().to(torch.uint8).permute(0, 2, 3, 1).cpu().numpy()
+    return [Image.fromarray(i[:, :, 0] if mode == 'L' else i, mode) for i in x]
+
+
+def matmul(matrix, x):
+    return torch.einsum('ij,njhw->nihw', matrix.to(x.device), x)
+
+
+def rgb_to_lab(x):
+    """srgb to lab scaled to 8-bit range same as opencv: l*255/100, a+128, b+128"""
+    x = torch.where(x <= 0.04045, x / 12.92, ((x + 0.055) / 1.055) ** 2.4)
+    x = matmul(rgb_to_xyz, x) / white.to(x.device).view(1, 3, 1, 1)
+    f = torch.where(x > 0.008856, x.clamp(min=epsilon) ** (1 / 3), 7.787 * x + 16 / 116)
+    return torch.stack([(116 * f[:, 1] - 16) * 255 / 100, 500 * (f[:, 0] - f[:, 1]) + 128, 200 * (f[:, 1] - f[:, 2]) + 128], dim=1)
+
+
+def lab_to_rgb(x):
+    fy = (x[:, 0] * 100 / 255 + 16) / 116
+    f = torch.stack([fy + (x[:, 1] - 128) / 500, fy, fy - (x[:, 2] - 128) / 200], dim=1)
+    x = torch.where(f ** 3 > 0.008856, f ** 3, (f - 16 / 116) / 7.787) * white.to(x.device).view(1, 3, 1, 1)
+    x = matmul(xyz_to_rgb, x).clamp(min=0)
+    return torch.where(x <= 0.0031308, 12.92 * x, 1.055 * x ** (1 / 2.4) - 0.055).clamp(0, 1)
+
+
+def lab(image):
+    """8-bit lab of image, used as color correction target"""
+    return (rgb_to_lab(to_tensor([image])).round().clamp(0, 255).to(torch.uint8)[0].permute(1, 2, 0).cpu().numpy())
+
+
+def histograms(x):
+    """per image and channel counts of 8-bit values"""
+    n, c = x.shape[:2]
+    offsets = torch.arange(n * c, device=x.device).view(n, c, 1) * 256
+    return torch.bincount((x.reshape(n, c, -1) + offsets).flatten(), minlength=n * c * 256).view(n, c, 256).float()
+
+
+def match_histograms(source, template):
+    """
+    maps 8-bit values of each channel so their distribution matches template, same as skimage match_histograms
+    - lookup tables for whole batch are built from cumulative histograms with a single interpolation
+    - source quantiles are interpolated between neighbouring template values that are present in template
+    """
+    source_cdf = histograms(source).cumsum(-1)
+    source_cdf = source_cdf / source_cdf[..., -1:]
+    counts = histograms(template)
+    template_cdf = counts.cumsum(-1)
+    template_cdf = template_cdf / template_cdf[..., -1:]
+    bins = torch.arange(256, device=source.device).expand_as(counts)
+    hi = torch.searchsorted(template_cdf.contiguous(), source_cdf.contiguous()).clamp(max=255) # first template value with quantile not below source quantile
+    present = torch.where(counts > 0, bins, torch.full_like(bins, -1)).cummax(-1).values
+    lo = torch.where(hi > 0, present.gather(-1, (hi - 1).clamp(min=0)), torch.full_like(hi, -1)) # previous template value that is present
+    cdf_hi = template_cdf.gather(-1, hi)
+    cdf_lo = torch.where(lo >= 0, template_cdf.gather(-1, lo.clamp(min=0)), torch.zeros_like(cdf_hi))
+    lut = torch.where(lo >= 0, lo + (source_cdf - cdf_lo) / (cdf_hi - cdf_lo).clamp(min=epsilon) * (hi - lo), hi.float())
+    return lut.gather(-1, source.reshape(source.shape[0], source.shape[1], -1)).view(source.shape)
+
+
+def luminosity(x):
+    return (x * luminosity_weights.to(x.device).view(1, 3, 1, 1)).sum(dim=1, keepdim=True)
+
+
+def set_luminosity(color, source):
+    """luminosity blend mode: hue and saturation of color with luminosity of source, clipped to valid range"""
+    x = color + luminosity(source) - luminosity(color)
+    lum, lo, hi = luminosity(x), x.amin(dim=1, keepdim=True), x.amax(dim=1, keepdim=True)
+    x = torch.where(lo < 0, lum + (x - lum) * lum / (lum - lo).clamp(min=epsilon), x)
+    x = torch.where(hi > 1, lum + (x - lum) * (1 - lum) / (hi - lum).clamp(min=epsilon), x)
+    return x
+
+
+def color_correct(images, corrections):
+    """match colors of images to their correction targets in lab space while keeping luminosity of images"""
+    if len({c.shape for c in corrections}) > 1 or len({image.size for image in images}) > 1: # scripts can change size of individual images
+        return [color_correct([image], [correction])[0] for image, correction in zip(images, corrections)]
+    with torch.no_grad():
+        rgb = to_tensor(images)
+        template = torch.from_numpy(np.stack(corrections)).to(devices.device).permute(0, 3, 1, 2).long()
+        source = rgb_to_lab(rgb).round().clamp(0, 255).long()
+        corrected = lab_to_rgb(match_histograms(source, template))
+        return to_images(set_luminosity(corrected, rgb))
+
+
+def mask_composite(images, mask):
+    """images with mask as alpha, color of fully transparent pixels is cleared same as premultiplied pil composite"""
+    if any(image.size != mask.size for image in images):
+        return [mask_composite([image], mask.resize(image.size))[0] for image in images]
+    with torch.no_grad():
+        rgb = to_tensor(images)
+        alpha = to_tensor([mask], 'L').expand(rgb.shape[0], -1, -1, -1)
+        return to_images(torch.cat([rgb * (alpha > 0), alpha], dim=1), 'RGBA')
+
+
+def composite_overlays(images, overlays, paste_loc=None):
+    """
+    paste images back under rgba overlays
+    - with paste_loc images are placed on transparent canvas of overlay size first, as used by inpaint full resolution
+    - result is overlay alpha composited over images
+    """
+    if len({image.size for image in images}) > 1 or len({overlay.size for overlay in overlays}) > 1:
+        return [composite_overlays([image], [overlay], paste_loc)[0] for image, overlay in zip(images, overlays)]
+    with torch.no_grad():
+        rgb = to_tensor(images)
+        overlay = to_tensor(overlays, 'RGBA')
+        n, _c, h, w = overlay.shape
+        if paste_loc is not None:
+            x, y = paste_loc[0], paste_loc[1]
+            ph, pw = min(rgb.shape[2], h - y), min(rgb.shape[3], w - x)
+            base = torch.zeros((n, 4, h, w), device=rgb.device)
+            base[:, :3, y:y+ph, x:x+pw] = rgb[:, :, :ph, :pw]
+            base[:, 3, y:y+ph, x:x+pw] = 1
+        else:
+            base = torch.cat([rgb, torch.ones_like(rgb[:, :1])], dim=1)
+        alpha, base_alpha = overlay[:, 3:], base[:, 3:] * (1 - overlay[:, 3:])
+        total = alpha + base_alpha
+        res = (overlay[:, :3] * alpha + base[:, :3] * base_alpha) / total.clamp(min=epsilon)
+        return to_images(torch.where(total > 0, res, torch.zeros_like(res)))
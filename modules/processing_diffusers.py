@@ -1,3 +1,4 @@
+import time
 import inspect
 import typing
 import torch
@@ -19,6 +20,18 @@ except Exception as ex:
     shared.log.error(f'Failed to import diffusers: {ex}')
 
 
+tome_step_times = {} # (pipeline, hash, pass, width, height, batch, ratio, schedule) -> average seconds per step
+
+
+def scheduled_token_merging_ratio(ratio, step, steps):
+    """full ratio until late start, then linearly reduced to zero at last step since late steps refine detail"""
+    start = shared.opts.token_merging_late_start
+    progress = min(1.0, step / max(1, steps))
+    if start >= 1 or progress < start:
+        return ratio
+    return ratio * max(0.0, 1.0 - (progress - start) / (1.0 - start))
+
+
 def process_diffusers(p: StableDiffusionProcessing, seeds, prompts, negative_prompts):
     results = []
     if p.enable_hr and p.hr_upscaler != 'None' and p.denoising_strength > 0 and len(getattr(p, 'init_images', [])) == 0:
@@ -46,7 +59,39 @@ def process_diffusers(p: StableDiffusionProcessing, seeds, prompts, negative_pro
             for i in range(len(decoded)):
                 images.save_image(decoded[i], path=p.outpath_samples, basename="", seed=seeds[i], prompt=prompts[i], extension=shared.opts.samples_format, info=info, p=p, suffix=suffix)
 
-    def diffusers_callback(_step: int, _timestep: int, latents: torch.FloatTensor):
+    tome = { 'ratio': 0, 'steps': 0, 'last': 0, 'times': [] }
+
+    def tome_start(ratio, steps):
+        if not shared.opts.cuda_compile:
+            sd_models.apply_token_merging(shared.sd_model, ratio)
+        sd_models.set_token_merging_ratio(shared.sd_model, ratio) # apply returns early for same ratio and would keep ratio decayed by previous pass
+        tome.update(ratio=getattr(shared.sd_model, 'applied_token_merged_ratio', 0), steps=steps, last=time.time(), times=[])
+
+    def tome_step(step):
+        now = time.time()
+        if step > 0: # first interval includes prompt encode and setup
+            tome['times'].append(now - tome['last'])
+        tome['last'] = now
+        if tome['ratio'] > 0 and shared.opts.token_merging_late_start < 1:
+            sd_models.set_token_merging_ratio(shared.sd_model, scheduled_token_merging_ratio(tome['ratio'], step + 1, tome['steps']))
+
+    def tome_finish(name):
+        if len(tome['times']) == 0:
+            return
+        step_time = sum(tome['times']) / len(tome['times'])
+        width, height = (getattr(p, 'hr_upscale_to_x', p.width), getattr(p, 'hr_upscale_to_y', p.height)) if name == 'hires' else (p.width, p.height)
+        key = (shared.sd_model.__class__.__name__, getattr(shared.sd_model, 'sd_model_hash', None), name, width, height, len(prompts)) # hires pass only compares to hires pass at same resolution
+        schedule = shared.opts.token_merging_late_start if tome['ratio'] > 0 else 1
+        tome_step_times[(*key, tome['ratio'], schedule)] = step_time
+        baseline = tome_step_times.get((*key, 0, 1), None)
+        if tome['ratio'] > 0:
+            speedup = baseline / step_time if baseline is not None and step_time > 0 else None
+            shared.log.debug(f'Token merging: pass={name} ratio={tome["ratio"]} schedule={schedule} step={step_time:.3f}s baseline={baseline if baseline is None else round(baseline, 3)} speedup={speedup if speedup is None else round(speedup, 2)}')
+            p.extra_generation_params[f'Token merging speedup{" hr" if name == "hires" else ""}'] = f'{speedup:.2f}x' if speedup is not None else None
+            p.extra_generation_params['Token merging schedule'] = schedule if schedule < 1 else None
+
+    def diffusers_callback(step: int, _timestep: int, latents: torch.FloatTensor):
+        tome_step(step)
         shared.state.sampling_step += 1
         shared.state.sampling_steps = p.steps
         if p.is_hr_pass:
@@ -250,7 +295,10 @@ def process_diffusers(p: StableDiffusionProcessing, seeds, prompts, negative_pro
     )
     p.extra_generation_params['CFG rescale'] = p.diffusers_guidance_rescale
     p.extra_generation_params["Eta DDIM"] = shared.opts.eta_ddim if shared.opts.eta_ddim is not None and shared.opts.eta_ddim > 0 else None
+    is_txt2img = sd_models.get_diffusers_task(shared.sd_model) == sd_models.DiffusersTaskType.TEXT_2_IMAGE
+    tome_start(p.get_token_merging_ratio(), p.steps if is_txt2img else int(p.steps * p.denoising_strength))
     output = shared.sd_model(**base_args) # pylint: disable=not-callable
+    tome_finish('base')
 
     if lora_state['active']:
         p.extra_generation_params['LoRA method'] = shared.opts.diffusers_lora_loader
@@ -283,7 +331,10 @@ def process_diffusers(p: StableDiffusionProcessing, seeds, prompts, negative_pro
                 strength=p.denoising_strength,
                 desc='Hires',
             )
+            tome_start(p.get_token_merging_ratio(for_hr=True), int((p.hr_second_pass_steps or p.steps) * p.denoising_strength))
             output = shared.sd_model(**hires_args) # pylint: disable=not-callable
+            tome_finish('hires')
+            tome_start(p.get_token_merging_ratio(), 0)
 
     # optional refiner pass or decode
     if is_refiner_enabled:
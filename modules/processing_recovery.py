@@ -0,0 +1,250 @@
+import torch
+from modules import shared, devices
+
+
+min_upscale_tile = 64
+sliced = ['init_images', 'init_latent', 'image_conditioning'] # job fields cut down to sub-batch
+
+
+def is_oom(e):
+    oom_error = getattr(torch.cuda, 'OutOfMemoryError', None)
+    if oom_error is not None and isinstance(e, oom_error):
+        return True
+    return isinstance(e, RuntimeError) and 'out of memory' in str(e).lower()
+
+
+def free():
+    devices.torch_gc(force=True)
+
+
+def combine(a, b):
+    """join results of two halves of a split text encode"""
+    from modules.prompt_parser import MulticondLearnedConditioning
+    if isinstance(a, MulticondLearnedConditioning):
+        return MulticondLearnedConditioning(shape=(len(a.batch) + len(b.batch),), batch=a.batch + b.batch)
+    return a + b
+
+
+def slice_cond(c, start, end):
+    from modules.prompt_parser import MulticondLearnedConditioning
+    if isinstance(c, MulticondLearnedConditioning):
+        return MulticondLearnedConditioning(shape=(end - start,), batch=c.batch[start:end])
+    return c[start:end]
+
+
+class Recovery:
+    """
+    catches out-of-memory errors at stage boundaries of a job and retries the failed stage with cheaper settings
+    - text encode: free memory and split prompts
+    - sampling: smaller sub-batches keeping completed ones, then lean attention
+    - vae decode: tiled decode, then vae on cpu
+    degradation path is recorded in infotext and all changes are reverted when job ends
+    """
+
+    def __init__(self, p):
+        self.p = p
+        self.path = []
+        self.lean = False
+        self.tiled = False
+        self.cpu_vae = False
+        self.vae_dtype = None
+        p.extra_generation_params.pop('OOM recovery', None)
+
+    @property
+    def enabled(self):
+        return shared.opts.oom_recovery
+
+    def record(self, stage, action):
+        self.path.append(f'{stage}:{action}')
+        self.p.extra_generation_params['OOM recovery'] = ' '.join(self.path)
+        shared.log.warning(f'OOM recovery: stage={stage} action={action}')
+
+    def handle(self, e):
+        if not self.enabled or not is_oom(e):
+            raise e
+        free()
+
+    def encode(self, function, model, prompts, steps):
+        try:
+            return function(model, prompts, steps)
+        except Exception as e:
+            self.handle(e)
+        if len(prompts) < 2:
+            self.record('encode', 'retry')
+            return function(model, prompts, steps)
+        half = len(prompts) // 2
+        self.record('encode', f'split={len(prompts)}')
+        return combine(self.encode(function, model, prompts[:half], steps), self.encode(function, model, prompts[half:], steps))
+
+    def snapshot(self):
+        return { k: getattr(self.p, k, None) for k in ['width', 'height', 'is_hr_pass', 'init_images', 'init_latent', 'image_conditioning'] }
+
+    def apply(self, state):
+        for k, v in state.items():
+            setattr(self.p, k, v)
+
+    def select(self, state, start, end, total):
+        """set job to a sub-batch; per-image tensors and lists are sliced, shared ones are left as is"""
+        p = self.p
+        p.prompts, p.negative_prompts = p.prompts[start:end], p.negative_prompts[start:end]
+        p.seeds, p.subseeds = p.seeds[start:end], p.subseeds[start:end]
+        for k in ['init_latent', 'image_conditioning']:
+            if isinstance(state[k], torch.Tensor) and state[k].shape[0] == total:
+                setattr(p, k, state[k][start:end])
+        if isinstance(state['init_images'], list) and len(state['init_images']) >= end and len(state['init_images']) > 1:
+            p.init_images = state['init_images'][start:end]
+
+    def degrade(self, stage, size):
+        """returns next sub-batch size or None if nothing cheaper is left to try"""
+        if size > 1:
+            size = size // 2
+            self.record(stage, f'batch={size}')
+            return size
+        if not self.lean:
+            self.set_lean()
+            self.record(stage, 'attention=lean')
+            return size
+        if shared.backend == shared.Backend.DIFFUSERS and not self.tiled and hasattr(shared.sd_model, 'enable_vae_tiling'):
+            self.tiled = True
+            shared.sd_model.enable_vae_tiling()
+            self.record(stage, 'vae=tiled')
+            return size
+        return None
+
+    def run(self, stage, fn, join):
+        """run fn over current batch in progressively smaller sub-batches, completed sub-batches are kept"""
+        p = self.p
+        batch = (p.prompts, p.negative_prompts, p.seeds, p.subseeds)
+        total = len(p.seeds)
+        state = self.snapshot()
+        done = []
+        start = 0
+        size = total
+        try:
+            while start < total and not shared.state.interrupted:
+                end = min(start + size, total)
+                if start > 0 or end < total:
+                    self.select(state, start, end, total)
+                try:
+                    done.append(fn(start, end))
+                    start = end
+                    if start < total:
+                        self.apply(state)
+                except Exception as e:
+                    self.apply(state)
+                    self.handle(e)
+                    size = self.degrade(stage, size)
+                    if size is None:
+                        if len(done) == 0 and p.iteration == 0:
+                            raise e
+                        self.record(stage, f'incomplete={start}/{total}')
+                        break
+                finally:
+                    p.prompts, p.negative_prompts, p.seeds, p.subseeds = batch
+        finally:
+            p.prompts, p.negative_prompts, p.seeds, p.subseeds = batch
+            for k in sliced: # last sub-batch leaves them cut down which breaks next iteration
+                setattr(p, k, state[k])
+        if len(done) == 0:
+            return None
+        return done[0] if len(done) == 1 else join(done)
+
+    def sample(self, c, uc):
+        p = self.p
+        total = len(p.seeds)
+
+        def fn(start, end):
+            conditioning = c if start == 0 and end == total else slice_cond(c, start, end)
+            unconditional_conditioning = uc if start == 0 and end == total else uc[start:end]
+            return p.sample(conditioning=conditioning, unconditional_conditioning=unconditional_conditioning, seeds=p.seeds, subseeds=p.subseeds, subseed_strength=p.subseed_strength, prompts=p.prompts)
+
+        return self.run('sample', fn, torch.cat)
+
+    def diffusers(self):
+        from modules.processing_diffusers import process_diffusers
+        p = self.p
+
+        def fn(_start, _end):
+            return process_diffusers(p, p.seeds, p.prompts, p.negative_prompts)
+
+        return self.run('sample', fn, lambda done: [x for results in done for x in results])
+
+    def decode(self, samples):
+        """decode one image at a time, degrading to tiled decode and then cpu decode on oom"""
+        from modules.processing import decode_first_stage, decode_first_stage_tiled
+        model = self.p.sd_model
+        res = []
+        for i in range(samples.size(0)):
+            x = samples[i:i+1].to(dtype=devices.dtype_vae)
+            while True:
+                try:
+                    if self.cpu_vae:
+                        res.append(self.decode_cpu(x)[0])
+                    elif self.tiled:
+                        with devices.autocast(disable=x.dtype == devices.dtype_vae):
+                            res.append(decode_first_stage_tiled(model, x)[0].cpu())
+                    else:
+                        res.append(decode_first_stage(model, x)[0].cpu())
+                    break
+                except Exception as e:
+                    self.handle(e)
+                    if not self.tiled and not shared.opts.sd_vae_tiled_decode:
+                        self.tiled = True
+                        self.record('decode', 'vae=tiled')
+                    elif not self.cpu_vae and not shared.cmd_opts.lowvram and not shared.cmd_opts.medvram:
+                        self.cpu_vae = True
+                        self.record('decode', 'vae=cpu')
+                    elif len(res) > 0:
+                        self.record('decode', f'incomplete={len(res)}/{samples.size(0)}')
+                        return res
+                    else:
+                        raise e
+        return res
+
+    def decode_cpu(self, x):
+        model = self.p.sd_model
+        if self.vae_dtype is None:
+            self.vae_dtype = next(model.first_stage_model.parameters()).dtype
+            model.first_stage_model.to(devices.cpu, dtype=torch.float32)
+            free()
+        with devices.without_autocast():
+            return model.decode_first_stage(x.to(devices.cpu, dtype=torch.float32))
+
+    def set_lean(self):
+        self.lean = True
+        if shared.backend == shared.Backend.ORIGINAL:
+            import ldm.modules.attention
+            from modules import sd_hijack_optimizations
+            ldm.modules.attention.CrossAttention.forward = sd_hijack_optimizations.sub_quad_attention_forward
+        elif hasattr(shared.sd_model, 'enable_attention_slicing'):
+            shared.sd_model.enable_attention_slicing()
+
+    def restore(self):
+        if self.vae_dtype is not None:
+            self.p.sd_model.first_stage_model.to(devices.device, dtype=self.vae_dtype)
+            self.vae_dtype = None
+        if self.lean or (self.tiled and shared.backend == shared.Backend.DIFFUSERS):
+            from modules import memory_planner
+            memory_planner.set_model_options(False, False)
+        self.lean = self.tiled = self.cpu_vae = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.restore()
+
+
+def upscale(fn, img, selected_model):
+    """run upscaler, on oom retry with smaller tiles; tile size 0 means untiled so it is tiled first"""
+    tiles = { 'ESRGAN_tile': shared.opts.ESRGAN_tile, 'SCUNET_tile': shared.opts.SCUNET_tile }
+    while True:
+        try:
+            with shared.opts.overlay(tiles):
+                return fn(img, selected_model)
+        except Exception as e:
+            if not shared.opts.oom_recovery or not is_oom(e) or all(0 < v <= min_upscale_tile for v in tiles.values()):
+                raise
+            free()
+            tiles = { k: 256 if v == 0 else max(min_upscale_tile, v // 2) for k, v in tiles.items() }
+            shared.log.warning(f'OOM recovery: stage=upscale action=tile={tiles}')
@@ -0,0 +1,89 @@
+import torch
+from modules import shared
+
+
+def tile_starts(size, tile, overlap):
+    """start offsets of overlapping tiles covering size, last tile is aligned to the end"""
+    if size <= tile:
+        return [0]
+    stride = max(tile - overlap, 1)
+    res = list(range(0, size - tile + 1, stride))
+    if res[-1] + tile < size:
+        res.append(size - tile)
+    return res
+
+
+def repeat(t, k):
+    return torch.cat([t] * k) if isinstance(t, torch.Tensor) else t
+
+
+def ramp(size, length, start, end, device):
+    """weights that fade towards edges shared with a neighbouring tile"""
+    weight = torch.ones(size, device=device)
+    length = min(length, size // 2)
+    if length > 0 and start:
+        weight[:length] = torch.linspace(1 / (length + 1), 1, length, device=device)
+    if length > 0 and end:
+        weight[-length:] = torch.linspace(1, 1 / (length + 1), length, device=device)
+    return weight
+
+
+class TiledDenoiser:
+    """
+    runs every unet evaluation over full latent as batches of overlapping tiles, MultiDiffusion-style
+    - tiles are evaluated at tile size so model sees resolution it was trained for while sampler works on full latent
+    - outputs of overlapping tiles are blended with weights that fade towards tile edges on every step so tiles agree on overlaps and no seams are left
+    - original backend only since it replaces forward of ldm unet, both k-diffusion and compvis samplers call it
+    """
+
+    def __init__(self, tile_w, tile_h, overlap, batch_size=1):
+        self.tile_w = max(tile_w // 8, 1) # latent space
+        self.tile_h = max(tile_h // 8, 1)
+        self.overlap = max(overlap // 8, 0)
+        self.batch_size = max(batch_size, 1)
+        self.unet = None
+        self.original = None
+        self.patched = False
+        self.evaluations = 0
+
+    def tiles(self, h, w):
+        th, tw = min(self.tile_h, h), min(self.tile_w, w)
+        return [(y, x, th, tw) for y in tile_starts(h, th, self.overlap) for x in tile_starts(w, tw, self.overlap)]
+
+    def forward(self, x, timesteps=None, context=None, y=None, **kwargs):
+        _n, _c, h, w = x.shape
+        tiles = self.tiles(h, w)
+        if len(tiles) == 1:
+            return self.original(x, timesteps, context, y=y, **kwargs)
+        out = None
+        weights = torch.zeros((1, 1, h, w), device=x.device)
+        for i in range(0, len(tiles), self.batch_size):
+            batch = tiles[i:i+self.batch_size]
+            x_in = torch.cat([x[:, :, ty:ty+th, tx:tx+tw] for ty, tx, th, tw in batch]) # tile-major so each tile keeps cond and uncond together
+            res = self.original(x_in, repeat(timesteps, len(batch)), repeat(context, len(batch)), y=repeat(y, len(batch)), **kwargs)
+            if out is None:
+                out = torch.zeros((x.shape[0], res.shape[1], h, w), device=x.device)
+            for j, (ty, tx, th, tw) in enumerate(batch):
+                mask = ramp(th, self.overlap, ty > 0, ty + th < h, x.device)[:, None] * ramp(tw, self.overlap, tx > 0, tx + tw < w, x.device)[None, :]
+                out[:, :, ty:ty+th, tx:tx+tw] += res[j * x.shape[0]:(j + 1) * x.shape[0]].float() * mask
+                weights[:, :, ty:ty+th, tx:tx+tw] += mask
+            del res, x_in
+            self.evaluations += 1
+        return (out / weights).to(x.dtype)
+
+    def __enter__(self):
+        self.unet = shared.sd_model.model.diffusion_model
+        self.patched = 'forward' in self.unet.__dict__ # already replaced by something else, put it back as is
+        self.original = self.unet.forward
+        self.unet.forward = self.forward
+        self.evaluations = 0
+        return self
+
+    def __exit__(self, *args):
+        if self.patched:
+            self.unet.forward = self.original
+        else:
+            del self.unet.forward
+        shared.log.debug(f'Tiled denoiser: tile={self.tile_w * 8}x{self.tile_h * 8} overlap={self.overlap * 8} batch={self.batch_size} evaluations={self.evaluations}')
+        self.unet = None
+        self.original = None
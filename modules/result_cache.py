@@ -0,0 +1,294 @@
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import threading
+import numpy as np
+from PIL import Image
+from modules import shared, paths, hashes
+
+
+cache_dir = os.path.join(paths.models_path, 'cache', 'results')
+marker_filename = '.last_used'
+result_filename = 'result.json'
+lock = threading.Lock()
+stats = { 'hits': 0, 'misses': 0, 'skipped': 0, 'stores': 0, 'evictions': 0, 'errors': 0 }
+# runtime state and output locations that do not change generated images
+excluded_params = ['sd_model', 'scripts', 'sampler', 'recovery', 'outpath_samples', 'outpath_grids', 'do_not_save_samples', 'do_not_save_grid', 'override_settings_restore_afterwards', 'sampler_index', 'prompt_for_display', 'job_timestamp', 'comments', 'ops', 'iteration', 'is_hr_pass', 'per_script_args', 'result_cache_key']
+# option sections that do not change generated images
+excluded_sections = ['saving-paths', 'system-paths', 'ui', 'live-preview', 'training', 'interrogate', 'extra_networks']
+
+
+# script methods called during processing, cached results would skip them
+script_hooks = ['process', 'before_process_batch', 'process_batch', 'postprocess', 'postprocess_batch', 'postprocess_batch_list', 'postprocess_image']
+
+
+class NotCacheable(Exception):
+    pass
+
+
+def enabled():
+    return shared.opts.result_cache > 0
+
+
+def canonical(value):
+    """convert value to json-serializable form that is identical for identical inputs, images are replaced by content hash"""
+    if value is None or isinstance(value, (bool, int, str)):
+        return value
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, (list, tuple)):
+        return [canonical(v) for v in value]
+    if isinstance(value, dict):
+        return { str(k): canonical(v) for k, v in sorted(value.items(), key=lambda kv: str(kv[0])) }
+    if isinstance(value, Image.Image):
+        return f'image:{value.mode}:{value.size}:{hashlib.sha256(value.tobytes()).hexdigest()}'
+    if isinstance(value, np.ndarray):
+        return f'array:{value.dtype}:{value.shape}:{hashlib.sha256(np.ascontiguousarray(value).tobytes()).hexdigest()}'
+    raise NotCacheable(type(value).__name__)
+
+
+def file_signature(filename, title=None):
+    if filename is None or not os.path.isfile(filename):
+        return None
+    sha256 = hashes.sha256_from_cache(filename, title) if title is not None else None
+    if sha256 is not None:
+        return sha256
+    stat = os.stat(filename)
+    return f'{os.path.basename(filename)}:{stat.st_size}:{int(stat.st_mtime)}'
+
+
+def model_signature(model):
+    checkpoint_info = getattr(model, 'sd_checkpoint_info', None)
+    if checkpoint_info is None:
+        return None
+    return checkpoint_info.sha256 or file_signature(checkpoint_info.filename, f'checkpoint/{checkpoint_info.name}') or checkpoint_info.title
+
+
+def networks_signature(prompts):
+    """hashes of extra networks and embeddings referenced by prompts"""
+    from modules import extra_networks, sd_hijack
+    res = {}
+    text = ' '.join(prompts)
+    _prompt, networks = extra_networks.parse_prompt(text)
+    lora = sys.modules.get('lora', None)
+    for network, params in networks.items():
+        for param in params:
+            name = param.positional[0] if len(param.positional) > 0 else ''
+            filename = None
+            if network in ['lora', 'lyco'] and lora is not None:
+                entry = lora.available_lora_aliases.get(name, None)
+                filename = entry.filename if entry is not None else None
+            elif network == 'hypernet':
+                filename = shared.hypernetworks.get(name, None)
+            res[f'{network}:{name}'] = file_signature(filename)
+    if shared.backend == shared.Backend.ORIGINAL:
+        for name, embedding in sd_hijack.model_hijack.embedding_db.word_embeddings.items():
+            if name in text:
+                res[f'embedding:{name}'] = file_signature(embedding.filename)
+    return res
+
+
+def options_signature():
+    options = shared.opts.snapshot()
+    res = {}
+    for k in sorted(options.keys()):
+        info = shared.opts.data_labels.get(k, None)
+        section = info.section[0] if info is not None and info.section is not None else None
+        if section in excluded_sections or k in ['result_cache']:
+            continue
+        try:
+            res[k] = canonical(options[k])
+        except NotCacheable:
+            res[k] = str(options[k])
+    return res
+
+
+def deterministic(p):
+    seeds = p.seed if isinstance(p.seed, list) else [p.seed]
+    if any(s is None or int(s) == -1 for s in seeds):
+        return False
+    if p.subseed_strength > 0:
+        subseeds = p.subseed if isinstance(p.subseed, list) else [p.subseed]
+        if any(s is None or int(s) == -1 for s in subseeds):
+            return False
+    return True
+
+
+def served(p):
+    """cached result can only be returned if job would not write outputs and no always-on script hooks into processing"""
+    from modules import scripts
+    if shared.opts.samples_save and not p.do_not_save_samples:
+        return False
+    if shared.opts.grid_save and not p.do_not_save_grid:
+        return False
+    for script in getattr(getattr(p, 'scripts', None), 'alwayson_scripts', []):
+        if any(getattr(type(script), hook, None) is not getattr(scripts.Script, hook) for hook in script_hooks):
+            return False
+    return True
+
+
+def cache_key(p):
+    """canonical hash of everything that determines job output, returns None if job is not cacheable"""
+    from modules import sd_vae
+    if not deterministic(p):
+        return None
+    try:
+        params = { k: canonical(v) for k, v in sorted(vars(p).items()) if k not in excluded_params }
+        prompts = p.prompt if isinstance(p.prompt, list) else [p.prompt]
+        negative_prompts = p.negative_prompt if isinstance(p.negative_prompt, list) else [p.negative_prompt or '']
+        data = {
+            'job': p.__class__.__name__,
+            'backend': str(shared.backend),
+            'model': model_signature(shared.sd_model),
+            'refiner': model_signature(shared.sd_refiner) if getattr(p, 'enable_hr', False) else None,
+            'vae': file_signature(sd_vae.loaded_vae_file),
+            'networks': networks_signature(prompts + negative_prompts),
+            'params': params,
+            'options': options_signature(),
+        }
+    except NotCacheable as e:
+        shared.log.debug(f'Result cache: job not cacheable: param={e}')
+        return None
+    if data['model'] is None:
+        return None
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def touch(folder):
+    with open(os.path.join(folder, marker_filename), 'w', encoding='utf8') as f:
+        f.write(str(time.time()))
+
+
+def lookup(p):
+    """returns cached Processed for job or None, key is stored on job so result can be stored after processing"""
+    p.result_cache_key = None
+    if not enabled():
+        return None
+    key = cache_key(p)
+    if key is None:
+        stats['skipped'] += 1
+        return None
+    p.result_cache_key = key
+    if not served(p): # result is still stored for later jobs that can be served
+        stats['skipped'] += 1
+        return None
+    folder = os.path.join(cache_dir, key)
+    data = shared.readfile(os.path.join(folder, result_filename), silent=True) if os.path.isdir(folder) else {}
+    if len(data) == 0:
+        stats['misses'] += 1
+        return None
+    try:
+        from modules.processing import Processed
+        images = []
+        for fn in data['images']:
+            with Image.open(os.path.join(folder, fn)) as image:
+                image.load()
+                images.append(image.copy())
+        for image, info in zip(images, data['infotexts']):
+            image.info['parameters'] = info
+        p.extra_generation_params.update(data.get('extra_generation_params', {}))
+        res = Processed(p, images, seed=data['seed'], info=data['info'], subseed=data['subseed'], all_prompts=data['all_prompts'], all_negative_prompts=data['all_negative_prompts'], all_seeds=data['all_seeds'], all_subseeds=data['all_subseeds'], index_of_first_image=data['index_of_first_image'], infotexts=data['infotexts'], comments=data.get('comments', ''))
+        touch(folder)
+    except Exception as e:
+        shared.log.warning(f'Result cache: load failed, removing entry: {folder} {e}')
+        shutil.rmtree(folder, ignore_errors=True)
+        stats['errors'] += 1
+        stats['misses'] += 1
+        return None
+    stats['hits'] += 1
+    shared.log.info(f'Result cache: hit key={key[:16]} images={len(images)}')
+    return res
+
+
+def store(p, processed):
+    key = getattr(p, 'result_cache_key', None)
+    if key is None or not enabled() or processed is None or len(processed.images) == 0:
+        return
+    if shared.state.interrupted or shared.state.skipped or 'incomplete' in str(p.extra_generation_params.get('OOM recovery', '')):
+        return
+    folder = os.path.join(cache_dir, key)
+    tmp = f'{folder}.tmp'
+    try:
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp, exist_ok=True)
+        filenames = []
+        for i, image in enumerate(processed.images):
+            fn = f'{i:05d}.png'
+            image.save(os.path.join(tmp, fn), format='PNG') # lossless so served result is identical to generated one
+            filenames.append(fn)
+        data = json.loads(processed.js())
+        data.update({ 'images': filenames, 'info': processed.info, 'comments': processed.comments, 'all_seeds': processed.all_seeds, 'all_subseeds': processed.all_subseeds })
+        shared.writefile(data, os.path.join(tmp, result_filename))
+        with lock:
+            shutil.rmtree(folder, ignore_errors=True)
+            os.replace(tmp, folder)
+            touch(folder)
+        stats['stores'] += 1
+    except Exception as e:
+        shared.log.warning(f'Result cache: store failed: {e}')
+        shutil.rmtree(tmp, ignore_errors=True)
+        stats['errors'] += 1
+        return
+    evict(keep=folder)
+
+
+def folder_size(folder):
+    total = 0
+    for f in os.listdir(folder):
+        try:
+            total += os.path.getsize(os.path.join(folder, f))
+        except OSError:
+            pass
+    return total
+
+
+def last_used(folder):
+    try:
+        return os.path.getmtime(os.path.join(folder, marker_filename))
+    except OSError:
+        return 0
+
+
+def entries():
+    if not os.path.isdir(cache_dir):
+        return []
+    return [os.path.join(cache_dir, f) for f in os.listdir(cache_dir) if os.path.isdir(os.path.join(cache_dir, f)) and not f.endswith('.tmp')]
+
+
+def evict(keep=None):
+    """remove least recently used entries until cache fits configured size"""
+    limit = shared.opts.result_cache * 1024 * 1024 * 1024
+    with lock:
+        items = sorted(entries(), key=last_used)
+        sizes = { e: folder_size(e) for e in items }
+        total = sum(sizes.values())
+        for entry in items:
+            if total <= limit:
+                break
+            if entry == keep:
+                continue
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= sizes[entry]
+            stats['evictions'] += 1
+
+
+def summary():
+    items = entries()
+    requests = stats['hits'] + stats['misses']
+    return {
+        **stats,
+        'hit_rate': round(stats['hits'] / requests, 3) if requests > 0 else 0,
+        'entries': len(items),
+        'size': sum(folder_size(e) for e in items),
+        'limit': int(shared.opts.result_cache * 1024 * 1024 * 1024),
+    }
+
+
+def clear():
+    with lock:
+        for entry in entries():
+            shutil.rmtree(entry, ignore_errors=True)
+    return summary()
@@ -1,9 +1,14 @@
 # this code is adapted from the script contributed by anon from /h/
 
+import os
+import re
+import json
+import atexit
 import pickle
-import collections
+import hashlib
 import zipfile
-import re
+import threading
+import collections
 
 import torch
 import numpy as np
@@ -64,6 +69,9 @@ class RestrictedUnpickler(pickle.Unpickler):
 # Regular expression that accepts 'dirname/version', 'dirname/data.pkl', and 'dirname/data/<number>'
 allowed_zip_names_re = re.compile(r"^([^/]+)/((data/\d+)|version|(data\.pkl))$")
 data_pkl_re = re.compile(r"^([^/]+)/data\.pkl$")
+cache_delay = 5 # seconds without new verifications before records are written
+cache_timer = None
+cache_lock = threading.Lock()
 
 def check_zip_filenames(filename, names):
     for name in names:
@@ -101,6 +109,180 @@ def check_pt(filename, extra_handler):
                 unpickler.load()
 
 
+def content_digest(filename):
+    """content key of the pickled part of a file: zip member names and data.pkl for new format, full file for legacy format"""
+    digest = hashlib.sha256()
+    try:
+        with zipfile.ZipFile(filename) as z:
+            names = sorted(z.namelist())
+            digest.update('\n'.join(names).encode())
+            for name in [f for f in names if data_pkl_re.match(f)]:
+                with z.open(name) as file:
+                    for chunk in iter(lambda: file.read(1024 * 1024), b""):
+                        digest.update(chunk)
+    except zipfile.BadZipfile:
+        with open(filename, "rb") as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def handler_name(extra_handler):
+    if extra_handler is None:
+        return 'default'
+    return f'{getattr(extra_handler, "__module__", "")}.{getattr(extra_handler, "__qualname__", type(extra_handler).__name__)}'
+
+
+def file_signature(stat):
+    """mtime can be set freely with os.utime, inode and ctime change when file is replaced or written and cannot be set back"""
+    return { 'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'ctime': stat.st_ctime_ns, 'inode': stat.st_ino, 'device': stat.st_dev }
+
+
+def file_record(path):
+    """cached verification record for a file if it has not changed since it was verified"""
+    from modules import hashes
+    record = hashes.cache('safe-unpickle-files').get(path, None)
+    if record is None:
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if any(record.get(k, None) != v for k, v in file_signature(stat).items()):
+        return None
+    return record
+
+
+def flush_cache():
+    global cache_timer # pylint: disable=global-statement
+    from modules import hashes
+    with cache_lock:
+        if cache_timer is None:
+            return
+        cache_timer.cancel()
+        cache_timer = None
+    hashes.dump_cache()
+
+
+def save_cache_later():
+    """verification records are written once after a burst of loads such as embeddings at startup instead of after every file"""
+    global cache_timer # pylint: disable=global-statement
+    with cache_lock:
+        if cache_timer is not None:
+            cache_timer.cancel()
+        cache_timer = threading.Timer(cache_delay, flush_cache)
+        cache_timer.daemon = True
+        cache_timer.start()
+
+
+atexit.register(flush_cache)
+
+
+def check_pt_cached(filename, extra_handler):
+    """run check_pt only for content that was not verified before with the same handler"""
+    from modules import hashes
+    path = filename if isinstance(filename, (str, os.PathLike)) else getattr(filename, 'name', None)
+    if path is None or not os.path.isfile(path):
+        check_pt(filename, extra_handler)
+        return
+    path = os.path.abspath(path)
+    handler = handler_name(extra_handler)
+    verified = hashes.cache('safe-unpickle')
+    record = file_record(path)
+    if record is not None and handler in verified.get(record['digest'], []):
+        return
+    stat = os.stat(path) # taken before reading so file replaced during verification does not match record
+    digest = content_digest(path)
+    if handler not in verified.get(digest, []):
+        check_pt(path, extra_handler)
+        verified[digest] = verified.get(digest, []) + [handler]
+    hashes.cache('safe-unpickle-files')[path] = { **file_signature(stat), 'digest': digest }
+    save_cache_later()
+
+
+def shadow_filename(path):
+    """safetensors shadow of a verified pickle file, None if shadow cache is disabled or file was not verified"""
+    from modules import shared, paths
+    if not shared.opts.safe_shadow_cache or shared.cmd_opts.disable_safe_unpickle:
+        return None
+    if os.path.splitext(path)[1].lower() not in ['.ckpt', '.pt', '.pth', '.bin']:
+        return None
+    record = file_record(os.path.abspath(path))
+    if record is None:
+        return None
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(paths.models_path, 'cache', 'safetensors', f'{name}-{record["digest"][:16]}.safetensors')
+
+
+def flatten(data, tensors, path, dropped):
+    if isinstance(data, torch.nn.ParameterDict):
+        data = dict(data.items())
+    if isinstance(data, torch.Tensor):
+        key = json.dumps(path)
+        tensors[key] = data.detach()
+        return { '__tensor__': key }
+    if isinstance(data, dict):
+        return { '__dict__': [[k, flatten(v, tensors, path + [k], dropped)] for k, v in data.items() if isinstance(k, (str, int, float, bool))] }
+    if isinstance(data, (list, tuple)):
+        return { '__list__': [flatten(v, tensors, path + [i], dropped) for i, v in enumerate(data)] }
+    if data is None or isinstance(data, (str, int, float, bool)):
+        return data
+    dropped.append('/'.join([str(p) for p in path]))
+    return None
+
+
+def unflatten(structure, tensors):
+    if isinstance(structure, dict):
+        if '__tensor__' in structure:
+            return tensors[structure['__tensor__']]
+        if '__dict__' in structure:
+            return { k: unflatten(v, tensors) for k, v in structure['__dict__'] }
+        if '__list__' in structure:
+            return [unflatten(v, tensors) for v in structure['__list__']]
+    return structure
+
+
+def save_shadow(path, data):
+    from modules import shared
+    import safetensors.torch
+    shadow = shadow_filename(path)
+    if shadow is None or os.path.exists(shadow):
+        return
+    tensors = {}
+    dropped = []
+    structure = flatten(data, tensors, [], dropped)
+    os.makedirs(os.path.dirname(shadow), exist_ok=True)
+    metadata = { '__structure__': json.dumps(structure), '__source__': os.path.basename(path) }
+    try:
+        try:
+            safetensors.torch.save_file({ k: v.contiguous() for k, v in tensors.items() }, shadow, metadata=metadata)
+        except RuntimeError: # tensors sharing storage must be saved as separate copies
+            safetensors.torch.save_file({ k: v.clone().contiguous() for k, v in tensors.items() }, shadow, metadata=metadata)
+        shared.log.info(f'Safetensors shadow created: {path} shadow="{shadow}" tensors={len(tensors)} dropped={dropped}')
+    except Exception as e:
+        shared.log.warning(f'Safetensors shadow failed: {path} {e}')
+        if os.path.exists(shadow):
+            os.remove(shadow)
+
+
+def load_shadow(path):
+    """load safetensors shadow of a pickle file using zero-copy safetensors path, returns None if no current shadow exists"""
+    from modules import shared
+    import safetensors
+    shadow = shadow_filename(path)
+    if shadow is None or not os.path.isfile(shadow):
+        return None
+    try:
+        with safetensors.safe_open(shadow, framework='pt', device='cpu') as f:
+            structure = json.loads(f.metadata()['__structure__'])
+            tensors = { k: f.get_tensor(k) for k in f.keys() }
+        shared.log.debug(f'Safetensors shadow: {path} shadow="{shadow}"')
+        return unflatten(structure, tensors)
+    except Exception as e:
+        shared.log.warning(f'Safetensors shadow load failed: {path} {e}')
+        return None
+
+
 def load(filename, *args, **kwargs):
     return load_with_extra(filename, *args, extra_handler=global_extra_handler, **kwargs)
 
@@ -129,14 +311,23 @@ def load_with_extra(filename, extra_handler=None, *args, **kwargs): # pylint: di
 
     from modules import shared, errors
 
+    path = filename if isinstance(filename, (str, os.PathLike)) else getattr(filename, 'name', None)
+    if path is not None and shared.opts.safe_shadow_cache:
+        data = load_shadow(path)
+        if data is not None:
+            return data
+
     try:
         if not shared.cmd_opts.disable_safe_unpickle:
-            check_pt(filename, extra_handler)
+            check_pt_cached(filename, extra_handler)
     except Exception as e:
         errors.display(e, f'verifying pickled file {filename}')
         return None
 
-    return unsafe_torch_load(filename, *args, **kwargs)
+    data = unsafe_torch_load(filename, *args, **kwargs)
+    if path is not None and shared.opts.safe_shadow_cache:
+        save_shadow(path, data)
+    return data
 
 
 class Extra:
@@ -4,7 +4,7 @@ import sys
 import time
 from collections import namedtuple
 import gradio as gr
-from modules import paths, script_callbacks, extensions, script_loading, scripts_postprocessing, errors
+from modules import paths, script_callbacks, extensions, script_loading, scripts_postprocessing, errors, shared
 from installer import log
 
 
@@ -179,6 +179,8 @@ ScriptFile = namedtuple("ScriptFile", ["basedir", "filename", "path", "priority"
 scripts_data = []
 postprocessing_scripts_data = []
 ScriptClassData = namedtuple("ScriptClassData", ["script_class", "path", "basedir", "module"])
+ScriptModuleData = namedtuple("ScriptModuleData", ["mtime", "module", "callbacks"])
+script_modules = {} # loaded script modules keyed by path, used to skip unchanged scripts on reload
 
 
 def list_scripts(scriptdirname, extension):
@@ -225,6 +227,27 @@ def list_files_with_name(filename):
     return res
 
 
+def load_script_module(path):
+    """loads script module or reuses previously loaded module if file is unchanged since last load
+    reused modules get their callbacks re-registered since callbacks are cleared on each load
+    modules that register script-unloaded callbacks tear down their own state on reload so they are always re-executed
+    """
+    mtime = os.path.getmtime(path)
+    cached = script_modules.get(path, None)
+    if cached is not None and cached.mtime == mtime and shared.opts.scripts_reload_cache:
+        for name, callback in cached.callbacks:
+            script_callbacks.callback_map[name].append(callback)
+        return cached.module, True
+    registered = {k: len(v) for k, v in script_callbacks.callback_map.items()}
+    module = script_loading.load_module(path)
+    callbacks = [(k, callback) for k, v in script_callbacks.callback_map.items() for callback in v[registered[k]:]]
+    if any(k == 'callbacks_script_unloaded' for k, _callback in callbacks):
+        script_modules.pop(path, None)
+    else:
+        script_modules[path] = ScriptModuleData(mtime, module, callbacks)
+    return module, False
+
+
 def load_scripts():
     global current_basedir # pylint: disable=global-statement
     scripts_data.clear()
@@ -233,6 +256,7 @@ def load_scripts():
     scripts_list = list_scripts("scripts", ".py")
     syspath = sys.path
     time_load = {}
+    reused = 0
 
     def register_scripts_from_module(module, scriptfile):
         for script_class in module.__dict__.values():
@@ -250,7 +274,8 @@ def load_scripts():
             if scriptfile.basedir != paths.script_path:
                 sys.path = [scriptfile.basedir] + sys.path
             current_basedir = scriptfile.basedir
-            script_module = script_loading.load_module(scriptfile.path)
+            script_module, cached = load_script_module(scriptfile.path)
+            reused += 1 if cached else 0
             register_scripts_from_module(script_module, scriptfile)
         except Exception as e:
             errors.display(e, f'Loading script: {scriptfile.filename}')
@@ -265,7 +290,7 @@ def load_scripts():
     scripts_postproc = scripts_postprocessing.ScriptPostprocessingRunner()
 
     time_summary = [f'{os.path.basename(k)}:{round(v,3)}s' for (k,v) in time_load.items() if v > 0.05]
-    log.debug(f'Scripts load: {time_summary}')
+    log.debug(f'Scripts load: scripts={len(scripts_list)} unchanged={reused} {time_summary}')
 
 
 def wrap_call(func, filename, funcname, *args, default=None, **kwargs):
@@ -529,7 +554,11 @@ class ScriptRunner:
             filename = script.filename
             module = cache.get(filename, None)
             if module is None:
-                module = script_loading.load_module(script.filename)
+                loaded = script_modules.get(filename, None)
+                if loaded is not None and os.path.isfile(filename) and loaded.mtime == os.path.getmtime(filename):
+                    module = loaded.module # unchanged since last load
+                else:
+                    module = script_loading.load_module(script.filename)
                 cache[filename] = module
             for script_class in module.__dict__.values():
                 if type(script_class) == type and issubclass(script_class, Script):
@@ -40,6 +40,14 @@ class ScriptPostprocessing:
         """
         pass # pylint: disable=unnecessary-pass
 
+    def process_batch(self, pps: list, **args):
+        """
+        This function is called instead of process() in batch mode with a list of images of the same size.
+        Scripts that can process several images at once override it, default processes them one by one.
+        """
+        for pp in pps:
+            self.process(pp, **args)
+
     def image_changed(self):
         pass
 
@@ -113,17 +121,26 @@ class ScriptPostprocessingRunner:
         self.ui_created = True
         return inputs
 
+    def process_args(self, script, args):
+        script_args = args[script.args_from:script.args_to]
+
+        process_args = {}
+        for (name, _component), value in zip(script.controls.items(), script_args):
+            process_args[name] = value
+        return process_args
+
     def run(self, pp: PostprocessedImage, args):
         for script in self.scripts_in_preferred_order():
             shared.state.job = script.name
+            script.process(pp, **self.process_args(script, args))
 
-            script_args = args[script.args_from:script.args_to]
-
-            process_args = {}
-            for (name, _component), value in zip(script.controls.items(), script_args):
-                process_args[name] = value
-
-            script.process(pp, **process_args)
+    def run_batch(self, pps: list, args):
+        for script in self.scripts_in_preferred_order():
+            shared.state.job = script.name
+            if len(pps) == 1:
+                script.process(pps[0], **self.process_args(script, args))
+            else:
+                script.process_batch(pps, **self.process_args(script, args))
 
     def create_args_for_run(self, scripts_args):
         if not self.ui_created:
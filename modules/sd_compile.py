@@ -0,0 +1,285 @@
+import os
+import time
+import logging
+import threading
+import torch
+from modules import shared, devices, paths
+
+
+cache_dir = os.path.join(paths.models_path, 'cache', 'compile')
+usage_filename = os.path.join(cache_dir, 'buckets.json')
+manager = None
+
+
+def parse_buckets(text: str, pairs: bool):
+    res = []
+    for item in [t.strip() for t in (text or '').replace(';', ',').split(',') if len(t.strip()) > 0]:
+        try:
+            if pairs:
+                w, h = [int(v) for v in item.lower().split('x')]
+                res.append((w, h))
+            else:
+                res.append(int(item))
+        except ValueError:
+            shared.log.warning(f'Compile: invalid bucket: {item}')
+    return sorted(set(res), key=lambda b: b[0] * b[1] if pairs else b)
+
+
+def setup_caches():
+    """point compiler caches to persistent location so compiled graphs survive restarts"""
+    if not shared.opts.cuda_compile_cache:
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.join(cache_dir, 'inductor'))
+    os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+    os.environ.setdefault('TRITON_CACHE_DIR', os.path.join(cache_dir, 'triton'))
+    os.environ.setdefault('OPENVINO_TORCH_CACHE_DIR', os.path.join(cache_dir, 'openvino'))
+    try:
+        import torch._inductor.config # pylint: disable=unused-import
+        torch._inductor.config.fx_graph_cache = True # pylint: disable=protected-access
+    except Exception:
+        pass
+
+
+def setup_dynamo():
+    import torch._dynamo # pylint: disable=unused-import,redefined-outer-name
+    if shared.opts.cuda_compile_backend == "openvino_fx":
+        from modules.intel.openvino import openvino_fx # pylint: disable=unused-import
+    log_level = logging.WARNING if shared.opts.cuda_compile_verbose else logging.CRITICAL # pylint: disable=protected-access
+    if hasattr(torch, '_logging'):
+        torch._logging.set_logs(dynamo=log_level, aot=log_level, inductor=log_level) # pylint: disable=protected-access
+    torch._dynamo.config.verbose = shared.opts.cuda_compile_verbose # pylint: disable=protected-access
+    torch._dynamo.config.suppress_errors = shared.opts.cuda_compile_errors # pylint: disable=protected-access
+    torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 64) # pylint: disable=protected-access
+
+
+def describe(value, batch, height, width):
+    """serializable template of call arguments with batch and spatial dims made symbolic"""
+    if isinstance(value, torch.Tensor):
+        shape = list(value.shape)
+        if len(shape) > 0 and shape[0] == batch:
+            shape[0] = 'B'
+        if len(shape) == 4 and shape[2] == height and shape[3] == width:
+            shape[2], shape[3] = 'H', 'W'
+        return { '__tensor__': shape, 'dtype': str(value.dtype).replace('torch.', '') }
+    if isinstance(value, (list, tuple)):
+        return [describe(v, batch, height, width) for v in value]
+    if isinstance(value, dict):
+        return { k: describe(v, batch, height, width) for k, v in value.items() }
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    raise TypeError(f'cannot describe argument: {type(value)}')
+
+
+def materialize(template, batch, height, width):
+    if isinstance(template, dict) and '__tensor__' in template:
+        shape = [batch if d == 'B' else height if d == 'H' else width if d == 'W' else d for d in template['__tensor__']]
+        dtype = getattr(torch, template['dtype'])
+        if dtype.is_floating_point:
+            return torch.randn(shape, dtype=dtype, device=devices.device)
+        return torch.ones(shape, dtype=dtype, device=devices.device)
+    if isinstance(template, list):
+        return [materialize(v, batch, height, width) for v in template]
+    if isinstance(template, dict):
+        return { k: materialize(v, batch, height, width) for k, v in template.items() }
+    return template
+
+
+def pad_value(value, batch, target_batch, height, width, target_height, target_width):
+    if isinstance(value, torch.Tensor):
+        if value.dim() == 4 and value.shape[2] == height and value.shape[3] == width and (target_height != height or target_width != width):
+            mode = 'replicate' if target_height - height >= height or target_width - width >= width else 'reflect' # reflect requires pad smaller than input
+            value = torch.nn.functional.pad(value, (0, target_width - width, 0, target_height - height), mode=mode)
+        if value.dim() > 0 and value.shape[0] == batch and target_batch > batch:
+            value = torch.cat([value, value[-1:].expand(target_batch - batch, *value.shape[1:])], dim=0)
+        return value
+    if isinstance(value, (list, tuple)):
+        return type(value)(pad_value(v, batch, target_batch, height, width, target_height, target_width) for v in value)
+    if isinstance(value, dict):
+        return { k: pad_value(v, batch, target_batch, height, width, target_height, target_width) for k, v in value.items() }
+    return value
+
+
+def crop_value(value, batch, height, width):
+    if isinstance(value, torch.Tensor):
+        if value.dim() == 4:
+            return value[:batch, :, :height, :width]
+        return value[:batch]
+    if isinstance(value, tuple):
+        return tuple(crop_value(v, batch, height, width) for v in value)
+    if hasattr(value, 'sample') and isinstance(value.sample, torch.Tensor): # diffusers output class
+        value.sample = crop_value(value.sample, batch, height, width)
+    return value
+
+
+class CompiledModule:
+    """compiled forward of a single module with inputs snapped to shape buckets"""
+
+    def __init__(self, owner, name, module):
+        self.owner = owner
+        self.name = name
+        self.module = module
+        self.forward = module.forward
+        self.compiled = torch.compile(module.forward, mode=shared.opts.cuda_compile_mode, backend=shared.opts.cuda_compile_backend, fullgraph=shared.opts.cuda_compile_fullgraph, dynamic=False)
+        self.seen = set()
+        module.forward = self
+
+    def restore(self):
+        self.module.forward = self.forward
+
+    def __call__(self, *args, **kwargs):
+        sample = args[0] if len(args) > 0 else next(iter(kwargs.values()), None)
+        if not isinstance(sample, torch.Tensor) or sample.dim() != 4:
+            return self.compiled(*args, **kwargs)
+        batch, _channels, height, width = sample.shape
+        target_batch, target_height, target_width = self.owner.bucket(batch, height, width)
+        if (target_batch, target_height, target_width) != (batch, height, width):
+            args = pad_value(args, batch, target_batch, height, width, target_height, target_width)
+            kwargs = pad_value(kwargs, batch, target_batch, height, width, target_height, target_width)
+        key = (target_batch, target_height, target_width, str(sample.dtype))
+        with self.owner.lock:
+            hit = key in self.seen
+            t0 = time.time()
+            res = self.compiled(*args, **kwargs)
+            self.seen.add(key)
+        self.owner.record(self, key, hit, time.time() - t0, (args, kwargs), padded=key[:3] != (batch, height, width))
+        return crop_value(res, batch, height, width)
+
+    def warmup(self, template, batch, height, width):
+        key = (batch, height, width, template.get('dtype', ''))
+        if key in self.seen:
+            return
+        args, kwargs = materialize(template['args'], batch, height, width), materialize(template['kwargs'], batch, height, width)
+        with self.owner.lock, torch.no_grad():
+            t0 = time.time()
+            self.compiled(*args, **kwargs)
+            self.seen.add(key)
+        self.owner.stats['precompiled'] += 1
+        self.owner.stats['compile_time'] += time.time() - t0
+        shared.log.debug(f'Compile: precompiled={self.name} batch={batch} latent={width}x{height} time={time.time() - t0:.2f}s')
+
+
+class CompileManager:
+    """
+    manages compiled model graphs
+    - latent shapes and batch sizes are snapped to configured buckets by padding inputs and cropping outputs so nearby sizes reuse one graph
+    - bucket usage and call signature are persisted so most used buckets can be precompiled in background after model load
+    - compiler caches are stored in models/cache/compile so compiled graphs survive restarts
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.modules: list[CompiledModule] = []
+        self.thread = None
+        self.stats = { 'hits': 0, 'misses': 0, 'padded': 0, 'precompiled': 0, 'compile_time': 0.0 }
+        self.usage = shared.readfile(usage_filename, silent=True)
+        self.usage_dirty = 0
+
+    def bucket(self, batch, height, width):
+        """smallest configured bucket that fits requested shape, shape is used as-is if nothing fits"""
+        spatial = parse_buckets(shared.opts.cuda_compile_buckets, pairs=True)
+        batches = parse_buckets(shared.opts.cuda_compile_batch_buckets, pairs=False)
+        target_batch = next((b for b in batches if b >= batch), batch)
+        target_height, target_width = next(((h // 8, w // 8) for w, h in spatial if w // 8 >= width and h // 8 >= height), (height, width))
+        return target_batch, target_height, target_width
+
+    def compile(self, module, name):
+        if isinstance(module.forward, CompiledModule):
+            return module
+        setup_caches()
+        setup_dynamo()
+        compiled = CompiledModule(self, name, module)
+        self.modules.append(compiled)
+        return module
+
+    def release(self, module=None):
+        modules = [m for m in self.modules if module is None or m.module is module]
+        self.modules = [m for m in self.modules if m not in modules] # signals background precompile to stop
+        self.wait()
+        for compiled in modules:
+            compiled.restore()
+        self.save()
+
+    def record(self, compiled, key, hit, duration, inputs, padded):
+        batch, height, width, dtype = key
+        self.stats['hits' if hit else 'misses'] += 1
+        if padded:
+            self.stats['padded'] += 1
+        if not hit:
+            self.stats['compile_time'] += duration
+            shared.log.info(f'Compile: compiled={compiled.name} batch={batch} latent={width}x{height} time={duration:.2f}s')
+        entry = self.usage.setdefault(compiled.name, { 'template': None, 'buckets': {} })
+        bucket = f'{batch}:{height}:{width}'
+        entry['buckets'][bucket] = entry['buckets'].get(bucket, 0) + 1
+        if entry['template'] is None or not hit:
+            try:
+                args, kwargs = inputs
+                entry['template'] = { 'args': describe(list(args), batch, height, width), 'kwargs': describe(kwargs, batch, height, width), 'dtype': dtype }
+            except TypeError as e:
+                shared.log.debug(f'Compile: cannot record call template: {compiled.name} {e}')
+        self.usage_dirty += 1
+        if not hit or self.usage_dirty >= 100:
+            self.save()
+
+    def save(self):
+        if self.usage_dirty == 0:
+            return
+        os.makedirs(cache_dir, exist_ok=True)
+        shared.writefile(self.usage, usage_filename)
+        self.usage_dirty = 0
+
+    def precompile(self):
+        """compile most used buckets from previous runs in background"""
+        if not shared.opts.cuda_compile_precompile or len(self.modules) == 0:
+            return
+        jobs = []
+        for compiled in self.modules:
+            entry = self.usage.get(compiled.name, None)
+            if entry is None or entry.get('template', None) is None:
+                continue
+            popular = sorted(entry['buckets'].items(), key=lambda kv: kv[1], reverse=True)[:shared.opts.cuda_compile_precompile_count]
+            for bucket, _count in popular:
+                batch, height, width = [int(v) for v in bucket.split(':')]
+                jobs.append((compiled, entry['template'], batch, height, width))
+        if len(jobs) == 0:
+            return
+
+        def run():
+            t0 = time.time()
+            for compiled, template, batch, height, width in jobs:
+                if compiled not in self.modules:
+                    break # model unloaded while precompiling
+                try:
+                    compiled.warmup(template, batch, height, width)
+                except Exception as e:
+                    shared.log.warning(f'Compile: precompile failed: {compiled.name} batch={batch} latent={width}x{height} {e}')
+            shared.log.info(f'Compile: precompile done buckets={len(jobs)} time={time.time() - t0:.2f}s')
+
+        shared.log.info(f'Compile: precompile start buckets={len(jobs)}')
+        self.thread = threading.Thread(target=run, name='compile-precompile', daemon=True)
+        self.thread.start()
+
+    def wait(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.thread.join()
+        self.thread = None
+
+    def summary(self):
+        total = self.stats['hits'] + self.stats['misses']
+        return { **self.stats, 'hit_rate': round(self.stats['hits'] / total, 3) if total > 0 else 0, 'modules': [m.name for m in self.modules], 'buckets': { m.name: sorted(m.seen) for m in self.modules } }
+
+
+def get_manager() -> CompileManager:
+    global manager # pylint: disable=global-statement
+    if manager is None:
+        manager = CompileManager()
+    return manager
+
+
+def compile_module(module, name):
+    return get_manager().compile(module, name)
+
+
+def release(module=None):
+    if manager is not None:
+        manager.release(module)
@@ -74,6 +74,12 @@ def apply_optimizations():
         shared.log.info("Applying InvokeAI cross attention optimization")
         ldm.modules.attention.CrossAttention.forward = sd_hijack_optimizations.split_cross_attention_forward_invokeAI
         optimization_method = 'invokeai'
+    if opts.cross_attention_optimization == "Automatic":
+        from modules import sd_hijack_autotune
+        shared.log.info("Applying automatic cross attention optimization with per-shape autotune")
+        ldm.modules.attention.CrossAttention.forward = sd_hijack_autotune.autotune_attention_forward
+        ldm.modules.diffusionmodules.model.AttnBlock.forward = sd_hijack_optimizations.sdp_attnblock_forward if can_use_sdp else sd_hijack_optimizations.sub_quad_attnblock_forward
+        optimization_method = 'autotune'
     if opts.cross_attention_optimization == "Doggettx's":
         shared.log.info("Applying Doggettx cross attention optimization")
         ldm.modules.attention.CrossAttention.forward = sd_hijack_optimizations.split_cross_attention_forward
@@ -185,22 +191,15 @@ class StableDiffusionModelHijack:
 
         if opts.cuda_compile and opts.cuda_compile_backend != 'none' and shared.backend == shared.Backend.ORIGINAL:
             try:
-                import logging
+                from modules import sd_compile
                 shared.log.info(f"Compiling pipeline={m.model.__class__.__name__} mode={opts.cuda_compile_backend}")
-                import torch._dynamo # pylint: disable=unused-import,redefined-outer-name
-                if shared.opts.cuda_compile_backend == "openvino_fx":
-                    from modules.intel.openvino import openvino_fx
-                log_level = logging.WARNING if opts.cuda_compile_verbose else logging.CRITICAL # pylint: disable=protected-access
-                if hasattr(torch, '_logging'):
-                    torch._logging.set_logs(dynamo=log_level, aot=log_level, inductor=log_level) # pylint: disable=protected-access
-                torch._dynamo.config.verbose = opts.cuda_compile_verbose # pylint: disable=protected-access
-                torch._dynamo.config.suppress_errors = opts.cuda_compile_errors # pylint: disable=protected-access
                 torch.backends.cudnn.benchmark = True
                 if opts.cuda_compile_backend == 'hidet':
                     import hidet
                     hidet.torch.dynamo_config.use_tensor_core(True)
                     hidet.torch.dynamo_config.search_space(2)
-                m.model = torch.compile(m.model, mode=opts.cuda_compile_mode, backend=opts.cuda_compile_backend, fullgraph=opts.cuda_compile_fullgraph, dynamic=False)
+                sd_compile.compile_module(m.model, f'unet:{m.__class__.__name__}')
+                sd_compile.get_manager().precompile()
                 shared.log.info("Model complilation done.")
             except Exception as err:
                 shared.log.warning(f"Model compile not supported: {err}")
@@ -236,6 +235,9 @@ class StableDiffusionModelHijack:
 
         undo_optimizations()
         undo_weighted_forward(m)
+        if shared.opts.cuda_compile:
+            from modules import sd_compile
+            sd_compile.release(m.model)
 
         self.apply_circular(False)
         self.layers = None
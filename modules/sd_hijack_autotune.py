@@ -0,0 +1,163 @@
+import time
+import torch
+from ldm.util import default
+from modules import shared, devices, hashes, sd_hijack_optimizations
+from modules.hypernetworks import hypernetwork
+
+
+benchmark_runs = 3
+tuned = {} # shape key -> ranked list of implementations, fastest first
+device_prefixes = {} # device -> key prefix, computed once since device name lookup is too slow for every attention call
+
+
+def device_name(device):
+    if device.type == 'cuda':
+        try:
+            return torch.cuda.get_device_name(device)
+        except Exception:
+            pass
+    return device.type
+
+
+def device_prefix(device):
+    prefix = device_prefixes.get(device, None)
+    if prefix is None:
+        prefix = f'{device_name(device)}:{torch.__version__}'
+        device_prefixes[device] = prefix
+    return prefix
+
+
+def shape_key(q, k, heads):
+    """q, k, v are in (batch * heads, tokens, head_dim) layout"""
+    return f'{device_prefix(q.device)}:{str(q.dtype).replace("torch.", "")}:heads={heads}:q={q.shape[1]}:kv={k.shape[1]}:dim={q.shape[2]}'
+
+
+def sdp(q, k, v):
+    return torch.nn.functional.scaled_dot_product_attention(q, k, v, dropout_p=0.0, is_causal=False)
+
+
+def sdp_no_mem(q, k, v):
+    with torch.backends.cuda.sdp_kernel(enable_flash=True, enable_math=True, enable_mem_efficient=False):
+        return sdp(q, k, v)
+
+
+def xformers_attention(q, k, v):
+    import xformers.ops # pylint: disable=import-error
+    return xformers.ops.memory_efficient_attention(q, k, v, attn_bias=None, op=sd_hijack_optimizations.get_xformers_flash_attention_op(q, k, v))
+
+
+def invokeai(q, k, v):
+    return sd_hijack_optimizations.einsum_op(q, k * q.shape[-1] ** -0.5, v)
+
+
+def sub_quadratic(q_chunk_size, kv_chunk_size):
+    def fn(q, k, v):
+        return sd_hijack_optimizations.sub_quad_attention(q, k, v, q_chunk_size=q_chunk_size, kv_chunk_size=kv_chunk_size, chunk_threshold=shared.opts.sub_quad_chunk_threshold, use_checkpoint=False)
+    return fn
+
+
+def implementations(q, k):
+    """all attention implementations usable for this shape, keyed by name stored in tuning cache"""
+    impl = {}
+    if hasattr(torch.nn.functional, "scaled_dot_product_attention"):
+        impl['sdp'] = sdp
+        if q.device.type == 'cuda':
+            impl['sdp-no-mem'] = sdp_no_mem
+    if shared.xformers_available and q.device.type == 'cuda':
+        impl['xformers'] = xformers_attention
+    impl['invokeai'] = invokeai
+    q_chunks = sorted({min(c, q.shape[1]) for c in [512, 1024, 2048]})
+    kv_chunks = sorted({min(c, k.shape[1]) for c in [512, 1024]})
+    for q_chunk in q_chunks:
+        impl[f'sub-quadratic:{q_chunk}:auto'] = sub_quadratic(q_chunk, None)
+        for kv_chunk in kv_chunks:
+            impl[f'sub-quadratic:{q_chunk}:{kv_chunk}'] = sub_quadratic(q_chunk, kv_chunk)
+    return impl
+
+
+def lookup(name):
+    if name.startswith('sub-quadratic:'):
+        _prefix, q_chunk, kv_chunk = name.split(':')
+        return sub_quadratic(int(q_chunk), None if kv_chunk == 'auto' else int(kv_chunk))
+    return { 'sdp': sdp, 'sdp-no-mem': sdp_no_mem, 'xformers': xformers_attention, 'invokeai': invokeai }.get(name, None)
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def benchmark(q, k, v, heads):
+    """time each implementation on actual inputs and return names ranked by speed"""
+    times = {}
+    with torch.no_grad():
+        for name, fn in implementations(q, k).items():
+            try:
+                fn(q, k, v) # warmup, also catches unsupported shapes and oom
+                synchronize(q.device)
+                best = float('inf')
+                for _i in range(benchmark_runs):
+                    t0 = time.perf_counter()
+                    fn(q, k, v)
+                    synchronize(q.device)
+                    best = min(best, time.perf_counter() - t0)
+                times[name] = best
+            except Exception as e:
+                shared.log.debug(f'Attention autotune: impl={name} failed: {e}')
+                if q.device.type == 'cuda':
+                    torch.cuda.empty_cache()
+    ranking = sorted(times, key=times.get)
+    shared.log.debug(f'Attention autotune: heads={heads} q={q.shape[1]} kv={k.shape[1]} dim={q.shape[2]} dtype={q.dtype} device={q.device.type} best={ranking[0] if len(ranking) > 0 else None} times={ {n: round(1000 * t, 3) for n, t in times.items()} }')
+    return ranking
+
+
+def attention(q, k, v, heads):
+    key = shape_key(q, k, heads)
+    ranking = tuned.get(key, None)
+    if ranking is None:
+        cache = hashes.cache('attention-autotune')
+        ranking = cache.get(key, None)
+        if ranking is None:
+            ranking = benchmark(q, k, v, heads)
+            if len(ranking) > 0:
+                cache[key] = ranking
+                hashes.dump_cache()
+        tuned[key] = ranking
+    for i, name in enumerate(ranking):
+        fn = lookup(name)
+        if fn is None:
+            continue
+        try:
+            return fn(q, k, v)
+        except Exception as e: # e.g. oom at larger batch than tuned, use next best
+            shared.log.debug(f'Attention autotune: impl={name} failed, trying next: {e}')
+            if i == len(ranking) - 1:
+                raise
+    return sd_hijack_optimizations.einsum_op_compvis(q, k * q.shape[-1] ** -0.5, v)
+
+
+def autotune_attention_forward(self, x, context=None, mask=None):
+    if mask is not None:
+        return sd_hijack_optimizations.scaled_dot_product_attention_forward(self, x, context, mask)
+    h = self.heads
+    q = self.to_q(x)
+    context = default(context, x)
+
+    context_k, context_v = hypernetwork.apply_hypernetworks(shared.loaded_hypernetworks, context)
+    k = self.to_k(context_k)
+    v = self.to_v(context_v)
+    del context, context_k, context_v, x
+
+    q, k, v = (t.unflatten(-1, (h, -1)).transpose(1, 2).flatten(end_dim=1) for t in (q, k, v))
+
+    dtype = q.dtype
+    if shared.opts.upcast_attn:
+        q, k, v = q.float(), k.float(), v.float()
+
+    with devices.without_autocast(disable=q.dtype == v.dtype):
+        out = attention(q, k, v, h)
+    out = out.to(dtype)
+
+    out = out.unflatten(0, (-1, h)).transpose(1, 2).flatten(start_dim=2)
+    return self.to_out(out)
+
@@ -15,7 +15,7 @@ from modules.hypernetworks import hypernetwork
 from .sub_quadratic_attention import efficient_dot_product_attention # pylint: disable=relative-beyond-top-level
 
 
-if shared.opts.cross_attention_optimization == "xFormers":
+if shared.opts.cross_attention_optimization in ["xFormers", "Automatic"]:
     try:
         import xformers.ops # pylint: disable=import-error
         shared.xformers_available = True
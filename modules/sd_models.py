@@ -1,4 +1,4 @@
-import collections
+import collections.abc
 import os.path
 import re
 import io
@@ -16,7 +16,7 @@ import tomesd
 from transformers import logging as transformers_logging
 import ldm.modules.midas as midas
 from ldm.util import instantiate_from_config
-from modules import paths, shared, modelloader, devices, script_callbacks, sd_vae, sd_disable_initialization, errors, hashes, sd_models_config
+from modules import paths, shared, modelloader, devices, script_callbacks, sd_vae, sd_disable_initialization, errors, hashes, sd_models_config, safe
 from modules.sd_hijack_inpainting import do_inpainting_hijack
 from modules.timer import Timer
 from modules.memstats import memory_stats
@@ -226,7 +226,7 @@ def select_checkpoint(op='model'):
     if op == 'dict':
         model_checkpoint = shared.opts.sd_model_dict
     elif op == 'refiner':
-        model_checkpoint = shared.opts.data.get('sd_model_refiner', None)
+        model_checkpoint = shared.opts.sd_model_refiner if shared.opts.is_overridden('sd_model_refiner') else shared.opts.data.get('sd_model_refiner', None)
     else:
         model_checkpoint = shared.opts.sd_model_checkpoint
     if model_checkpoint is None or model_checkpoint == 'None':
@@ -328,11 +328,17 @@ def read_state_dict(checkpoint_file, map_location=None): # pylint: disable=unuse
         return None
     try:
         pl_sd = None
+        _, extension = os.path.splitext(checkpoint_file)
+        if extension.lower() == ".ckpt" and shared.opts.sd_disable_ckpt:
+            shared.log.warning(f"Checkpoint loading disabled: {checkpoint_file}")
+            return None
+        if extension.lower() != ".safetensors" and shared.opts.safe_shadow_cache:
+            pl_sd = safe.load_shadow(checkpoint_file) # verified pickle checkpoint previously converted to safetensors
+            if pl_sd is not None:
+                sd = get_state_dict_from_checkpoint(pl_sd)
+                del pl_sd
+                return sd
         with progress.open(checkpoint_file, 'rb', description=f'Loading weights: [cyan]{checkpoint_file}', auto_refresh=True) as f:
-            _, extension = os.path.splitext(checkpoint_file)
-            if extension.lower() == ".ckpt" and shared.opts.sd_disable_ckpt:
-                shared.log.warning(f"Checkpoint loading disabled: {checkpoint_file}")
-                return None
             if shared.opts.stream_load:
                 if extension.lower() == ".safetensors":
                     # shared.log.debug('Model weights loading: type=safetensors mode=buffered')
@@ -357,35 +363,67 @@ def read_state_dict(checkpoint_file, map_location=None): # pylint: disable=unuse
     return sd
 
 
+class LazyStateDict(collections.abc.Mapping):
+    """read-only state dict over a safetensors file: keys are transformed when opened and tensors are read from mmap only when accessed"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = safetensors.safe_open(filename, framework='pt', device='cpu')
+        self.keys_map = {}
+        for k in self.file.keys():
+            new_key = transform_checkpoint_dict_key(k)
+            if new_key is not None:
+                self.keys_map[new_key] = k
+
+    def __getitem__(self, key):
+        return self.file.get_tensor(self.keys_map[key])
+
+    def __iter__(self):
+        return iter(self.keys_map)
+
+    def __len__(self):
+        return len(self.keys_map)
+
+
 def get_checkpoint_state_dict(checkpoint_info: CheckpointInfo, timer):
     if checkpoint_info in checkpoints_loaded:
         shared.log.info("Model weights loading: from cache")
         return checkpoints_loaded[checkpoint_info]
+    if shared.backend == shared.Backend.ORIGINAL and shared.opts.sd_lazy_load and not shared.opts.stream_load and checkpoint_info.filename.lower().endswith('.safetensors'):
+        try:
+            res = LazyStateDict(checkpoint_info.filename)
+            timer.record("load")
+            return res
+        except Exception as e:
+            shared.log.warning(f'Model weights lazy loading failed: {checkpoint_info.filename} {e}')
     res = read_state_dict(checkpoint_info.filename)
     timer.record("load")
     return res
 
 
-def load_model_weights(model: torch.nn.Module, checkpoint_info: CheckpointInfo, state_dict, timer):
-    shared.log.debug(f'Model weights loading: {memory_stats()}')
-    sd_model_hash = checkpoint_info.calculate_shorthash()
-    timer.record("hash")
-    if model_data.sd_dict == 'None':
-        shared.opts.data["sd_model_checkpoint"] = checkpoint_info.title
-    if state_dict is None:
-        state_dict = get_checkpoint_state_dict(checkpoint_info, timer)
-    try:
-        model.load_state_dict(state_dict, strict=False)
-    except Exception as e:
-        shared.log.error(f'Error loading model weights: {checkpoint_info.filename} {e}')
-    del state_dict
-    timer.record("apply")
-    if shared.opts.sd_checkpoint_cache > 0:
-        # cache newly loaded model
-        checkpoints_loaded[checkpoint_info] = model.state_dict().copy()
-    if shared.opts.opt_channelslast:
-        model.to(memory_format=torch.channels_last)
-        timer.record("channels")
+def load_state_dict_streaming(model: torch.nn.Module, state_dict: LazyStateDict):
+    """copy tensors one at a time into existing model parameters which already have target dtype and device"""
+    targets = { **dict(model.named_parameters()), **dict(model.named_buffers()) }
+    loaded = 0
+    mismatched = []
+    with torch.no_grad():
+        for key in state_dict.keys():
+            target = targets.get(key, None)
+            if target is None:
+                continue
+            tensor = state_dict[key]
+            if tensor.shape != target.shape:
+                mismatched.append(key)
+                continue
+            target.copy_(tensor)
+            loaded += 1
+            del tensor
+    if len(mismatched) > 0:
+        shared.log.error(f'Error loading model weights: {state_dict.filename} size mismatch: {mismatched}')
+    shared.log.debug(f'Model weights streamed: {state_dict.filename} tensors={loaded} missing={len(targets) - loaded}')
+
+
+def apply_model_dtype(model):
     if not shared.opts.no_half:
         vae = model.first_stage_model
         depth_model = getattr(model, 'depth_model', None)
@@ -404,6 +442,45 @@ def load_model_weights(model: torch.nn.Module, checkpoint_info: CheckpointInfo,
     else:
         model.model.diffusion_model.to(devices.dtype_unet)
     model.first_stage_model.to(devices.dtype_vae)
+
+
+def load_model_weights(model: torch.nn.Module, checkpoint_info: CheckpointInfo, state_dict, timer):
+    shared.log.debug(f'Model weights loading: {memory_stats()}')
+    sd_model_hash = checkpoint_info.calculate_shorthash()
+    timer.record("hash")
+    if model_data.sd_dict == 'None' and not shared.opts.is_overridden('sd_model_checkpoint'):
+        shared.opts.data["sd_model_checkpoint"] = checkpoint_info.title
+    if state_dict is None:
+        state_dict = get_checkpoint_state_dict(checkpoint_info, timer)
+    if isinstance(state_dict, LazyStateDict): # cast and move model first so each tensor is copied directly into its final parameter
+        if shared.opts.opt_channelslast:
+            model.to(memory_format=torch.channels_last)
+        apply_model_dtype(model)
+        if not shared.cmd_opts.lowvram and not shared.cmd_opts.medvram:
+            model.to(devices.device)
+        timer.record("prepare")
+        try:
+            load_state_dict_streaming(model, state_dict)
+        except Exception as e:
+            shared.log.error(f'Error loading model weights: {checkpoint_info.filename} {e}')
+        del state_dict
+        timer.record("apply")
+        if shared.opts.sd_checkpoint_cache > 0: # parameters are already on device so cache holds separate cpu copies
+            checkpoints_loaded[checkpoint_info] = { k: v.detach().to('cpu', copy=True) for k, v in model.state_dict().items() }
+    else:
+        try:
+            model.load_state_dict(state_dict, strict=False)
+        except Exception as e:
+            shared.log.error(f'Error loading model weights: {checkpoint_info.filename} {e}')
+        del state_dict
+        timer.record("apply")
+        if shared.opts.sd_checkpoint_cache > 0:
+            # cache newly loaded model
+            checkpoints_loaded[checkpoint_info] = model.state_dict().copy()
+        if shared.opts.opt_channelslast:
+            model.to(memory_format=torch.channels_last)
+            timer.record("channels")
+        apply_model_dtype(model)
     # clean up cache if limit is reached
     while len(checkpoints_loaded) > shared.opts.sd_checkpoint_cache:
         checkpoints_loaded.popitem(last=False)
@@ -674,11 +751,17 @@ def load_diffuser(checkpoint_info=None, already_loaded_state_dict=None, timer=No
                     shared.log.error(f'Diffusers {op} pipeline not initialized: {shared.opts.diffusers_pipeline}')
                     return
                 try:
-                    if hasattr(pipeline, 'from_single_file'):
+                    from modules import diffusers_cache
+                    sd_model = diffusers_cache.load(checkpoint_info, pipeline, diffusers_load_config) # converted pipeline from previous load
+                    if sd_model is not None:
+                        shared.log.debug(f'Diffusers {op}: loaded from pipeline cache')
+                    elif hasattr(pipeline, 'from_single_file'):
                         diffusers_load_config['use_safetensors'] = True
                         sd_model = pipeline.from_single_file(checkpoint_info.path, **diffusers_load_config)
+                        diffusers_cache.save(checkpoint_info, pipeline, diffusers_load_config, sd_model)
                     elif hasattr(pipeline, 'from_ckpt'):
                         sd_model = pipeline.from_ckpt(checkpoint_info.path, **diffusers_load_config)
+                        diffusers_cache.save(checkpoint_info, pipeline, diffusers_load_config, sd_model)
                     else:
                         shared.log.error(f'Diffusers {op} cannot load safetensor model: {checkpoint_info.path} {shared.opts.diffusers_pipeline}')
                         return
@@ -702,7 +785,13 @@ def load_diffuser(checkpoint_info=None, already_loaded_state_dict=None, timer=No
         if hasattr(sd_model, "watermark"):
             sd_model.watermark = NoWatermark()
         sd_model.has_accelerate = False
-        if hasattr(sd_model, "enable_model_cpu_offload"):
+        use_offload_engine = shared.opts.diffusers_offload_engine and (shared.cmd_opts.medvram or shared.cmd_opts.lowvram or shared.opts.diffusers_model_cpu_offload or shared.opts.diffusers_seq_cpu_offload)
+        if use_offload_engine:
+            from modules import lowvram
+            shared.log.debug(f'Diffusers {op}: enable prefetching offload engine')
+            lowvram.setup_for_diffusers(sd_model)
+            sd_model.has_accelerate = True
+        if hasattr(sd_model, "enable_model_cpu_offload") and not use_offload_engine:
             if (shared.cmd_opts.medvram and devices.backend != "directml") or shared.opts.diffusers_model_cpu_offload:
                 shared.log.debug(f'Diffusers {op}: enable model CPU offload')
                 if shared.opts.diffusers_move_base or shared.opts.diffusers_move_unet or shared.opts.diffusers_move_refiner:
@@ -712,7 +801,7 @@ def load_diffuser(checkpoint_info=None, already_loaded_state_dict=None, timer=No
                     shared.log.warning(f'Disabling {op} "Move model to CPU" since "Model CPU offload" is enabled')
                 sd_model.enable_model_cpu_offload()
                 sd_model.has_accelerate = True
-        if hasattr(sd_model, "enable_sequential_cpu_offload"):
+        if hasattr(sd_model, "enable_sequential_cpu_offload") and not use_offload_engine:
             if shared.cmd_opts.lowvram or shared.opts.diffusers_seq_cpu_offload:
                 shared.log.debug(f'Diffusers {op}: enable sequential CPU offload')
                 if shared.opts.diffusers_move_base or shared.opts.diffusers_move_unet or shared.opts.diffusers_move_refiner:
@@ -792,19 +881,11 @@ def load_diffuser(checkpoint_info=None, already_loaded_state_dict=None, timer=No
                 shared.log.warning(f"IPEX Optimize not supported: {err}")
             try:
                 if shared.opts.cuda_compile and shared.opts.cuda_compile_backend != 'none':
+                    from modules import sd_compile
                     shared.log.info(f"Compiling pipeline={sd_model.__class__.__name__} shape={8 * sd_model.unet.config.sample_size} mode={shared.opts.cuda_compile_backend}")
-                    import torch._dynamo # pylint: disable=unused-import,redefined-outer-name
-                    if shared.opts.cuda_compile_backend == "openvino_fx":
-                        from modules.intel.openvino import openvino_fx
-                    log_level = logging.WARNING if shared.opts.cuda_compile_verbose else logging.CRITICAL # pylint: disable=protected-access
-                    if hasattr(torch, '_logging'):
-                        torch._logging.set_logs(dynamo=log_level, aot=log_level, inductor=log_level) # pylint: disable=protected-access
-                    torch._dynamo.config.verbose = shared.opts.cuda_compile_verbose # pylint: disable=protected-access
-                    torch._dynamo.config.suppress_errors = shared.opts.cuda_compile_errors # pylint: disable=protected-access
-                    sd_model.unet = torch.compile(sd_model.unet, mode=shared.opts.cuda_compile_mode, backend=shared.opts.cuda_compile_backend, fullgraph=shared.opts.cuda_compile_fullgraph) # pylint: disable=attribute-defined-outside-init
+                    sd_compile.compile_module(sd_model.unet, f'unet:{sd_model.__class__.__name__}')
                     sd_model.vae.decode = torch.compile(sd_model.vae.decode, mode=shared.opts.cuda_compile_mode, backend=shared.opts.cuda_compile_backend, fullgraph=shared.opts.cuda_compile_fullgraph) # pylint: disable=attribute-defined-outside-init
-                    if shared.opts.cuda_compile_precompile:
-                        sd_model("dummy prompt")
+                    sd_compile.get_manager().precompile()
                     shared.log.info("Complilation done.")
             except Exception as err:
                 shared.log.warning(f"Model compile not supported: {err}")
@@ -1012,6 +1093,7 @@ def reload_model_weights(sd_model=None, info=None, reuse_dict=False, op='model')
     if (reuse_dict or (shared.opts.model_reuse_dict and sd_model is not None)) and not sd_model.has_accelerate:
         shared.log.info('Reusing previous model dictionary')
         sd_hijack.model_hijack.undo_hijack(sd_model)
+        lowvram.release(sd_model) # offload blocks are registered again once new weights are loaded
     else:
         unload_model_weights(op=op)
         sd_model = None
@@ -1037,6 +1119,9 @@ def reload_model_weights(sd_model=None, info=None, reuse_dict=False, op='model')
         shared.log.error("Load model failed: restoring previous")
         load_model_weights(sd_model, current_checkpoint_info, None, timer)
     finally:
+        if (shared.cmd_opts.lowvram or shared.cmd_opts.medvram) and shared.backend == shared.Backend.ORIGINAL: # same order as load_model, before hijack wraps cond stage model
+            lowvram.setup_for_low_vram(sd_model, shared.cmd_opts.medvram)
+            timer.record("offload")
         sd_hijack.model_hijack.hijack(sd_model)
         timer.record("hijack")
         script_callbacks.model_loaded_callback(sd_model)
@@ -1058,24 +1143,32 @@ def disable_offload(sd_model):
 
 
 def unload_model_weights(op='model'):
-    from modules import sd_hijack
+    from modules import sd_hijack, lowvram
     if op == 'model' or op == 'dict':
         if model_data.sd_model:
+            lowvram.release(model_data.sd_model)
             if shared.backend == shared.Backend.ORIGINAL:
                 model_data.sd_model.to(devices.cpu)
                 sd_hijack.model_hijack.undo_hijack(model_data.sd_model)
             else:
                 disable_offload(model_data.sd_model)
+                if shared.opts.cuda_compile and hasattr(model_data.sd_model, 'unet'):
+                    from modules import sd_compile
+                    sd_compile.release(model_data.sd_model.unet)
                 model_data.sd_model.to('meta')
             model_data.sd_model = None
             shared.log.debug(f'Unload weights {op}: {memory_stats()}')
     else:
         if model_data.sd_refiner:
+            lowvram.release(model_data.sd_refiner)
             if shared.backend == shared.Backend.ORIGINAL:
                 model_data.sd_model.to(devices.cpu)
                 sd_hijack.model_hijack.undo_hijack(model_data.sd_refiner)
             else:
                 disable_offload(model_data.sd_model)
+                if shared.opts.cuda_compile and hasattr(model_data.sd_refiner, 'unet'):
+                    from modules import sd_compile
+                    sd_compile.release(model_data.sd_refiner.unet)
                 model_data.sd_refiner.to('meta')
             model_data.sd_refiner = None
             shared.log.debug(f'Unload weights {op}: {memory_stats()}')
@@ -1091,12 +1184,33 @@ def apply_token_merging(sd_model, token_merging_ratio):
         tomesd.remove_patch(sd_model)
 
     if token_merging_ratio > 0:
+        max_downsample = 1
+        if shared.backend == shared.Backend.DIFFUSERS:
+            if not hasattr(sd_model, 'unet') or not hasattr(sd_model.unet, 'config'):
+                shared.log.warning(f'Token merging not supported: pipeline={sd_model.__class__.__name__}')
+                sd_model.applied_token_merged_ratio = 0 # patch was removed above
+                return
+            down_blocks = getattr(sd_model.unet.config, 'down_block_types', [])
+            for i, block in enumerate(down_blocks): # merge at highest resolution that has attention, e.g. sdxl has no attention in first block
+                if 'Attn' in block:
+                    max_downsample = min(2 ** i, 8)
+                    break
         tomesd.apply_patch(
             sd_model,
             ratio=token_merging_ratio,
+            max_downsample=max_downsample,
             use_rand=False,  # can cause issues with some samplers
             merge_attn=True,
             merge_crossattn=False,
             merge_mlp=False
         )
     sd_model.applied_token_merged_ratio = token_merging_ratio
+
+
+def set_token_merging_ratio(sd_model, token_merging_ratio):
+    """change ratio of already applied token merging without repatching, used for per-step schedule"""
+    model = sd_model.unet if hasattr(sd_model, 'unet') else getattr(sd_model, 'model', sd_model)
+    model = getattr(model, 'diffusion_model', model)
+    tome_info = getattr(model, '_tome_info', None)
+    if tome_info is not None:
+        tome_info['args']['ratio'] = token_merging_ratio
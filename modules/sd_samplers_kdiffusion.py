@@ -327,7 +327,7 @@ class KDiffusionSampler:
             sigma_min = 0
         sigma_max = sigmas.max()
 
-        current_iter_seeds = p.all_seeds[p.iteration * p.batch_size:(p.iteration + 1) * p.batch_size]
+        current_iter_seeds = p.seeds # may be a sub-batch of current iteration
         return BrownianTreeNoiseSampler(x, sigma_min, sigma_max, seed=current_iter_seeds)
 
     def sample_img2img(self, p, x, noise, conditioning, unconditional_conditioning, steps=None, image_conditioning=None):
@@ -1,9 +1,8 @@
 import os
 import collections
-import glob
 from copy import deepcopy
 import torch
-from modules import shared, paths, paths_internal, devices, script_callbacks, sd_models
+from modules import shared, paths, paths_internal, devices, script_callbacks, sd_models, files_index
 
 
 vae_ignore_keys = {"model_ema.decay", "model_ema.num_updates"}
@@ -55,40 +54,28 @@ def refresh_vae_list():
     global vae_path # pylint: disable=global-statement
     vae_path = shared.opts.vae_dir
     vae_dict.clear()
-    vae_paths = []
+    vae_paths = [] # list of (folder, suffixes) served by shared files index
     if shared.backend == shared.Backend.ORIGINAL:
         if sd_models.model_path is not None and os.path.isdir(sd_models.model_path):
-            vae_paths += [
-                os.path.join(sd_models.model_path, 'VAE', '**/*.vae.ckpt'),
-                os.path.join(sd_models.model_path, 'VAE', '**/*.vae.pt'),
-                os.path.join(sd_models.model_path, 'VAE', '**/*.vae.safetensors'),
-            ]
+            vae_paths.append((os.path.join(sd_models.model_path, 'VAE'), ('.vae.ckpt', '.vae.pt', '.vae.safetensors')))
         if shared.opts.ckpt_dir is not None and os.path.isdir(shared.opts.ckpt_dir):
-            vae_paths += [
-                os.path.join(shared.opts.ckpt_dir, '**/*.vae.ckpt'),
-                os.path.join(shared.opts.ckpt_dir, '**/*.vae.pt'),
-                os.path.join(shared.opts.ckpt_dir, '**/*.vae.safetensors'),
-            ]
+            vae_paths.append((shared.opts.ckpt_dir, ('.vae.ckpt', '.vae.pt', '.vae.safetensors')))
         if shared.opts.vae_dir is not None and os.path.isdir(shared.opts.vae_dir):
-            vae_paths += [
-                os.path.join(shared.opts.vae_dir, '**/*.ckpt'),
-                os.path.join(shared.opts.vae_dir, '**/*.pt'),
-                os.path.join(shared.opts.vae_dir, '**/*.safetensors'),
-            ]
+            vae_paths.append((shared.opts.vae_dir, ('.ckpt', '.pt', '.safetensors')))
     elif shared.backend == shared.Backend.DIFFUSERS:
         if sd_models.model_path is not None and os.path.isdir(sd_models.model_path):
-            vae_paths += [os.path.join(sd_models.model_path, 'VAE', '**/*.vae.safetensors')]
+            vae_paths.append((os.path.join(sd_models.model_path, 'VAE'), ('.vae.safetensors', )))
         if shared.opts.ckpt_dir is not None and os.path.isdir(shared.opts.ckpt_dir):
-            vae_paths += [os.path.join(shared.opts.ckpt_dir, '**/*.vae.safetensors')]
+            vae_paths.append((shared.opts.ckpt_dir, ('.vae.safetensors', )))
         if shared.opts.vae_dir is not None and os.path.isdir(shared.opts.vae_dir):
-            vae_paths += [os.path.join(shared.opts.vae_dir, '**/*.safetensors')]
-        vae_paths += [
-            os.path.join(sd_models.model_path, 'VAE', '**/*.json'),
-            os.path.join(shared.opts.vae_dir, '**/*.json'),
-        ]
+            vae_paths.append((shared.opts.vae_dir, ('.safetensors', )))
+        vae_paths.append((os.path.join(sd_models.model_path, 'VAE'), ('.json', )))
+        vae_paths.append((shared.opts.vae_dir, ('.json', )))
     candidates = []
-    for path in vae_paths:
-        candidates += glob.iglob(path, recursive=True)
+    for folder, suffixes in vae_paths:
+        if folder is None or not os.path.isdir(folder):
+            continue
+        candidates += [f for f in files_index.query('vaes', [folder]) if f.endswith(suffixes) and f not in candidates]
     for filepath in candidates:
         name = get_filename(filepath)
         if shared.backend == shared.Backend.ORIGINAL:
@@ -3,7 +3,11 @@ import sys
 import time
 import json
 import datetime
+import threading
+import contextlib
+import contextvars
 import urllib.request
+from types import MappingProxyType
 from urllib.parse import urlparse
 from enum import Enum
 import gradio as gr
@@ -356,11 +360,13 @@ options_templates.update(options_section(('sd', "Stable Diffusion"), {
     "sd_vae": OptionInfo("Automatic", "Select VAE", gr.Dropdown, lambda: {"choices": shared_items.sd_vae_items()}, refresh=shared_items.refresh_vae_list),
     "sd_model_dict": OptionInfo('None', "Stable Diffusion checkpoint dict", gr.Dropdown, lambda: {"choices": ['None'] + list_checkpoint_tiles()}, refresh=refresh_checkpoints),
     "stream_load": OptionInfo(False, "Load models using stream loading method"),
+    "sd_lazy_load": OptionInfo(True, "Load safetensors weights directly into model parameters without creating full state dict"),
     "model_reuse_dict": OptionInfo(False, "When loading models attempt to reuse previous model dictionary"),
     "prompt_attention": OptionInfo("Full parser", "Prompt attention parser", gr.Radio, lambda: {"choices": ["Full parser", "Compel parser", "A1111 parser", "Fixed attention"] }),
     "prompt_mean_norm": OptionInfo(True, "Prompt attention mean normalization"),
     "comma_padding_backtrack": OptionInfo(20, "Prompt padding for long prompts", gr.Slider, {"minimum": 0, "maximum": 74, "step": 1 }),
     "sd_disable_ckpt": OptionInfo(False, "Disallow usage of checkpoints in ckpt format"),
+    "safe_shadow_cache": OptionInfo(False, "Convert verified ckpt/pt files to safetensors cache on first load and use cache afterwards"),
 }))
 
 options_templates.update(options_section(('optimizations', "Optimizations"), {
@@ -372,7 +378,9 @@ options_templates.update(options_section(('optimizations', "Optimizations"), {
     "token_merging_ratio": OptionInfo(0.0, "Token merging ratio", gr.Slider, {"minimum": 0.0, "maximum": 0.9, "step": 0.1}),
     "token_merging_ratio_img2img": OptionInfo(0.0, "Token merging ratio for img2img", gr.Slider, {"minimum": 0.0, "maximum": 0.9, "step": 0.1}),
     "token_merging_ratio_hr": OptionInfo(0.0, "Token merging ratio for hires pass", gr.Slider, {"minimum": 0.0, "maximum": 0.9, "step": 0.1}),
+    "token_merging_late_start": OptionInfo(1.0, "Token merging ratio is reduced to zero starting at this fraction of steps (diffusers)", gr.Slider, {"minimum": 0.0, "maximum": 1.0, "step": 0.05}),
     "sd_vae_sliced_encode": OptionInfo(False, "Enable splitting of hires batch processing"),
+    "sd_vae_tiled_decode": OptionInfo(False, "Enable tiled VAE decode and img2img encode"),
 }))
 
 options_templates.update(options_section(('cuda', "Compute Settings"), {
@@ -394,10 +402,22 @@ options_templates.update(options_section(('cuda', "Compute Settings"), {
     "cuda_compile_backend": OptionInfo("openvino_fx" if cmd_opts.use_openvino else "none", "Model compile backend (experimental)", gr.Radio, lambda: {"choices": ['none', 'inductor', 'cudagraphs', 'aot_ts_nvfuser', 'hidet', 'ipex', 'openvino_fx']}),
     "cuda_compile_mode": OptionInfo("default", "Model compile mode (experimental)", gr.Radio, lambda: {"choices": ['default', 'reduce-overhead', 'max-autotune']}),
     "cuda_compile_fullgraph": OptionInfo(False, "Model compile fullgraph"),
-    "cuda_compile_precompile": OptionInfo(False, "Model compile precompile"),
+    "cuda_compile_precompile": OptionInfo(False, "Model compile precompile most used shapes in background"),
+    "cuda_compile_precompile_count": OptionInfo(3, "Model compile number of shapes to precompile", gr.Slider, {"minimum": 1, "maximum": 16, "step": 1}),
+    "cuda_compile_buckets": OptionInfo("", "Model compile resolution buckets, e.g. 512x512,768x768,1024x1024"),
+    "cuda_compile_batch_buckets": OptionInfo("1,2,4,8", "Model compile batch size buckets"),
+    "cuda_compile_cache": OptionInfo(True, "Model compile persistent compiler cache"),
     "cuda_compile_verbose": OptionInfo(False, "Model compile verbose mode"),
     "cuda_compile_errors": OptionInfo(True, "Model compile suppress errors"),
     "disable_gc": OptionInfo(True, "Disable Torch memory garbage collection"),
+    "lowvram_budget": OptionInfo(0, "Offload: VRAM for model blocks in MB, next blocks are prefetched while they fit (0=size of two largest blocks) (--medvram/--lowvram)", gr.Slider, {"minimum": 0, "maximum": 16384, "step": 256}),
+    "lowvram_pin_memory": OptionInfo(True, "Offload: keep offloaded weights in pinned system memory"),
+    "memory_planner": OptionInfo(False, "Memory planner: adjust attention, VAE tiling and batch size when job is predicted to exceed available VRAM"),
+    "memory_planner_limit": OptionInfo(0.9, "Memory planner: fraction of available VRAM jobs are planned to use", gr.Slider, {"minimum": 0.5, "maximum": 1.0, "step": 0.01}),
+    "oom_recovery": OptionInfo(True, "Recover from out-of-memory errors by retrying with smaller batches, lean attention and tiled or CPU VAE"),
+    "result_cache": OptionInfo(0, "Cache results of repeated jobs with fixed seed and serve them without processing (GB, 0=disabled)", gr.Slider, {"minimum": 0, "maximum": 100, "step": 1}),
+    "batch_jobs_max": OptionInfo(8, "Max images per batch when scripts combine jobs with compatible settings", gr.Slider, {"minimum": 1, "maximum": 64, "step": 1}),
+    "batch_prefetch": OptionInfo(4, "Input images decoded ahead of processing in batch mode", gr.Slider, {"minimum": 1, "maximum": 32, "step": 1}),
     "ipex_optimize": OptionInfo(True if devices.backend == "ipex" else False, "Enable IPEX Optimize for Intel GPUs"),
     "directml_memory_provider": OptionInfo(default_memory_provider, '[DirectML] Memory stats provider', gr.Dropdown, lambda: {"choices": memory_providers}),
 }))
@@ -408,9 +428,11 @@ options_templates.update(options_section(('diffusers', "Diffusers Settings"), {
     "diffusers_move_unet": OptionInfo(True, "Move base model to CPU when using VAE"),
     "diffusers_move_refiner": OptionInfo(True, "Move refiner model to CPU when not in use"),
     "diffusers_extract_ema": OptionInfo(True, "Use model EMA weights when possible"),
+    "diffusers_pipeline_cache": OptionInfo(0, "Cache converted single-file models in diffusers format (GB, 0=disabled)", gr.Slider, {"minimum": 0, "maximum": 200, "step": 1}),
     "diffusers_generator_device": OptionInfo("default", "Generator device", gr.Radio, lambda: {"choices": ["default", "cpu"]}),
     "diffusers_model_cpu_offload": OptionInfo(False, "Enable model CPU offload (--medvram)"),
     "diffusers_seq_cpu_offload": OptionInfo(False, "Enable sequential CPU offload (--lowvram)"),
+    "diffusers_offload_engine": OptionInfo(False, "Use prefetching offload engine instead of accelerate for CPU offload"),
     "diffusers_vae_upcast": OptionInfo("default", "VAE upcasting", gr.Radio, lambda: {"choices": ['default', 'true', 'false']}),
     "diffusers_vae_slicing": OptionInfo(True, "Enable VAE slicing"),
     "diffusers_vae_tiling": OptionInfo(True, "Enable VAE tiling"),
@@ -442,6 +464,7 @@ options_templates.update(options_section(('system-paths', "System Paths"), {
     "swinir_models_path": OptionInfo(os.path.join(paths.models_path, 'SwinIR'), "Path to directory with SwinIR model file(s)"),
     "ldsr_models_path": OptionInfo(os.path.join(paths.models_path, 'LDSR'), "Path to directory with LDSR model file(s)"),
     "clip_models_path": OptionInfo(os.path.join(paths.models_path, 'CLIP'), "Path to directory with CLIP model file(s)"),
+    "files_index_watch": OptionInfo(True, "Watch model folders for changes instead of polling", gr.Checkbox, {"visible": sys.platform.startswith('linux')}),
 }))
 
 options_templates.update(options_section(('saving-images', "Image Options"), {
@@ -462,6 +485,7 @@ options_templates.update(options_section(('saving-images', "Image Options"), {
     "n_rows": OptionInfo(-1, "Grid row count", gr.Slider, {"minimum": -1, "maximum": 16, "step": 1}),
     "save_txt": OptionInfo(False, "Create text file next to every image with generation parameters"),
     "save_log_fn": OptionInfo("", "Create JSON log file for each saved image", component_args=hide_dirs),
+    "image_catalogue": OptionInfo(True, "Add saved images to searchable image catalogue"),
     "save_images_before_highres_fix": OptionInfo(False, "Save copy of image before applying highres fix"),
     "save_images_before_refiner": OptionInfo(False, "Save copy of image before running refiner"),
     "save_images_before_face_restoration": OptionInfo(False, "Save copy of image before doing face restoration"),
@@ -521,6 +545,7 @@ options_templates.update(options_section(('ui', "User Interface"), {
     "hidden_tabs": OptionInfo([], "Hidden UI tabs", ui_components.DropdownMulti, lambda: {"choices": list(tab_names)}),
     "ui_tab_reorder": OptionInfo("From Text, From Image, Process Image", "UI tabs order"),
     "ui_scripts_reorder": OptionInfo("Enable Dynamic Thresholding, ControlNet", "UI scripts order"),
+    "scripts_reload_cache": OptionInfo(True, "Skip reloading unchanged scripts on UI reload"),
 }))
 
 options_templates.update(options_section(('live-preview', "Live Previews"), {
@@ -576,6 +601,7 @@ options_templates.update(options_section(('postprocessing', "Postprocessing"), {
     'postprocessing_enable_in_main_ui': OptionInfo([], "Enable addtional postprocessing operations", ui_components.DropdownMulti, lambda: {"choices": [x.name for x in shared_items.postprocessing_scripts()]}),
     'postprocessing_operation_order': OptionInfo([], "Postprocessing operation order", ui_components.DropdownMulti, lambda: {"choices": [x.name for x in shared_items.postprocessing_scripts()]}),
     'upscaling_max_images_in_cache': OptionInfo(5, "Maximum number of images in upscaling cache", gr.Slider, {"minimum": 0, "maximum": 10, "step": 1}),
+    'postprocessing_batch_size': OptionInfo(4, "Maximum number of images of same size processed together in batch mode", gr.Slider, {"minimum": 1, "maximum": 16, "step": 1}),
 }))
 
 options_templates.update(options_section(('training', "Training"), {
@@ -591,6 +617,9 @@ options_templates.update(options_section(('training', "Training"), {
     "training_enable_tensorboard": OptionInfo(False, "Enable tensorboard logging"),
     "training_tensorboard_save_images": OptionInfo(False, "Save generated images within tensorboard"),
     "training_tensorboard_flush_every": OptionInfo(120, "Tensorboard flush period"),
+    "preprocess_workers": OptionInfo(0, "Preprocess CPU worker processes (0 for auto)", gr.Slider, {"minimum": 0, "maximum": 64, "step": 1}),
+    "preprocess_caption_batch": OptionInfo(8, "Preprocess captioning batch size", gr.Slider, {"minimum": 1, "maximum": 64, "step": 1}),
+    "preprocess_resume": OptionInfo(True, "Resume interrupted preprocess runs in the same destination directory"),
 }))
 
 options_templates.update(options_section(('interrogate', "Interrogate"), {
@@ -609,10 +638,10 @@ options_templates.update(options_section(('interrogate', "Interrogate"), {
 }))
 
 options_templates.update(options_section(('upscaling', "Upscaling"), {
-    "face_restoration_model": OptionInfo("CodeFormer", "Face restoration model", gr.Radio, lambda: {"choices": [x.name() for x in face_restorers]}),
+    "face_restoration_model": OptionInfo("CodeFormer", "Face restoration model", gr.Radio, lambda: {"choices": [x.name() for x in sys.modules[__name__].face_restorers]}),
     "code_former_weight": OptionInfo(0.2, "CodeFormer weight parameter", gr.Slider, {"minimum": 0, "maximum": 1, "step": 0.01}),
     "face_restoration_unload": OptionInfo(False, "Move face restoration model from VRAM into RAM after processing"),
-    "upscaler_for_img2img": OptionInfo("None", "Default upscaler for image resize operations", gr.Dropdown, lambda: {"choices": [x.name for x in sd_upscalers]}),
+    "upscaler_for_img2img": OptionInfo("None", "Default upscaler for image resize operations", gr.Dropdown, lambda: {"choices": [x.name for x in sys.modules[__name__].sd_upscalers]}),
     "realesrgan_enabled_models": OptionInfo(["R-ESRGAN 4x+", "R-ESRGAN 4x+ Anime6B"], "Real-ESRGAN available models", gr.CheckboxGroup, lambda: {"choices": shared_items.realesrgan_models_names()}),
     "ESRGAN_tile": OptionInfo(192, "Tile size for ESRGAN upscalers", gr.Slider, {"minimum": 0, "maximum": 512, "step": 16}),
     "ESRGAN_tile_overlap": OptionInfo(8, "Tile overlap in pixels for ESRGAN upscalers", gr.Slider, {"minimum": 0, "maximum": 48, "step": 1}),
@@ -648,6 +677,10 @@ options_templates.update(options_section((None, "Hidden options"), {
 
 options_templates.update()
 
+opts_overlay = contextvars.ContextVar('opts_overlay', default=None) # per-job read-only settings that shadow global options
+model_opts = ['sd_model_checkpoint', 'sd_model_refiner', 'sd_model_dict', 'sd_vae'] # options that require model state to match
+overlay_restricted_opts = ['sd_backend'] # options that cannot be applied per-job
+
 
 class Options:
     data = None
@@ -671,6 +704,9 @@ class Options:
         return super(Options, self).__setattr__(key, value) # pylint: disable=super-with-arguments
 
     def __getattr__(self, item):
+        overlay = opts_overlay.get()
+        if overlay is not None and item in overlay:
+            return overlay[item]
         if self.data is not None:
             if item in self.data:
                 return self.data[item]
@@ -698,6 +734,24 @@ class Options:
                 return False
         return True
 
+    @contextlib.contextmanager
+    def overlay(self, settings: dict):
+        """applies settings for the current job only: reads in this context see them, global options and other jobs are not modified"""
+        current = opts_overlay.get() or {}
+        token = opts_overlay.set(MappingProxyType({**current, **settings}))
+        try:
+            yield opts_overlay.get()
+        finally:
+            opts_overlay.reset(token)
+
+    def is_overridden(self, key):
+        overlay = opts_overlay.get()
+        return overlay is not None and key in overlay
+
+    def snapshot(self):
+        """immutable view of effective options for the current job"""
+        return MappingProxyType({**self.data, **(opts_overlay.get() or {})})
+
     def get_default(self, key):
         """returns the default value for the key"""
         data_label = self.data_labels.get(key)
@@ -980,6 +1034,44 @@ def get_version():
     return version
 
 
+lazy_loaders = {} # deferred initializers registered when running with --lazy
+lazy_pending = {} # loaders in progress: name -> (event, thread)
+lazy_lock = threading.RLock()
+
+
+def lazy_register(name, loader):
+    lazy_loaders[name] = loader
+
+
+def lazy_load(name):
+    """first caller runs loader, callers from other threads wait until it finishes instead of seeing empty results"""
+    if name not in lazy_loaders and name not in lazy_pending:
+        return
+    with lazy_lock:
+        loader = lazy_loaders.get(name, None)
+        if loader is not None: # marked pending before removal so unlocked check above never sees neither
+            lazy_pending[name] = (threading.Event(), threading.get_ident())
+            del lazy_loaders[name]
+        pending = lazy_pending.get(name, None)
+    if pending is None:
+        return
+    event, thread = pending
+    if loader is None:
+        if thread != threading.get_ident(): # loader itself can trigger lazy load of same name
+            event.wait()
+        return
+    t0 = time.time()
+    try:
+        loader()
+    except Exception as e:
+        log.error(f'Lazy load failed: {name} {e}')
+    finally:
+        with lazy_lock:
+            lazy_pending.pop(name, None)
+        event.set()
+    log.debug(f'Lazy load: {name} time={time.time() - t0:.2f}s')
+
+
 class Shared(sys.modules[__name__].__class__): # this class is here to provide sd_model field as a property, so that it can be created and loaded on demand rather than at program startup.
     @property
     def sd_model(self):
@@ -1001,6 +1093,26 @@ class Shared(sys.modules[__name__].__class__): # this class is here to provide s
         import modules.sd_models # pylint: disable=W0621
         modules.sd_models.model_data.set_sd_refiner(value)
 
+    @property
+    def sd_upscalers(self):
+        lazy_load('upscalers')
+        return sd_upscalers
+
+    @sd_upscalers.setter
+    def sd_upscalers(self, value):
+        global sd_upscalers # pylint: disable=global-statement
+        sd_upscalers = value
+
+    @property
+    def face_restorers(self):
+        lazy_load('face_restorers')
+        return face_restorers
+
+    @face_restorers.setter
+    def face_restorers(self, value):
+        global face_restorers # pylint: disable=global-statement
+        face_restorers = value
+
     @property
     def backend(self):
         return Backend.ORIGINAL if not cmd_opts.use_openvino and opts.data['sd_backend'] == 'original' else Backend.DIFFUSERS
@@ -26,5 +26,6 @@ def list_crossattention():
         "Doggettx's",
         "InvokeAI's",
         "Sub-quadratic",
-        "Split attention"
+        "Split attention",
+        "Automatic",
     ]
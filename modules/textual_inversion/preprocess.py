@@ -1,9 +1,16 @@
 import os
-import math
+import time
+import json
+import hashlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
-from PIL import Image, ImageOps
 from modules import paths, shared, images, deepbooru
 from modules.textual_inversion import autocrop
+from modules.textual_inversion.preprocess_worker import PreprocessTask, process_file, split_pic, center_crop, multicrop_pic # pylint: disable=unused-import
+
+
+progress_filename = '.preprocess.json'
 
 
 def preprocess(id_task, process_src, process_dst, process_width, process_height, preprocess_txt_action, process_keep_original_size=False, process_keep_channels=False, process_flip=False, process_split=False, process_caption_only=False, process_caption=False, process_caption_deepbooru=False, split_threshold=0.5, overlap_ratio=0.2, process_focal_crop=False, process_focal_crop_face_weight=0.9, process_focal_crop_entropy_weight=0.3, process_focal_crop_edges_weight=0.5, process_focal_crop_debug=False, process_multicrop=None, process_multicrop_mindim=None, process_multicrop_maxdim=None, process_multicrop_minarea=None, process_multicrop_maxarea=None, process_multicrop_objective=None, process_multicrop_threshold=None): # pylint: disable=unused-argument
@@ -40,93 +47,116 @@ class PreprocessParams:
     preprocess_txt_action = None
 
 
-def save_pic_with_caption(image, index, params: PreprocessParams, existing_caption=None, existing_caption_filename=None):
-    caption = ""
-    if params.process_caption:
-        caption += shared.interrogator.generate_caption(image)
-    if params.process_caption_deepbooru:
-        if len(caption) > 0:
-            caption += ", "
-        caption += deepbooru.model.tag_multi(image)
+class PreprocessStats:
+    """per-stage time and throughput accounting for preprocess runs"""
+
+    def __init__(self):
+        self.stages = {}
 
-    filename_part = params.src
-    filename_part = os.path.splitext(filename_part)[0]
-    filename_part = os.path.basename(filename_part)
+    def record(self, stage, duration, count=1):
+        if stage not in self.stages:
+            self.stages[stage] = [0, 0]
+        self.stages[stage][0] += duration
+        self.stages[stage][1] += count
 
-    basename = f"{index:05}-{params.subindex}-{filename_part}"
-    if not params.process_caption_only:
-        image.save(os.path.join(params.dstdir, f"{basename}.png"))
+    def summary(self):
+        return ' '.join([f'{stage}={count}/{duration:.1f}s/{(count / duration if duration > 0 else 0):.1f}/s' for stage, (duration, count) in self.stages.items()])
 
+
+class PreprocessProgress:
+    """resumable progress stored in destination folder, keyed by source file and preprocess settings"""
+
+    def __init__(self, dstdir, settings):
+        self.filename = os.path.join(dstdir, progress_filename)
+        self.key = hashlib.sha256(json.dumps(settings, default=str).encode()).hexdigest()[:16]
+        self.done = {}
+        self.dirty = 0
+        if not shared.opts.preprocess_resume:
+            return
+        data = shared.readfile(self.filename, silent=True)
+        if data.get('key', None) == self.key:
+            self.done = data.get('done', {})
+            if len(self.done) > 0:
+                shared.log.info(f'Preprocess resume: {self.filename} completed={len(self.done)}')
+
+    def is_done(self, filename):
+        try:
+            return self.done.get(os.path.basename(filename), None) == os.path.getmtime(filename)
+        except OSError:
+            return False
+
+    def mark(self, filename):
+        try:
+            self.done[os.path.basename(filename)] = os.path.getmtime(filename)
+        except OSError:
+            return
+        self.dirty += 1
+        if self.dirty >= 100:
+            self.save()
+
+    def save(self):
+        if not shared.opts.preprocess_resume or self.dirty == 0:
+            return
+        shared.writefile({ 'key': self.key, 'done': self.done }, self.filename)
+        self.dirty = 0
+
+
+def build_caption(caption, params: PreprocessParams, existing_caption=None):
     if params.preprocess_txt_action == 'prepend' and existing_caption:
         caption = f"{existing_caption} {caption}"
     elif params.preprocess_txt_action == 'append' and existing_caption:
         caption = f"{caption} {existing_caption}"
     elif params.preprocess_txt_action == 'copy' and existing_caption:
         caption = existing_caption
-    caption = caption.strip()
-    if len(caption) > 0:
-        if params.process_caption_only:
-            fn = os.path.join(params.dstdir, f"{filename_part}.txt")
-        elif existing_caption_filename is not None:
-            fn = existing_caption_filename
-        else:
-            fn = os.path.join(params.dstdir, f"{basename}.txt")
-        with open(fn, "w", encoding="utf8") as file:
-            file.write(caption)
-
-    params.subindex += 1
-
-
-def save_pic(image, index, params, existing_caption=None, existing_caption_filename=None):
-    save_pic_with_caption(image, index, params, existing_caption=existing_caption, existing_caption_filename=existing_caption_filename)
-    if params.flip:
-        save_pic_with_caption(ImageOps.mirror(image), index, params, existing_caption=existing_caption, existing_caption_filename=existing_caption_filename)
-
-
-def split_pic(image, inverse_xy, width, height, overlap_ratio):
-    if inverse_xy:
-        from_w, from_h = image.height, image.width
-        to_w, to_h = height, width
-    else:
-        from_w, from_h = image.width, image.height
-        to_w, to_h = width, height
-    h = from_h * to_w // from_w
-    if inverse_xy:
-        image = image.resize((h, to_w))
-    else:
-        image = image.resize((to_w, h))
-
-    split_count = math.ceil((h - to_h * overlap_ratio) / (to_h * (1.0 - overlap_ratio)))
-    y_step = (h - to_h) / (split_count - 1)
-    for i in range(split_count):
-        y = int(y_step * i)
-        if inverse_xy:
-            splitted = image.crop((y, 0, y + to_h, to_w))
-        else:
-            splitted = image.crop((0, y, to_w, y + to_h))
-        yield splitted
-
-# not using torchvision.transforms.CenterCrop because it doesn't allow float regions
-def center_crop(image: Image, w: int, h: int):
-    iw, ih = image.size
-    if ih / h < iw / w:
-        sw = w * ih / h
-        box = (iw - sw) / 2, 0, iw - (iw - sw) / 2, ih
-    else:
-        sh = h * iw / w
-        box = 0, (ih - sh) / 2, iw, ih - (ih - sh) / 2
-    return image.resize((w, h), Image.Resampling.LANCZOS, box)
+    return caption.strip()
 
 
-def multicrop_pic(image: Image, mindim, maxdim, minarea, maxarea, objective, threshold):
-    iw, ih = image.size
-    err = lambda w, h: 1-(lambda x: x if x < 1 else 1/x)(iw/ih/(w/h)) # pylint: disable=unnecessary-lambda-assignment,unnecessary-direct-lambda-call
-    wh = max(((w, h) for w in range(mindim, maxdim+1, 64) for h in range(mindim, maxdim+1, 64)
-        if minarea <= w * h <= maxarea and err(w, h) <= threshold),
-        key= lambda wh: (wh[0]*wh[1], -err(*wh))[::1 if objective=='Maximize area' else -1],
-        default=None
-    )
-    return wh and center_crop(image, *wh)
+def caption_items(items, params: PreprocessParams):
+    """device stage: run captioning models over a batch of images"""
+    captions = ["" for _ in items]
+    batch = [item.image for item in items]
+    if params.process_caption:
+        captions = list(shared.interrogator.generate_captions(batch))
+    if params.process_caption_deepbooru:
+        tags = deepbooru.model.tag_batch(batch)
+        captions = [f'{caption}, {tag}' if len(caption) > 0 else tag for caption, tag in zip(captions, tags)]
+    return captions
+
+
+def write_caption(caption, item, src, params: PreprocessParams, existing_caption=None):
+    caption = build_caption(caption, params, existing_caption=existing_caption)
+    if len(caption) == 0:
+        return
+    if params.process_caption_only:
+        fn = os.path.join(params.dstdir, f"{os.path.basename(os.path.splitext(src)[0])}.txt")
+    elif item.caption_filename is not None:
+        fn = item.caption_filename
+    else:
+        fn = os.path.join(params.dstdir, f"{item.basename}.txt")
+    with open(fn, "w", encoding="utf8") as file:
+        file.write(caption)
+
+
+def run_tasks(tasks, workers):
+    """cpu stage: stream results in submission order while keeping a bounded number of tasks in flight"""
+    if workers <= 1:
+        for task in tasks:
+            yield process_file(task)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for task in tasks:
+            pending.append(executor.submit(process_file, task))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+            if shared.state.interrupted:
+                break
+        while len(pending) > 0:
+            future = pending.popleft()
+            if shared.state.interrupted:
+                future.cancel()
+                continue
+            yield future.result()
 
 
 def preprocess_work(process_src, process_dst, process_width, process_height, preprocess_txt_action, process_keep_original_size, process_keep_channels, process_flip, process_split, process_caption, process_caption_deepbooru, process_caption_only, split_threshold, overlap_ratio, process_focal_crop, process_focal_crop_face_weight, process_focal_crop_entropy_weight, process_focal_crop_edges_weight, process_focal_crop_debug, process_multicrop, process_multicrop_mindim, process_multicrop_maxdim, process_multicrop_minarea, process_multicrop_maxarea, process_multicrop_objective, process_multicrop_threshold):
@@ -156,84 +186,90 @@ def preprocess_work(process_src, process_dst, process_width, process_height, pre
     params.process_caption_deepbooru = process_caption_deepbooru
     params.preprocess_txt_action = preprocess_txt_action
 
-    pbar = tqdm(files)
-    for index, imagefile in enumerate(pbar):
-        params.subindex = 0
-        filename = os.path.join(src, imagefile)
+    dnn_model_path = None
+    if process_focal_crop:
         try:
-            img = Image.open(filename)
-            img = ImageOps.exif_transpose(img)
-            if not process_keep_channels:
-                img = img.convert("RGB")
-        except Exception:
+            dnn_model_path = autocrop.download_and_cache_models(os.path.join(paths.models_path, "opencv"))
+        except Exception as e:
+            shared.log.warning(f"Unable to load face detection model for auto crop selection, falling back to lower quality haar method: {e}")
+
+    upscaler = shared.opts.upscaler_for_img2img
+    settings = [src, width, height, preprocess_txt_action, process_keep_original_size, process_keep_channels, process_flip, process_split, process_caption, process_caption_deepbooru, process_caption_only, split_threshold, overlap_ratio, process_focal_crop, process_focal_crop_face_weight, process_focal_crop_entropy_weight, process_focal_crop_edges_weight, process_focal_crop_debug, process_multicrop, process_multicrop_mindim, process_multicrop_maxdim, process_multicrop_minarea, process_multicrop_maxarea, process_multicrop_objective, process_multicrop_threshold, upscaler]
+    progress = PreprocessProgress(dst, settings)
+    workers = shared.opts.preprocess_workers if shared.opts.preprocess_workers > 0 else max(1, (os.cpu_count() or 1) - 1)
+    workers = min(workers, len(files))
+    caption_batch = max(1, shared.opts.preprocess_caption_batch)
+    captioning = process_caption or process_caption_deepbooru
+    stats = PreprocessStats()
+
+    tasks = []
+    for index, imagefile in enumerate(files):
+        filename = os.path.join(src, imagefile)
+        if progress.is_done(filename):
+            shared.state.nextjob()
             continue
-
-        description = f"Preprocessing image {index + 1}/{len(files)}"
+        tasks.append(PreprocessTask(
+            index=index, filename=filename, dstdir=dst, width=width, height=height,
+            keep_original_size=process_keep_original_size, keep_channels=process_keep_channels, flip=process_flip, split=process_split, caption_only=process_caption_only,
+            split_threshold=split_threshold, overlap_ratio=overlap_ratio,
+            focal_crop=process_focal_crop, focal_crop_face_weight=process_focal_crop_face_weight, focal_crop_entropy_weight=process_focal_crop_entropy_weight, focal_crop_edges_weight=process_focal_crop_edges_weight, focal_crop_debug=process_focal_crop_debug, dnn_model_path=dnn_model_path,
+            multicrop=process_multicrop, multicrop_mindim=process_multicrop_mindim, multicrop_maxdim=process_multicrop_maxdim, multicrop_minarea=process_multicrop_minarea, multicrop_maxarea=process_multicrop_maxarea, multicrop_objective=process_multicrop_objective, multicrop_threshold=process_multicrop_threshold,
+            resize_in_worker=upscaler is None or upscaler == "None",
+            return_images=captioning,
+        ))
+    if len(tasks) < len(files):
+        shared.log.info(f'Preprocess skipping completed: {len(files) - len(tasks)}')
+    shared.log.info(f'Preprocess: src="{src}" dst="{dst}" files={len(tasks)} workers={workers} caption-batch={caption_batch if captioning else 0}')
+
+    pending = [] # results waiting for captioning batch to fill
+
+    def flush():
+        queue = [(res, item) for res in pending for item in res.items]
+        for i in range(0, len(queue), caption_batch):
+            chunk = queue[i:i + caption_batch]
+            if captioning:
+                t0 = time.time()
+                captions = caption_items([item for _res, item in chunk], params)
+                stats.record('caption', time.time() - t0, len(chunk))
+            else:
+                captions = ["" for _ in chunk]
+            for (res, item), caption in zip(chunk, captions):
+                write_caption(caption, item, res.filename, params, existing_caption=res.existing_caption)
+                item.image = None
+        for res in pending:
+            progress.mark(res.filename)
+            shared.state.nextjob()
+        pending.clear()
+
+    t_start = time.time()
+    pbar = tqdm(total=len(tasks))
+    for res in run_tasks(tasks, workers):
+        pbar.update(1)
+        description = f"Preprocessing image {res.index + 1}/{len(files)}"
         pbar.set_description(description)
         shared.state.textinfo = description
-
-        params.src = filename
-
-        existing_caption = None
-        existing_caption_filename = f"{os.path.splitext(filename)[0]}.txt"
-        if os.path.exists(existing_caption_filename):
-            with open(existing_caption_filename, 'r', encoding="utf8") as file:
-                existing_caption = file.read()
-        else:
-            existing_caption_filename = None
-
+        for msg in res.messages:
+            shared.log.info(f'Preprocess: {msg}')
+        if res.error is not None:
+            shared.log.debug(f'Preprocess skipping: {res.filename} {res.error}')
+            shared.state.nextjob()
+            continue
+        stats.record('load', res.time_load)
+        stats.record('crop', res.time_crop)
+        t0 = time.time()
+        for item in res.items:
+            if item.saved or item.image is None:
+                continue
+            item.image = images.resize_image(1, item.image, width, height) # default resize using configured upscaler
+            if not process_caption_only:
+                item.image.save(os.path.join(dst, f"{item.basename}.png"))
+        stats.record('save', res.time_save + time.time() - t0, len(res.items))
+        pending.append(res)
+        if sum([len(r.items) for r in pending]) >= caption_batch or not captioning:
+            flush()
         if shared.state.interrupted:
             break
-
-        if img.height > img.width:
-            ratio = (img.width * height) / (img.height * width)
-            inverse_xy = False
-        else:
-            ratio = (img.height * width) / (img.width * height)
-            inverse_xy = True
-
-        process_default_resize = True
-
-        if process_split and ratio < 1.0 and ratio <= split_threshold:
-            for splitted in split_pic(img, inverse_xy, width, height, overlap_ratio):
-                save_pic(splitted, index, params, existing_caption=existing_caption, existing_caption_filename=existing_caption_filename)
-            process_default_resize = False
-
-        if process_focal_crop and img.height != img.width:
-
-            dnn_model_path = None
-            try:
-                dnn_model_path = autocrop.download_and_cache_models(os.path.join(paths.models_path, "opencv"))
-            except Exception as e:
-                print("Unable to load face detection model for auto crop selection. Falling back to lower quality haar method.", e)
-
-            autocrop_settings = autocrop.Settings(
-                crop_width = width,
-                crop_height = height,
-                face_points_weight = process_focal_crop_face_weight,
-                entropy_points_weight = process_focal_crop_entropy_weight,
-                corner_points_weight = process_focal_crop_edges_weight,
-                annotate_image = process_focal_crop_debug,
-                dnn_model_path = dnn_model_path,
-            )
-            for focal in autocrop.crop_image(img, autocrop_settings):
-                save_pic(focal, index, params, existing_caption=existing_caption)
-            process_default_resize = False
-
-        if process_multicrop:
-            cropped = multicrop_pic(img, process_multicrop_mindim, process_multicrop_maxdim, process_multicrop_minarea, process_multicrop_maxarea, process_multicrop_objective, process_multicrop_threshold)
-            if cropped is not None:
-                save_pic(cropped, index, params, existing_caption=existing_caption)
-            else:
-                print(f"skipped {img.width}x{img.height} image {filename} (can't find suitable size within error threshold)")
-            process_default_resize = False
-
-        if process_keep_original_size:
-            save_pic(img, index, params, existing_caption=existing_caption)
-            process_default_resize = False
-
-        if process_default_resize:
-            img = images.resize_image(1, img, width, height)
-            save_pic(img, index, params, existing_caption=existing_caption)
-
-        shared.state.nextjob()
+    flush()
+    pbar.close()
+    progress.save()
+    shared.log.info(f'Preprocess: {"interrupted" if shared.state.interrupted else "finished"} files={len(tasks)} time={time.time() - t_start:.1f}s workers={workers} {stats.summary()}')
@@ -0,0 +1,202 @@
+import os
+import math
+import time
+from PIL import Image, ImageOps
+from modules.textual_inversion import autocrop
+
+# this module runs inside preprocess worker processes so it must not import modules.shared or anything that depends on it
+
+
+class PreprocessTask:
+    def __init__(self, index, filename, dstdir, width, height, keep_original_size=False, keep_channels=False, flip=False, split=False, caption_only=False, split_threshold=0.5, overlap_ratio=0.2, focal_crop=False, focal_crop_face_weight=0.9, focal_crop_entropy_weight=0.3, focal_crop_edges_weight=0.5, focal_crop_debug=False, dnn_model_path=None, multicrop=False, multicrop_mindim=None, multicrop_maxdim=None, multicrop_minarea=None, multicrop_maxarea=None, multicrop_objective=None, multicrop_threshold=None, resize_in_worker=True, return_images=False):
+        self.index = index
+        self.filename = filename
+        self.dstdir = dstdir
+        self.width = width
+        self.height = height
+        self.keep_original_size = keep_original_size
+        self.keep_channels = keep_channels
+        self.flip = flip
+        self.split = split
+        self.caption_only = caption_only
+        self.split_threshold = split_threshold
+        self.overlap_ratio = overlap_ratio
+        self.focal_crop = focal_crop
+        self.focal_crop_face_weight = focal_crop_face_weight
+        self.focal_crop_entropy_weight = focal_crop_entropy_weight
+        self.focal_crop_edges_weight = focal_crop_edges_weight
+        self.focal_crop_debug = focal_crop_debug
+        self.dnn_model_path = dnn_model_path
+        self.multicrop = multicrop
+        self.multicrop_mindim = multicrop_mindim
+        self.multicrop_maxdim = multicrop_maxdim
+        self.multicrop_minarea = multicrop_minarea
+        self.multicrop_maxarea = multicrop_maxarea
+        self.multicrop_objective = multicrop_objective
+        self.multicrop_threshold = multicrop_threshold
+        self.resize_in_worker = resize_in_worker # default resize with configured upscaler must run in main process
+        self.return_images = return_images # images are only sent back to main process when captioning is enabled
+
+
+class PreprocessItem:
+    def __init__(self, basename, image=None, caption_filename=None, saved=False):
+        self.basename = basename
+        self.image = image
+        self.caption_filename = caption_filename
+        self.saved = saved
+
+
+class PreprocessResult:
+    def __init__(self, index, filename):
+        self.index = index
+        self.filename = filename
+        self.items = []
+        self.existing_caption = None
+        self.existing_caption_filename = None
+        self.messages = []
+        self.error = None
+        self.time_load = 0
+        self.time_crop = 0
+        self.time_save = 0
+
+
+def split_pic(image, inverse_xy, width, height, overlap_ratio):
+    if inverse_xy:
+        from_w, from_h = image.height, image.width
+        to_w, to_h = height, width
+    else:
+        from_w, from_h = image.width, image.height
+        to_w, to_h = width, height
+    h = from_h * to_w // from_w
+    if inverse_xy:
+        image = image.resize((h, to_w))
+    else:
+        image = image.resize((to_w, h))
+
+    split_count = math.ceil((h - to_h * overlap_ratio) / (to_h * (1.0 - overlap_ratio)))
+    y_step = (h - to_h) / (split_count - 1)
+    for i in range(split_count):
+        y = int(y_step * i)
+        if inverse_xy:
+            splitted = image.crop((y, 0, y + to_h, to_w))
+        else:
+            splitted = image.crop((0, y, to_w, y + to_h))
+        yield splitted
+
+# not using torchvision.transforms.CenterCrop because it doesn't allow float regions
+def center_crop(image: Image, w: int, h: int):
+    iw, ih = image.size
+    if ih / h < iw / w:
+        sw = w * ih / h
+        box = (iw - sw) / 2, 0, iw - (iw - sw) / 2, ih
+    else:
+        sh = h * iw / w
+        box = 0, (ih - sh) / 2, iw, ih - (ih - sh) / 2
+    return image.resize((w, h), Image.Resampling.LANCZOS, box)
+
+
+def multicrop_pic(image: Image, mindim, maxdim, minarea, maxarea, objective, threshold):
+    iw, ih = image.size
+    err = lambda w, h: 1-(lambda x: x if x < 1 else 1/x)(iw/ih/(w/h)) # pylint: disable=unnecessary-lambda-assignment,unnecessary-direct-lambda-call
+    wh = max(((w, h) for w in range(mindim, maxdim+1, 64) for h in range(mindim, maxdim+1, 64)
+        if minarea <= w * h <= maxarea and err(w, h) <= threshold),
+        key= lambda wh: (wh[0]*wh[1], -err(*wh))[::1 if objective=='Maximize area' else -1],
+        default=None
+    )
+    return wh and center_crop(image, *wh)
+
+
+def process_file(task: PreprocessTask):
+    """cpu stage: load, crop, flip and encode all outputs for a single source image"""
+    res = PreprocessResult(task.index, task.filename)
+    subindex = 0
+    filename_part = os.path.basename(os.path.splitext(task.filename)[0])
+
+    def emit(image, caption_filename=None, resize=False):
+        nonlocal subindex
+        variants = [image, ImageOps.mirror(image)] if task.flip else [image]
+        for variant in variants:
+            basename = f"{task.index:05}-{subindex}-{filename_part}"
+            subindex += 1
+            item = PreprocessItem(basename, caption_filename=caption_filename)
+            if resize: # main process resizes and saves using upscaler
+                item.image = variant
+            else:
+                if not task.caption_only:
+                    t0 = time.time()
+                    variant.save(os.path.join(task.dstdir, f"{basename}.png"))
+                    res.time_save += time.time() - t0
+                    item.saved = True
+                if task.return_images:
+                    item.image = variant
+            res.items.append(item)
+
+    t0 = time.time()
+    try:
+        img = Image.open(task.filename)
+        img = ImageOps.exif_transpose(img)
+        if not task.keep_channels:
+            img = img.convert("RGB")
+        else:
+            img.load()
+    except Exception as e:
+        res.error = str(e)
+        return res
+    existing_caption_filename = f"{os.path.splitext(task.filename)[0]}.txt"
+    if os.path.exists(existing_caption_filename):
+        with open(existing_caption_filename, 'r', encoding="utf8") as file:
+            res.existing_caption = file.read()
+        res.existing_caption_filename = existing_caption_filename
+    res.time_load = time.time() - t0
+
+    t0 = time.time()
+    try:
+        if img.height > img.width:
+            ratio = (img.width * task.height) / (img.height * task.width)
+            inverse_xy = False
+        else:
+            ratio = (img.height * task.width) / (img.width * task.height)
+            inverse_xy = True
+
+        process_default_resize = True
+
+        if task.split and ratio < 1.0 and ratio <= task.split_threshold:
+            for splitted in split_pic(img, inverse_xy, task.width, task.height, task.overlap_ratio):
+                emit(splitted, caption_filename=res.existing_caption_filename)
+            process_default_resize = False
+
+        if task.focal_crop and img.height != img.width:
+            autocrop_settings = autocrop.Settings(
+                crop_width = task.width,
+                crop_height = task.height,
+                face_points_weight = task.focal_crop_face_weight,
+                entropy_points_weight = task.focal_crop_entropy_weight,
+                corner_points_weight = task.focal_crop_edges_weight,
+                annotate_image = task.focal_crop_debug,
+                dnn_model_path = task.dnn_model_path,
+            )
+            for focal in autocrop.crop_image(img, autocrop_settings):
+                emit(focal)
+            process_default_resize = False
+
+        if task.multicrop:
+            cropped = multicrop_pic(img, task.multicrop_mindim, task.multicrop_maxdim, task.multicrop_minarea, task.multicrop_maxarea, task.multicrop_objective, task.multicrop_threshold)
+            if cropped is not None:
+                emit(cropped)
+            else:
+                res.messages.append(f"skipped {img.width}x{img.height} image {task.filename} (can't find suitable size within error threshold)")
+            process_default_resize = False
+
+        if task.keep_original_size:
+            emit(img)
+            process_default_resize = False
+
+        if process_default_resize:
+            if task.resize_in_worker:
+                emit(img.resize((task.width, task.height), resample=Image.Resampling.LANCZOS))
+            else:
+                emit(img, resize=True)
+    except Exception as e:
+        res.messages.append(f"error processing {task.filename}: {e}")
+    res.time_crop = time.time() - t0 - res.time_save
+    return res
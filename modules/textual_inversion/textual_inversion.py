@@ -8,12 +8,12 @@ import safetensors.torch
 import numpy as np
 from PIL import Image, PngImagePlugin
 from torch.utils.tensorboard import SummaryWriter
-from modules import shared, devices, sd_hijack, processing, sd_models, images, sd_samplers, sd_hijack_checkpoint, errors
+from modules import shared, devices, sd_hijack, processing, sd_models, images, sd_samplers, sd_hijack_checkpoint, errors, files_index
 import modules.textual_inversion.dataset
 from modules.textual_inversion.learn_schedule import LearnRateScheduler
 from modules.textual_inversion.image_embedding import embedding_to_b64, embedding_from_b64, insert_image_data_embed, extract_image_data_embed, caption_image_overlay
 from modules.textual_inversion.logging import save_settings_to_file
-from modules.modelloader import directory_files, extension_filter, directory_mtime
+from modules.modelloader import directory_files, extension_filter, directory_has_changed
 
 TextualInversionTemplate = namedtuple("TextualInversionTemplate", ["name", "path"])
 textual_inversion_templates = {}
@@ -80,19 +80,19 @@ class Embedding:
 class DirWithTextualInversionEmbeddings:
     def __init__(self, path):
         self.path = path
-        self.mtime = None
+        self.generation = None
 
     def has_changed(self):
         if not os.path.isdir(self.path):
             return False
-
-        return directory_mtime(self.path) != self.mtime
+        if self.generation is None:
+            return True
+        return directory_has_changed(self.path, generation=self.generation)
 
     def update(self):
         if not os.path.isdir(self.path):
             return
-
-        self.mtime = directory_mtime(self.path)
+        self.generation = files_index.get_index().generation_of(self.path)
 
 
 class EmbeddingDatabase:
@@ -367,6 +367,8 @@ def train_embedding(id_task, embedding_name, learn_rate, batch_size, gradient_st
     shared.log.debug(f'train_embedding: embedding_name={embedding_name}|learn_rate={learn_rate}|batch_size={batch_size}|gradient_step={gradient_step}|data_root={data_root}|log_directory={log_directory}|training_width={training_width}|training_height={training_height}|varsize={varsize}|steps={steps}|clip_grad_mode={clip_grad_mode}|clip_grad_value={clip_grad_value}|shuffle_tags={shuffle_tags}|tag_drop_out={tag_drop_out}|latent_sampling_method={latent_sampling_method}|use_weight={use_weight}|create_image_every={create_image_every}|save_embedding_every={save_embedding_every}|template_filename={template_filename}|save_image_with_stored_embedding={save_image_with_stored_embedding}|preview_from_txt2img={preview_from_txt2img}|preview_prompt={preview_prompt}|preview_negative_prompt={preview_negative_prompt}|preview_steps={preview_steps}|preview_sampler_index={preview_sampler_index}|preview_cfg_scale={preview_cfg_scale}|preview_seed={preview_seed}|preview_width={preview_width}|preview_height={preview_height}')
     save_embedding_every = save_embedding_every or 0
     create_image_every = create_image_every or 0
+    if len(textual_inversion_templates) == 0: # not yet listed when started with --lazy
+        list_textual_inversion_templates()
     template_file = textual_inversion_templates.get(template_filename, None)
     validate_train_inputs(embedding_name, learn_rate, batch_size, gradient_step, data_root, template_file, template_filename, steps, save_embedding_every, create_image_every, name="embedding")
     if log_directory is None or log_directory == '':
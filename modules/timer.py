@@ -1,4 +1,7 @@
+import sys
 import time
+import builtins
+import threading
 
 
 class Timer:
@@ -36,3 +39,75 @@ class Timer:
 
     def reset(self):
         self.__init__()
+
+
+class ImportTimer:
+    """records wall time of module imports to report per-module cost and the startup critical path"""
+
+    def __init__(self):
+        self.roots = []
+        self.local = threading.local()
+        self.original = None
+
+    def install(self):
+        if self.original is None:
+            self.original = builtins.__import__
+            builtins.__import__ = self.wrapped_import
+
+    def uninstall(self):
+        if self.original is not None:
+            builtins.__import__ = self.original
+            self.original = None
+
+    def wrapped_import(self, name, globals=None, locals=None, fromlist=(), level=0): # pylint: disable=redefined-builtin
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        label = name
+        if level > 0 and globals is not None:
+            label = f"{globals.get('__package__') or ''}.{name}".strip('.')
+        node = { 'name': label, 'total': 0, 'children': [] }
+        loaded = len(sys.modules)
+        stack.append(node)
+        t0 = time.perf_counter()
+        try:
+            return self.original(name, globals, locals, fromlist, level)
+        finally:
+            node['total'] = time.perf_counter() - t0
+            stack.pop()
+            if len(sys.modules) > loaded: # only record imports that actually loaded new modules
+                if len(stack) > 0:
+                    stack[-1]['children'].append(node)
+                else:
+                    self.roots.append(node)
+
+    def modules(self):
+        """returns flattened list of (name, self time, total time)"""
+        res = {}
+
+        def walk(node):
+            own = node['total'] - sum([child['total'] for child in node['children']])
+            prev = res.get(node['name'], (0, 0))
+            res[node['name']] = (prev[0] + own, prev[1] + node['total'])
+            for child in node['children']:
+                walk(child)
+
+        for root in self.roots:
+            walk(root)
+        return sorted([(k, v[0], v[1]) for k, v in res.items()], key=lambda x: x[1], reverse=True)
+
+    def critical_path(self):
+        """follows the most expensive import at each level starting from the most expensive top-level import"""
+        path = []
+        nodes = self.roots
+        while len(nodes) > 0:
+            node = max(nodes, key=lambda x: x['total'])
+            path.append((node['name'], node['total']))
+            nodes = node['children']
+        return path
+
+    def summary(self, top=10):
+        total = sum([root['total'] for root in self.roots])
+        modules = ' '.join([f'{name}={own:.2f}s' for name, own, _total in self.modules()[:top]])
+        path = ' > '.join([f'{name}={t:.2f}s' for name, t in self.critical_path()])
+        return f'total={total:.1f}s top: {modules} critical-path: {path}'
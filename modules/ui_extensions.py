@@ -38,8 +38,7 @@ def update_extension_list():
     except Exception:
         shared.log.debug(f'Extensions list failed to load: {os.path.join(paths.script_path, "html", "extensions.json")}')
     found = []
-    for ext in extensions.extensions:
-        ext.read_info_from_repo()
+    extensions.read_info_all()
     for ext in extensions_list:
         installed = [extension for extension in extensions.extensions
                      if extension.git_name == ext['name']
@@ -116,6 +115,7 @@ def check_updates(_id_task, disable_list, search_text, sort_column):
         except Exception as e:
             errors.display(e, f'extensions check update: {ext.name}')
         shared.state.nextjob()
+    extensions.save_info_cache()
     return refresh_extensions_list_from_data(search_text, sort_column), "Extension update complete | Restart required"
 
 
@@ -243,6 +243,7 @@ def update_extension(extension_path, search_text, sort_column):
             errors.display(e, f'extensions check update: {ext.name}')
         shared.log.debug(f'Extensions update finish: {ext.name} {ext.commit_hash} {ext.commit_date}')
         shared.state.nextjob()
+    extensions.save_info_cache()
     return refresh_extensions_list_from_data(search_text, sort_column), f"Extension updated | {extension_path} | Restart required"
 
 
@@ -309,6 +310,7 @@ def refresh_extensions_list_from_data(search_text, sort_column):
         ext['remote'] = extension[0].remote if len(extension) > 0 else None
         ext['path'] = extension[0].path if len(extension) > 0 else ''
         ext['sort_default'] = f"{'1' if ext['is_builtin'] else '0'}{'1' if ext['installed'] else '0'}{ext.get('updated', '2000-01-01T00:00')}"
+    extensions.save_info_cache()
     sort_reverse, sort_function = sort_ordering[sort_column]
 
     def dt(x: str):
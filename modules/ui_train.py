@@ -137,6 +137,8 @@ def create_ui(txt2img_preview_params):
                 with gr.Tab(label="Train embedding", id="train_embedding_tab") as tab_ti:
                     tab_ti.select(fn=lambda x: train_tab_change('ti'), inputs=[], outputs=[action_pp, action_ti, action_hn])
                     def get_textual_inversion_template_names():
+                        if len(textual_inversion.textual_inversion_templates) == 0: # not yet listed when started with --lazy
+                            textual_inversion.list_textual_inversion_templates()
                         return sorted(textual_inversion.textual_inversion_templates)
 
                     gr.Markdown('## Select existing embedding to continue training or create a new one')
@@ -5,7 +5,7 @@ import PIL
 from PIL import Image
 
 import modules.shared
-from modules import modelloader
+from modules import modelloader, processing_recovery
 
 LANCZOS = (Image.Resampling.LANCZOS if hasattr(Image, 'Resampling') else Image.LANCZOS)
 NEAREST = (Image.Resampling.NEAREST if hasattr(Image, 'Resampling') else Image.NEAREST)
@@ -57,7 +57,7 @@ class Upscaler:
         dest_h = int(img.height * scale)
         for _ in range(3):
             shape = (img.width, img.height)
-            img = self.do_upscale(img, selected_model)
+            img = processing_recovery.upscale(self.do_upscale, img, selected_model)
             if shape == (img.width, img.height):
                 break
             if img.width >= dest_w and img.height >= dest_h:
@@ -66,6 +66,24 @@ class Upscaler:
             img = img.resize((int(dest_w), int(dest_h)), resample=LANCZOS)
         return img
 
+    def do_upscale_batch(self, imgs, selected_model: str):
+        """upscalers that can process several images of same size in one pass override this"""
+        return [self.do_upscale(img, selected_model) for img in imgs]
+
+    def upscale_batch(self, imgs, scale, selected_model: str = None):
+        """same as upscale for list of images of same size"""
+        self.scale = scale
+        dest_w = int(imgs[0].width * scale)
+        dest_h = int(imgs[0].height * scale)
+        for _ in range(3):
+            shape = (imgs[0].width, imgs[0].height)
+            imgs = processing_recovery.upscale(self.do_upscale_batch, imgs, selected_model)
+            if shape == (imgs[0].width, imgs[0].height):
+                break
+            if imgs[0].width >= dest_w and imgs[0].height >= dest_h:
+                break
+        return [img if img.width == dest_w and img.height == dest_h else img.resize((int(dest_w), int(dest_h)), resample=LANCZOS) for img in imgs]
+
     @abstractmethod
     def load_model(self, path: str):
         pass
@@ -2,7 +2,7 @@ import math
 
 import gradio as gr
 import modules.scripts as scripts
-from modules import deepbooru, images, processing, shared
+from modules import deepbooru, images, processing, processing_batch, shared
 from modules.processing import Processed
 from modules.shared import opts, state
 
@@ -43,8 +43,6 @@ class Script(scripts.Script):
         original_init_image = p.init_images
         original_prompt = p.prompt
         original_inpainting_fill = p.inpainting_fill
-        state.job_count = loops * batch_count
-
         initial_color_corrections = [processing.setup_color_correction(p.init_images[0])]
 
         def calculate_denoising_strength(loop):
@@ -65,65 +63,62 @@ class Script(scripts.Script):
             return initial_denoising_strength + change
 
         history = []
-
-        for n in range(batch_count):
-            # Reset to original init image at the start of each batch
-            p.init_images = original_init_image
-
-            # Reset to original denoising strength
-            p.denoising_strength = initial_denoising_strength
-
-            last_image = None
-
-            for i in range(loops):
-                p.n_iter = 1
-                p.batch_size = 1
-                p.do_not_save_grid = True
-
-                if opts.img2img_color_correction:
-                    p.color_corrections = initial_color_corrections
-
+        chains = [original_init_image for _n in range(batch_count)] # independent loops for each batch run side by side as one batched job per step
+        last_images = [None] * batch_count
+        state.job_count = loops
+
+        for i in range(loops):
+            p.n_iter = 1
+            p.batch_size = 1
+            p.do_not_save_grid = True
+            p.denoising_strength = calculate_denoising_strength(i)
+            p.inpainting_fill = original_inpainting_fill if i == 0 else 1 # Set "masked content" to "original" after first loop.
+
+            if opts.img2img_color_correction:
+                p.color_corrections = initial_color_corrections
+
+            params = []
+            for n in range(batch_count):
+                args = { 'init_images': chains[n], 'seed': p.seed + n * loops + i }
                 if append_interrogation != "None":
-                    p.prompt = f"{original_prompt}, " if original_prompt else ""
+                    args['prompt'] = f"{original_prompt}, " if original_prompt else ""
                     if append_interrogation == "CLIP":
-                        p.prompt += shared.interrogator.interrogate(p.init_images[0])
+                        args['prompt'] += shared.interrogator.interrogate(chains[n][0])
                     elif append_interrogation == "DeepBooru":
-                        p.prompt += deepbooru.model.tag(p.init_images[0])
-
-                state.job = f"Iteration {i + 1}/{loops}, batch {n + 1}/{batch_count}"
+                        args['prompt'] += deepbooru.model.tag(chains[n][0])
+                params.append(args)
 
-                processed = processing.process_images(p)
+            state.job = f"Iteration {i + 1}/{loops}, batch size {batch_count}"
 
-                # Generation cancelled.
-                if state.interrupted:
-                    break
+            results = processing_batch.JobList(processing_batch.create_jobs(p, params), max_batch=min(batch_count, shared.opts.batch_jobs_max)).execute()
 
-                if initial_seed is None:
-                    initial_seed = processed.seed
-                    initial_info = processed.info
-
-                p.seed = processed.seed + 1
-                p.denoising_strength = calculate_denoising_strength(i + 1)
+            # Generation cancelled.
+            if state.interrupted:
+                break
 
-                if state.skipped:
-                    break
+            if initial_seed is None and results[0] is not None:
+                initial_seed = results[0].seed
+                initial_info = results[0].info
 
-                last_image = processed.images[0]
-                p.init_images = [last_image]
-                p.inpainting_fill = 1 # Set "masked content" to "original" for next loop.
+            if state.skipped:
+                break
 
+            for n, res in enumerate(results):
+                if res is None or len(res.images) == 0:
+                    continue
+                last_images[n] = res.images[0]
+                chains[n] = [res.images[0]]
                 if batch_count == 1:
-                    history.append(last_image)
-                    all_images.append(last_image)
+                    history.append(res.images[0])
+                    all_images.append(res.images[0])
 
-            if batch_count > 1 and not state.skipped and not state.interrupted:
-                history.append(last_image)
-                all_images.append(last_image)
+        if batch_count > 1 and not state.skipped and not state.interrupted:
+            history += [image for image in last_images if image is not None]
+            all_images += [image for image in last_images if image is not None]
 
-            p.inpainting_fill = original_inpainting_fill
-
-            if state.interrupted:
-                break
+        p.init_images = original_init_image
+        p.denoising_strength = initial_denoising_strength
+        p.inpainting_fill = original_inpainting_fill
 
         if len(history) > 1:
             grid = images.image_grid(history, rows=1)
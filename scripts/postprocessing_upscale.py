@@ -71,30 +71,55 @@ class ScriptPostprocessingUpscale(scripts_postprocessing.ScriptPostprocessing):
             upscale_cache.pop(next(iter(upscale_cache), None), None)
 
         if upscale_mode == 1 and upscale_crop:
-            cropped = Image.new("RGB", (upscale_to_width, upscale_to_height))
-            cropped.paste(image, box=(upscale_to_width // 2 - image.width // 2, upscale_to_height // 2 - image.height // 2))
-            image = cropped
+            image = self.crop(image, upscale_to_width, upscale_to_height)
             info["Postprocess crop to"] = f"{image.width}x{image.height}"
 
         return image
 
-    def process(self, pp: scripts_postprocessing.PostprocessedImage, upscale_mode=1, upscale_by=2.0, upscale_to_width=None, upscale_to_height=None, upscale_crop=False, upscaler_1_name=None, upscaler_2_name=None, upscaler_2_visibility=0.0): # pylint: disable=arguments-differ
+    def upscale_batch(self, images, info, upscaler, upscale_mode, upscale_by,  upscale_to_width, upscale_to_height, upscale_crop):
+        """images of same size are upscaled together, cache is skipped since batch inputs are not repeated"""
+        if upscale_mode == 1:
+            upscale_by = max(upscale_to_width/images[0].width, upscale_to_height/images[0].height)
+            info["Postprocess upscale to"] = f"{upscale_to_width}x{upscale_to_height}"
+        else:
+            info["Postprocess upscale by"] = upscale_by
+
+        images = upscaler.scaler.upscale_batch(images, upscale_by, upscaler.data_path)
+
+        if upscale_mode == 1 and upscale_crop:
+            images = [self.crop(image, upscale_to_width, upscale_to_height) for image in images]
+            info["Postprocess crop to"] = f"{upscale_to_width}x{upscale_to_height}"
+
+        return images
+
+    def crop(self, image, width, height):
+        cropped = Image.new("RGB", (width, height))
+        cropped.paste(image, box=(width // 2 - image.width // 2, height // 2 - image.height // 2))
+        return cropped
 
+    def find_upscalers(self, upscaler_1_name, upscaler_2_name):
         if upscaler_1_name == "None":
             upscaler_1_name = None
         upscaler1 = next(iter([x for x in shared.sd_upscalers if x.name == upscaler_1_name]), None)
         if not upscaler1:
             if upscaler_1_name is not None:
                 shared.log.warning(f"Could not find upscaler: {upscaler_1_name or '<empty string>'}")
-            return
-        upscaled_image = self.upscale(pp.image, pp.info, upscaler1, upscale_mode, upscale_by, upscale_to_width, upscale_to_height, upscale_crop)
-        pp.info["Postprocess upscaler"] = upscaler1.name
-
+            return None, None
         if upscaler_2_name == "None":
             upscaler_2_name = None
         upscaler2 = next(iter([x for x in shared.sd_upscalers if x.name == upscaler_2_name and x.name != "None"]), None)
         if not upscaler2 and (upscaler_2_name is not None):
             shared.log.warning(f"Could not find upscaler: {upscaler_2_name or '<empty string>'}")
+        return upscaler1, upscaler2
+
+    def process(self, pp: scripts_postprocessing.PostprocessedImage, upscale_mode=1, upscale_by=2.0, upscale_to_width=None, upscale_to_height=None, upscale_crop=False, upscaler_1_name=None, upscaler_2_name=None, upscaler_2_visibility=0.0): # pylint: disable=arguments-differ
+
+        upscaler1, upscaler2 = self.find_upscalers(upscaler_1_name, upscaler_2_name)
+        if not upscaler1:
+            return
+        upscaled_image = self.upscale(pp.image, pp.info, upscaler1, upscale_mode, upscale_by, upscale_to_width, upscale_to_height, upscale_crop)
+        pp.info["Postprocess upscaler"] = upscaler1.name
+
         if upscaler2 and upscaler_2_visibility > 0:
             second_upscale = self.upscale(pp.image, pp.info, upscaler2, upscale_mode, upscale_by, upscale_to_width, upscale_to_height, upscale_crop)
             upscaled_image = Image.blend(upscaled_image, second_upscale, upscaler_2_visibility)
@@ -102,6 +127,23 @@ class ScriptPostprocessingUpscale(scripts_postprocessing.ScriptPostprocessing):
 
         pp.image = upscaled_image
 
+    def process_batch(self, pps: list, upscale_mode=1, upscale_by=2.0, upscale_to_width=None, upscale_to_height=None, upscale_crop=False, upscaler_1_name=None, upscaler_2_name=None, upscaler_2_visibility=0.0): # pylint: disable=arguments-differ
+        upscaler1, upscaler2 = self.find_upscalers(upscaler_1_name, upscaler_2_name)
+        if not upscaler1:
+            return
+        info = {}
+        upscaled_images = self.upscale_batch([pp.image for pp in pps], info, upscaler1, upscale_mode, upscale_by, upscale_to_width, upscale_to_height, upscale_crop)
+        info["Postprocess upscaler"] = upscaler1.name
+
+        if upscaler2 and upscaler_2_visibility > 0:
+            second_upscales = self.upscale_batch([pp.image for pp in pps], info, upscaler2, upscale_mode, upscale_by, upscale_to_width, upscale_to_height, upscale_crop)
+            upscaled_images = [Image.blend(a, b, upscaler_2_visibility) for a, b in zip(upscaled_images, second_upscales)]
+            info["Postprocess upscaler 2"] = upscaler2.name
+
+        for pp, image in zip(pps, upscaled_images):
+            pp.image = image
+            pp.info.update(info)
+
     def image_changed(self):
         upscale_cache.clear()
 
@@ -130,3 +172,19 @@ class ScriptPostprocessingUpscaleSimple(ScriptPostprocessingUpscale):
 
         pp.image = self.upscale(pp.image, pp.info, upscaler1, 0, upscale_by, 0, 0, False)
         pp.info["Postprocess upscaler"] = upscaler1.name
+
+    def process_batch(self, pps: list, upscale_by=2.0, upscaler_name=None): # pylint: disable=arguments-differ
+        if upscaler_name is None or upscaler_name == "None":
+            return
+
+        upscaler1 = next(iter([x for x in shared.sd_upscalers if x.name == upscaler_name]), None)
+        if upscaler1 is None:
+            shared.log.debug(f"Upscaler not found: {upscaler_name}")
+            return
+
+        info = {}
+        upscaled_images = self.upscale_batch([pp.image for pp in pps], info, upscaler1, 0, upscale_by, 0, 0, False)
+        info["Postprocess upscaler"] = upscaler1.name
+        for pp, image in zip(pps, upscaled_images):
+            pp.image = image
+            pp.info.update(info)
@@ -1,7 +1,7 @@
 import math
 import gradio as gr
 import modules.scripts as scripts
-from modules import images
+from modules import images, processing_batch
 from modules.processing import process_images
 from modules.shared import opts, state
 import modules.sd_samplers
@@ -53,9 +53,12 @@ class Script(scripts.Script):
             with gr.Column():
                 margin_size = gr.Slider(label="Grid margins", minimum=0, maximum=500, value=0, step=2, elem_id=self.elem_id("margin_size"))
 
-        return [put_at_start, different_seeds, prompt_type, variations_delimiter, margin_size]
+            with gr.Column():
+                batch_jobs = gr.Checkbox(label='Batch combinations', value=True, elem_id=self.elem_id("batch_jobs"))
+
+        return [put_at_start, different_seeds, prompt_type, variations_delimiter, margin_size, batch_jobs]
 
-    def run(self, p, put_at_start, different_seeds, prompt_type, variations_delimiter, margin_size):
+    def run(self, p, put_at_start, different_seeds, prompt_type, variations_delimiter, margin_size, batch_jobs=False): # pylint: disable=arguments-differ
         modules.processing.fix_seed(p)
         # Raise error if promp type is not positive or negative
         if prompt_type not in ["positive", "negative"]:
@@ -83,18 +86,27 @@ class Script(scripts.Script):
 
             all_prompts.append(delimiter.join(selected_prompts))
 
-        p.n_iter = math.ceil(len(all_prompts) / p.batch_size)
         p.do_not_save_grid = True
-
-        print(f"Prompt matrix will create {len(all_prompts)} images using a total of {p.n_iter} batches.")
-
-        if prompt_type == "positive":
-            p.prompt = all_prompts
-        else:
-            p.negative_prompt = all_prompts
-        p.seed = [p.seed + (i if different_seeds else 0) for i in range(len(all_prompts))]
         p.prompt_for_display = positive_prompt
-        processed = process_images(p)
+        if batch_jobs:
+            field = 'prompt' if prompt_type == "positive" else 'negative_prompt'
+            params = [{ field: text, 'seed': p.seed + (i if different_seeds else 0) } for i, text in enumerate(all_prompts)]
+            max_batch = max(p.batch_size, opts.batch_jobs_max)
+            p.batch_size = 1
+            p.n_iter = 1
+            job_list = processing_batch.JobList(processing_batch.create_jobs(p, params), max_batch=max_batch)
+            print(f"Prompt matrix will create {len(all_prompts)} images using a total of {len(job_list.batches)} batches.")
+            state.job_count = len(job_list.batches)
+            processed = processing_batch.join(p, job_list.execute())
+        else:
+            p.n_iter = math.ceil(len(all_prompts) / p.batch_size)
+            print(f"Prompt matrix will create {len(all_prompts)} images using a total of {p.n_iter} batches.")
+            if prompt_type == "positive":
+                p.prompt = all_prompts
+            else:
+                p.negative_prompt = all_prompts
+            p.seed = [p.seed + (i if different_seeds else 0) for i in range(len(all_prompts))]
+            processed = process_images(p)
 
         if images.check_grid_size(processed.images):
             grid = images.image_grid(processed.images, p.batch_size, rows=1 << ((len(prompt_matrix_parts) - 1) // 2))
@@ -3,7 +3,7 @@ import random
 import shlex
 import gradio as gr
 import modules.scripts as scripts
-from modules import sd_samplers, errors
+from modules import sd_samplers, errors, processing_batch
 from modules.processing import Processed, process_images
 from modules.shared import state
 
@@ -116,9 +116,10 @@ class Script(scripts.Script):
         # We don't shrink back to 1, because that causes the control to ignore [enter], and it may
         # be unclear to the user that shift-enter is needed.
         prompt_txt.change(lambda tb: gr.update(lines=7) if ("\n" in tb) else gr.update(lines=2), inputs=[prompt_txt], outputs=[prompt_txt], show_progress=False)
-        return [checkbox_iterate, checkbox_iterate_batch, prompt_txt]
+        checkbox_batch = gr.Checkbox(label="Batch lines with same settings", value=True, elem_id=self.elem_id("checkbox_batch"))
+        return [checkbox_iterate, checkbox_iterate_batch, prompt_txt, checkbox_batch]
 
-    def run(self, p, checkbox_iterate, checkbox_iterate_batch, prompt_txt: str):
+    def run(self, p, checkbox_iterate, checkbox_iterate_batch, prompt_txt: str, checkbox_batch=False): # pylint: disable=arguments-differ
         lines = [x.strip() for x in prompt_txt.splitlines()]
         lines = [x for x in lines if len(x) > 0]
 
@@ -143,6 +144,16 @@ class Script(scripts.Script):
         if (checkbox_iterate or checkbox_iterate_batch) and p.seed == -1:
             p.seed = int(random.randrange(4294967294))
 
+        if checkbox_batch:
+            params = []
+            for args in jobs:
+                params.append({ 'seed': p.seed, **args })
+                if checkbox_iterate:
+                    p.seed = p.seed + (p.batch_size * p.n_iter)
+            job_list = processing_batch.JobList(processing_batch.create_jobs(p, params))
+            state.job_count = len(job_list.batches)
+            return processing_batch.join(p, job_list.execute())
+
         state.job_count = job_count
 
         images = []
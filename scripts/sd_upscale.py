@@ -2,7 +2,7 @@ import math
 import gradio as gr
 from PIL import Image
 import modules.scripts as scripts
-from modules import processing, shared, images, devices
+from modules import processing, processing_tiled, shared, images, devices
 from modules.processing import Processed
 from modules.shared import opts, state
 
@@ -31,7 +31,6 @@ class Script(scripts.Script):
         p.extra_generation_params["SD upscale overlap"] = overlap
         p.extra_generation_params["SD upscale upscaler"] = upscaler.name
 
-        initial_info = None
         seed = p.seed
 
         init_img = p.init_images[0]
@@ -44,6 +43,33 @@ class Script(scripts.Script):
 
         devices.torch_gc()
 
+        if shared.backend == shared.Backend.ORIGINAL:
+            return self.run_latent(p, img, overlap)
+        return self.run_tiles(p, img, overlap, seed)
+
+    def run_latent(self, p, img, overlap):
+        """single img2img job over whole image, encoded and decoded once while unet runs over batches of latent tiles"""
+        tile_w, tile_h = p.width, p.height
+        tiled = processing_tiled.TiledDenoiser(tile_w, tile_h, overlap, batch_size=p.batch_size)
+        width, height = max(img.width // 8 * 8, 8), max(img.height // 8 * 8, 8)
+        tiles = tiled.tiles(height // 8, width // 8)
+        cols = len({x for _y, x, _h, _w in tiles})
+        rows = len(tiles) // cols
+        p.init_images = [img.resize((width, height), resample=Image.LANCZOS) if (width, height) != img.size else img] # latent needs size divisible by 8
+        p.width, p.height = width, height
+        p.resize_mode = 0
+        p.batch_size = 1
+        p.do_not_save_grid = True
+        p.extra_generation_params["SD upscale tiles"] = f"{cols}x{rows}"
+        state.job_count = p.n_iter
+        shared.log.info(f'SD upscale: size={width}x{height} tile={tile_w}x{tile_h} overlap={overlap} tiles={cols}x{rows} batch={tiled.batch_size} upscales={p.n_iter}')
+        with tiled, opts.overlay({ 'sd_vae_tiled_decode': True }):
+            processed = processing.process_images(p)
+        return processed
+
+    def run_tiles(self, p, img, overlap, seed):
+        """img2img job per batch of tiles combined in pixel space"""
+        initial_info = None
         grid = images.split_grid(img, tile_w=p.width, tile_h=p.height, overlap=overlap)
 
         batch_size = p.batch_size
@@ -12,7 +12,7 @@ import numpy as np
 import gradio as gr
 import modules.scripts as scripts
 import modules.shared as shared
-from modules import images, sd_samplers, processing, sd_models, sd_vae
+from modules import images, sd_samplers, processing, processing_batch, sd_models, sd_vae
 from modules.processing import process_images, Processed, StableDiffusionProcessingTxt2Img
 from modules.ui_components import ToolButton
 
@@ -97,7 +97,6 @@ def apply_dict(p, x, xs):
 
 def apply_clip_skip(p, x, xs):
     p.clip_skip = x
-    shared.opts.data["clip_skip"] = x
 
 
 def apply_upscale_latent_space(p, x, xs):
@@ -322,19 +321,32 @@ def draw_xyz_grid(p, xs, ys, zs, x_labels, y_labels, z_labels, cell, draw_legend
     for i in range(z_count):
         start_index = (i * len(xs) * len(ys)) + i
         end_index = start_index + len(xs) * len(ys)
-        if not no_grid and images.check_grid_size(processed_result.images[start_index:end_index]):
-            grid = images.image_grid(processed_result.images[start_index:end_index], rows=len(ys))
-            if draw_legend:
-                grid = images.draw_grid_annotations(grid, processed_result.images[start_index].size[0], processed_result.images[start_index].size[1], hor_texts, ver_texts, margin_size)
+        if not no_grid:
+            cells = processed_result.images[start_index:end_index]
+            if images.check_grid_size(cells):
+                grid = images.image_grid(cells, rows=len(ys))
+                if draw_legend:
+                    grid = images.draw_grid_annotations(grid, cells[0].size[0], cells[0].size[1], hor_texts, ver_texts, margin_size)
+            else: # composed one row at a time when saved
+                grid = images.GridStream(cells, rows=len(ys), hor_texts=hor_texts if draw_legend else None, ver_texts=ver_texts if draw_legend else None, margin=margin_size).preview()
             processed_result.images.insert(i, grid)
         processed_result.all_prompts.insert(i, processed_result.all_prompts[start_index])
         processed_result.all_seeds.insert(i, processed_result.all_seeds[start_index])
         processed_result.infotexts.insert(i, processed_result.infotexts[start_index])
     sub_grid_size = processed_result.images[0].size
-    if not no_grid and images.check_grid_size(processed_result.images[:z_count]):
-        z_grid = images.image_grid(processed_result.images[:z_count], rows=1)
-        if draw_legend:
-            z_grid = images.draw_grid_annotations(z_grid, sub_grid_size[0], sub_grid_size[1], title_texts, [[images.GridAnnotation()]])
+    if not no_grid:
+        sub_grids = processed_result.images[:z_count]
+        streams = [getattr(grid, 'grid_stream', None) for grid in sub_grids]
+        if all(s is None for s in streams) and images.check_grid_size(sub_grids):
+            z_grid = images.image_grid(sub_grids, rows=1)
+            if draw_legend:
+                z_grid = images.draw_grid_annotations(z_grid, sub_grid_size[0], sub_grid_size[1], title_texts, [[images.GridAnnotation()]])
+        elif all(s is not None for s in streams) and images.GridStreamColumns.compatible(streams): # combined strip by strip from full sub-grids instead of their previews
+            z_grid = images.GridStreamColumns(streams, hor_texts=title_texts if draw_legend else None).preview()
+        else:
+            if any(s is not None for s in streams):
+                shared.log.warning(f'XYZ grid: streamed sub-grids have different layouts, z-grid is composed from downscaled previews: {[g.size if s is None else s.size for s, g in zip(streams, sub_grids)]}')
+            z_grid = images.GridStream(sub_grids, rows=1, hor_texts=title_texts if draw_legend else None, ver_texts=[[images.GridAnnotation()]] if draw_legend else None).preview()
         processed_result.images.insert(0, z_grid)
     #processed_result.all_prompts.insert(0, processed_result.all_prompts[0])
     #processed_result.all_seeds.insert(0, processed_result.all_seeds[0])
@@ -406,6 +418,7 @@ class Script(scripts.Script):
             no_grid = gr.Checkbox(label='Do not create grid', value=False, elem_id=self.elem_id("no_xyz_grid"))
             include_lone_images = gr.Checkbox(label='Include Sub Images', value=False, elem_id=self.elem_id("include_lone_images"))
             include_sub_grids = gr.Checkbox(label='Include Sub Grids', value=False, elem_id=self.elem_id("include_sub_grids"))
+            batch_cells = gr.Checkbox(label='Batch cells', value=True, elem_id=self.elem_id("batch_cells"))
         with gr.Row(variant="compact", elem_id="axis_options"):
             margin_size = gr.Slider(label="Grid margins", minimum=0, maximum=500, value=0, step=2, elem_id=self.elem_id("margin_size"))
         with gr.Row(variant="compact", elem_id="swap_axes"):
@@ -464,9 +477,9 @@ class Script(scripts.Script):
             (z_values_dropdown, lambda params:get_dropdown_update_from_params("Z",params)),
         )
 
-        return [x_type, x_values, x_values_dropdown, y_type, y_values, y_values_dropdown, z_type, z_values, z_values_dropdown, draw_legend, include_lone_images, include_sub_grids, no_fixed_seeds, margin_size, no_grid]
+        return [x_type, x_values, x_values_dropdown, y_type, y_values, y_values_dropdown, z_type, z_values, z_values_dropdown, draw_legend, include_lone_images, include_sub_grids, no_fixed_seeds, margin_size, no_grid, batch_cells]
 
-    def run(self, p, x_type, x_values, x_values_dropdown, y_type, y_values, y_values_dropdown, z_type, z_values, z_values_dropdown, draw_legend, include_lone_images, include_sub_grids, no_fixed_seeds, margin_size, no_grid): # pylint: disable=arguments-differ
+    def run(self, p, x_type, x_values, x_values_dropdown, y_type, y_values, y_values_dropdown, z_type, z_values, z_values_dropdown, draw_legend, include_lone_images, include_sub_grids, no_fixed_seeds, margin_size, no_grid, batch_cells=False): # pylint: disable=arguments-differ
         shared.log.debug(f'xyzgrid: x_type={x_type}|x_values={x_values}|x_values_dropdown={x_values_dropdown}|y_type={y_type}|{y_values}={y_values}|{y_values_dropdown}={y_values_dropdown}|z_type={z_type}|z_values={z_values}|z_values_dropdown={z_values_dropdown}|draw_legend={draw_legend}|include_lone_images={include_lone_images}|include_sub_grids={include_sub_grids}|no_grid={no_grid}|margin_size={margin_size}')
         if not no_fixed_seeds:
             processing.fix_seed(p)
@@ -596,15 +609,17 @@ class Script(scripts.Script):
                 second_axes_processed = 'y'
         grid_infotext = [None] * (1 + len(zs))
 
-        def cell(x, y, z, ix, iy, iz):
-            if shared.state.interrupted:
-                return Processed(p, [], p.seed, "")
+        def make_cell(x, y, z, costly=True):
+            """job for a cell; axes with cost change models or global settings when applied so they can be deferred until cell runs"""
             pc = copy(p)
             pc.styles = pc.styles[:]
-            x_opt.apply(pc, x, xs)
-            y_opt.apply(pc, y, ys)
-            z_opt.apply(pc, z, zs)
-            res = process_images(pc)
+            pc.override_settings = copy(pc.override_settings)
+            for opt, val, vals in [(x_opt, x, xs), (y_opt, y, ys), (z_opt, z, zs)]:
+                if costly or opt.cost == 0:
+                    opt.apply(pc, val, vals)
+            return pc
+
+        def set_grid_infotext(pc, ix, iy, iz, index=0):
             # Sets subgrid infotexts
             subgrid_index = 1 + iz
             if grid_infotext[subgrid_index] is None and ix == 0 and iy == 0:
@@ -620,7 +635,7 @@ class Script(scripts.Script):
                     pc.extra_generation_params["Y Values"] = y_values
                     if y_opt.label in ["Seed", "Var. seed"] and not no_fixed_seeds:
                         pc.extra_generation_params["Fixed Y Values"] = ", ".join([str(y) for y in ys])
-                grid_infotext[subgrid_index] = processing.create_infotext(pc, pc.all_prompts, pc.all_seeds, pc.all_subseeds)
+                grid_infotext[subgrid_index] = processing.create_infotext(pc, pc.all_prompts, pc.all_seeds, pc.all_subseeds, index=index)
             # Sets main grid infotext
             if grid_infotext[0] is None and ix == 0 and iy == 0 and iz == 0:
                 pc.extra_generation_params = copy(pc.extra_generation_params)
@@ -630,10 +645,48 @@ class Script(scripts.Script):
                     pc.extra_generation_params["Z Values"] = z_values
                     if z_opt.label in ["Seed", "Var. seed"] and not no_fixed_seeds:
                         pc.extra_generation_params["Fixed Z Values"] = ", ".join([str(z) for z in zs])
-                grid_infotext[0] = processing.create_infotext(pc, pc.all_prompts, pc.all_seeds, pc.all_subseeds)
+                grid_infotext[0] = processing.create_infotext(pc, pc.all_prompts, pc.all_seeds, pc.all_subseeds, index=index)
+
+        batched = {} # cell -> (processed, job, index in job)
+
+        def run_batched():
+            """run all cells upfront: cells sharing model, sampler, size, steps and other settings run as one batch and groups are ordered by costly axes"""
+            cells = [(ix, iy, iz) for iz in range(len(zs)) for iy in range(len(ys)) for ix in range(len(xs))]
+            jobs = [make_cell(xs[ix], ys[iy], zs[iz], costly=False) for ix, iy, iz in cells]
+            costly = [axis for axis, opt in sorted(enumerate([x_opt, y_opt, z_opt]), key=lambda a: -a[1].cost) if opt.cost > 0]
+            job_list = processing_batch.JobList(jobs, groups=[tuple(cell[axis] for axis in costly) for cell in cells], max_batch=min(max(len(xs), len(ys), len(zs)), shared.opts.batch_jobs_max))
+            executed = {}
+
+            def prepare(pb, indexes):
+                ix, iy, iz = cells[indexes[0]]
+                for opt, val, vals in [(x_opt, xs[ix], xs), (y_opt, ys[iy], ys), (z_opt, zs[iz], zs)]:
+                    if opt.cost > 0:
+                        opt.apply(pb, val, vals)
+                for position, i in enumerate(indexes):
+                    executed[cells[i]] = (pb, position)
+
+            shared.state.job_count = len(job_list.batches)
+            results = job_list.execute(prepare=prepare)
+            for cell_index, res in zip(cells, results):
+                if res is not None:
+                    batched[cell_index] = (res, *executed[cell_index])
+            shared.log.info(f"XYZ grid: planned={job_list.planned()} actual={job_list.actual}")
+
+        def cell(x, y, z, ix, iy, iz):
+            if (ix, iy, iz) in batched:
+                res, pc, index = batched[(ix, iy, iz)]
+                set_grid_infotext(pc, ix, iy, iz, index=index)
+                return res
+            if shared.state.interrupted:
+                return Processed(p, [], p.seed, "")
+            pc = make_cell(x, y, z)
+            res = process_images(pc)
+            set_grid_infotext(pc, ix, iy, iz)
             return res
 
         with SharedSettingsStackHelper():
+            if batch_cells:
+                run_batched()
             processed = draw_xyz_grid(
                 p,
                 xs=xs,
@@ -0,0 +1,39 @@
+import pytest
+torch = pytest.importorskip('torch')
+from modules import lowvram # pylint: disable=wrong-import-position
+
+cuda = pytest.mark.skipif(not torch.cuda.is_available(), reason='offload engine moves blocks to cuda')
+
+
+def offloaded_block():
+    engine = lowvram.OffloadEngine(torch.device('cuda'), pin_memory=False)
+    block = torch.nn.Linear(4, 4)
+    engine.register(block)
+    engine.load(block)
+    return engine, block
+
+
+@cuda
+def test_evict_keeps_host_copy_of_unchanged_block():
+    engine, block = offloaded_block()
+    expected = block.weight.detach().cpu().clone()
+    engine.evict(block)
+    assert block.weight.device.type == 'cpu'
+    assert torch.equal(block.weight.detach(), expected)
+    assert engine.stats['writebacks'] == 0
+
+
+@cuda
+def test_evict_writes_back_inplace_change():
+    engine, block = offloaded_block()
+    with torch.no_grad(): # same as lora applying weights on device
+        block.weight += 1
+        block.bias.copy_(torch.ones(4))
+    expected = block.weight.detach().cpu().clone()
+    engine.evict(block)
+    assert block.weight.device.type == 'cpu'
+    assert torch.equal(block.weight.detach(), expected)
+    assert torch.equal(block.bias.detach(), torch.ones(4))
+    assert engine.stats['writebacks'] == 2
+    engine.load(block) # modified weights are used after next load
+    assert torch.equal(block.weight.detach().cpu(), expected)
@@ -10,10 +10,13 @@ import warnings
 import importlib
 from threading import Thread
 import urllib3
-from modules import timer, errors, paths # pylint: disable=unused-import
+from modules import timer, errors, paths, cmd_args # pylint: disable=unused-import
 
 startup_timer = timer.Timer()
+import_timer = timer.ImportTimer()
 local_url = None
+if cmd_args.parser.parse_known_args()[0].profile:
+    import_timer.install()
 
 errors.log.debug('Loading Torch')
 import torch # pylint: disable=C0411
@@ -48,24 +51,25 @@ from modules.paths import create_paths
 from modules import shared, extensions, extra_networks, ui_tempdir, ui_extra_networks, modelloader
 import modules.devices
 import modules.sd_samplers
-import modules.upscaler
-import modules.codeformer_model as codeformer
-import modules.face_restoration
-import modules.gfpgan_model as gfpgan
-import modules.img2img
 import modules.lowvram
 import modules.scripts
 import modules.sd_hijack
 import modules.sd_models
 import modules.sd_vae
-import modules.txt2img
 import modules.script_callbacks
-import modules.textual_inversion.textual_inversion
 import modules.progress
-import modules.ui
 from modules.shared import cmd_opts, opts
-import modules.hypernetworks.hypernetwork
 from modules.middleware import setup_middleware
+if not cmd_opts.lazy:
+    import modules.upscaler
+    import modules.codeformer_model as codeformer
+    import modules.face_restoration
+    import modules.gfpgan_model as gfpgan
+    import modules.img2img
+    import modules.txt2img
+    import modules.textual_inversion.textual_inversion
+    import modules.hypernetworks.hypernetwork
+    import modules.ui
 startup_timer.record("libraries")
 log.info('Libraries loaded')
 log.setLevel(logging.DEBUG if cmd_opts.debug else logging.INFO)
@@ -102,6 +106,20 @@ def check_rollback_vae():
             shared.cmd_opts.rollback_vae = False
 
 
+def load_face_restorers():
+    import modules.codeformer_model as codeformer # pylint: disable=redefined-outer-name
+    import modules.gfpgan_model as gfpgan # pylint: disable=redefined-outer-name
+    codeformer.setup_model(opts.codeformer_models_path)
+    startup_timer.record("codeformer")
+    gfpgan.setup_model(opts.gfpgan_models_path)
+    startup_timer.record("gfpgan")
+
+
+def load_upscalers():
+    modelloader.load_upscalers()
+    startup_timer.record("upscalers")
+
+
 def initialize():
     log.debug('Entering initialize')
     shared.disable_extensions()
@@ -120,18 +138,19 @@ def initialize():
     modules.sd_models.setup_model()
     startup_timer.record("models")
 
-    codeformer.setup_model(opts.codeformer_models_path)
-    startup_timer.record("codeformer")
-
-    gfpgan.setup_model(opts.gfpgan_models_path)
-    startup_timer.record("gfpgan")
+    if cmd_opts.lazy:
+        shared.lazy_register('face_restorers', load_face_restorers)
+    else:
+        load_face_restorers()
 
     log.debug('Loading scripts')
     modules.scripts.load_scripts()
     startup_timer.record("scripts")
 
-    modelloader.load_upscalers()
-    startup_timer.record("upscalers")
+    if cmd_opts.lazy:
+        shared.lazy_register('upscalers', load_upscalers)
+    else:
+        load_upscalers()
 
     setup_logging() # needs a reset since scripts can hijaack logging
 
@@ -140,7 +159,8 @@ def initialize():
     shared.opts.onchange("gradio_theme", shared.reload_gradio_theme)
     startup_timer.record("onchange")
 
-    modules.textual_inversion.textual_inversion.list_textual_inversion_templates()
+    if not cmd_opts.lazy:
+        modules.textual_inversion.textual_inversion.list_textual_inversion_templates()
     shared.reload_hypernetworks()
 
     ui_extra_networks.initialize()
@@ -244,6 +264,7 @@ def start_common():
 
 def start_ui():
     log.debug('Creating UI')
+    import modules.ui # pylint: disable=redefined-outer-name
     modules.script_callbacks.before_ui_callback()
     startup_timer.record("before-ui")
     shared.demo = modules.ui.create_ui(startup_timer)
@@ -340,10 +361,18 @@ def webui(restart=False):
     else:
         for module in [module for name, module in sys.modules.items() if name.startswith("modules.ui")]:
             importlib.reload(module)
+    log_import_profile()
 
     return shared.demo.server
 
 
+def log_import_profile():
+    if import_timer.original is None:
+        return
+    import_timer.uninstall()
+    log.info(f'Import profile: {import_timer.summary()}')
+
+
 def api_only():
     start_common()
     app = FastAPI(**fastapi_args)
@@ -353,6 +382,7 @@ def api_only():
     modules.script_callbacks.app_started_callback(None, app)
     modules.sd_models.write_metadata()
     log.info(f"Startup time: {startup_timer.summary()}")
+    log_import_profile()
     server = api.launch()
     return server
 